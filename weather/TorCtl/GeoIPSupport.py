@@ -25,7 +25,7 @@ class Continent:
     self.countries = []
 
   def contains(self, country_code):
-    return country_code in self.countries
+    return country_code in self.country_set
 
 # Set countries to continents
 africa = Continent("AF")
@@ -69,18 +69,77 @@ south_america.countries = ["AG","AI","AN","AR","AW","BB","BM","BO","BR","BS",
 # List of continents
 continents = [africa, asia, europe, north_america, oceania, south_america]
 
+# Precomputed country -> continent map. Where a code is listed on two
+# continents, the first one in 'continents' wins, as with the old scan.
+# Continents also get a small integer id for cheap path comparisons.
+continent_of = {}
+for i in xrange(len(continents)):
+  continents[i].id = i
+  continents[i].country_set = set(continents[i].countries)
+  for country in continents[i].countries:
+    continent_of.setdefault(country, continents[i])
+
+# Integer ids for country codes, assigned as they are first seen
+country_ids = {}
+
+def get_country_id(country_code):
+  """ Return the integer id of 'country_code' (None for None) """
+  if country_code == None: return None
+  if country_code not in country_ids:
+    country_ids[country_code] = len(country_ids)
+  return country_ids[country_code]
+
 def get_continent(country_code):
   """ Perform country -- continent mapping """
-  for c in continents:
-    if c.contains(country_code):
-      return c
-  plog("INFO", country_code + " is not on any continent")
-  return None
+  c = continent_of.get(country_code)
+  if c == None:
+    plog("INFO", country_code + " is not on any continent")
+  return c
 
 def get_country(ip):
   """ Get the country via the library """
   return geoip.country_code_by_addr(ip)
 
+# Country codes of the router IPs seen since the last forget_countries(),
+# keyed by the integer IP. Emptied when it reaches _MAX_COUNTRY_CACHE
+# entries, for users that never call forget_countries().
+_country_cache = {}
+_MAX_COUNTRY_CACHE = 16384
+
+def forget_countries():
+  """ Forget the lookups of the previous consensus. Call it before the
+  routers of the new one are built and annotated. """
+  _country_cache.clear()
+
+def get_router_country(ip):
+  """ Country code of the integer IP 'ip', looked up once per consensus """
+  if ip not in _country_cache:
+    if len(_country_cache) >= _MAX_COUNTRY_CACHE: _country_cache.clear()
+    _country_cache[ip] = get_country(socket.inet_ntoa(struct.pack('>I', ip)))
+  return _country_cache[ip]
+
+def annotate(r):
+  """ Set the GeoIP attributes (country_code, country_id, continent,
+  continent_id and cont_group) of the Router 'r' """
+  r.country_code = get_router_country(r.ip)
+  r.country_id = get_country_id(r.country_code)
+  r.continent = r.continent_id = r.cont_group = None
+  if r.country_code != None:
+    c = get_continent(r.country_code)
+    if c != None:
+      r.continent = c.code
+      r.continent_id = c.id
+      r.cont_group = c.group
+  else:
+    plog("INFO", r.nickname + ": Country code not found")
+  r._geoip_ip = r.ip
+
+def annotate_routers(routers):
+  """ Bulk GeoIP annotation of a consensus' worth of routers. Resolves
+  each distinct IP once, reusing the lookups made since
+  forget_countries(). """
+  for r in routers: annotate(r)
+
 def get_country_from_record(ip):
   """ Get the country code out of a GeoLiteCity record (not used) """
   record = geoip.record_by_addr(ip)
@@ -93,15 +152,11 @@ class GeoIPRouter(TorCtl.Router):
   """ Router class extended to GeoIP """
   def __init__(self, router):
     self.__dict__ = router.__dict__
-    self.country_code = get_country(self.get_ip_dotted())
-    if self.country_code != None: 
-      c = get_continent(self.country_code)
-      if c != None:
-        self.continent = c.code
-        self.cont_group = c.group
-    else: 
-      plog("INFO", self.nickname + ": Country code not found")
-      self.continent = None
+    annotate(self)
+
+  def update_to(self, new):
+    TorCtl.Router.update_to(self, new)
+    if self.ip != self._geoip_ip: annotate(self)
    
   def get_ip_dotted(self):
     """ Convert long int back to dotted quad string """
@@ -53,6 +53,7 @@ import struct
 import random
 import socket
 import copy
+import itertools
 import Queue
 import time
 import TorUtil
@@ -64,6 +65,13 @@ import sys
 if sys.version_info < (2, 5):
   from sets import Set as set
 
+# NumPy is optional. Without it, NodeGenerators evaluate their
+# restrictions one router at a time.
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
 __all__ = ["NodeRestrictionList", "PathRestrictionList",
 "PercentileRestriction", "OSRestriction", "ConserveExitsRestriction",
 "FlagsRestriction", "MinBWRestriction", "VersionIncludeRestriction",
@@ -78,7 +86,7 @@ __all__ = ["NodeRestrictionList", "PathRestrictionList",
 "CountryRestriction", "UniqueCountryRestriction", "SingleCountryRestriction",
 "ContinentRestriction", "ContinentJumperRestriction",
 "UniqueContinentRestriction", "MetaPathRestriction", "RateLimitedRestriction",
-"SmartSocket"]
+"SmartSocket", "RouterColumns"]
 
 #################### Path Support Interfaces #####################
 
@@ -96,12 +104,26 @@ class NodeRestriction:
     "Returns true if Router 'r' is acceptable for this restriction"
     return True  
 
+  def r_mask(self, cols, where=None):
+    """Optional vectorized form of r_is_ok: returns a numpy boolean array
+    over the routers of the RouterColumns 'cols', or None if this 
+    restriction can only be evaluated per router. Rows that are False in
+    'where' (if given) don't matter."""
+    return None
+
 class PathRestriction:
   "Interface for path restriction policies"
   def path_is_ok(self, path):
     "Return true if the list of Routers in path satisfies this restriction"
     return True  
 
+  def next_is_ok(self, path, r):
+    """Return false if Router 'r' can never be appended to the partial
+    'path' without violating this restriction. Used to narrow the
+    candidates for each hop while a path is built; path_is_ok() still
+    has the final say."""
+    return True
+
 # TODO: Or, Not, N of M
 class MetaPathRestriction(PathRestriction):
   "MetaPathRestrictions are path restriction aggregators."
@@ -121,6 +143,13 @@ class PathRestrictionList(MetaPathRestriction):
         return False
     return True
 
+  def next_is_ok(self, path, r):
+    "Check Router 'r' as the next hop of 'path' against each restriction."
+    for rs in self.restrictions:
+      if not rs.next_is_ok(path, r):
+        return False
+    return True
+
   def add_restriction(self, rstr):
     "Add a PathRestriction 'rstr' to the list"
     self.restrictions.append(rstr)
@@ -135,7 +164,12 @@ class PathRestrictionList(MetaPathRestriction):
     return self.__class__.__name__+"("+str(map(str, self.restrictions))+")"
 
 class NodeGenerator:
-  "Interface for node generation"
+  """Interface for node generation.
+
+     The candidates live in self.routers. The first self.live entries
+     are the routers that have not been chosen since the last rewind();
+     mark_chosen() swaps a router out of that prefix, so both it and
+     rewind() are constant time."""
   def __init__(self, sorted_r, rstr_list):
     """Constructor. Takes a bandwidth-sorted list of Routers 'sorted_r' 
     and a NodeRestrictionList 'rstr_list'"""
@@ -149,8 +183,8 @@ class NodeGenerator:
 
   def rewind(self):
     "Rewind the generator to the 'beginning'"
-    self.routers = copy.copy(self.rstr_routers)
-    if not self.routers:
+    self.live = len(self.routers)
+    if not self.live:
       plog("NOTICE", "No routers left after restrictions applied: "+str(self.rstr_list))
       raise NoNodesRemain(str(self.rstr_list))
  
@@ -159,19 +193,40 @@ class NodeGenerator:
     the restrictions change. """
     if sorted_r:
       self.sorted_r = sorted_r
-    self.rstr_routers = filter(lambda r: self.rstr_list.r_is_ok(r), self.sorted_r)
+    cols = RouterColumns.get(self.sorted_r)
+    if cols:
+      self.rstr_routers = cols.select(self.rstr_list)
+    else:
+      self.rstr_routers = filter(lambda r: self.rstr_list.r_is_ok(r), self.sorted_r)
     if not self.rstr_routers:
       plog("NOTICE", "No routers left after restrictions applied: "+str(self.rstr_list))
       raise NoNodesRemain(str(self.rstr_list))
+    self.routers = list(self.rstr_routers)
+    self.live = len(self.routers)
+    self._index = {}
+    for i in xrange(self.live):
+      self._index[self.routers[i]] = i
 
   def mark_chosen(self, r):
     """Mark a router as chosen: remove it from the list of routers 
      that can be returned in the future"""
-    self.routers.remove(r)
+    i = self._index.get(r)
+    if i is None or i >= self.live:
+      raise ValueError("Router "+r.idhex+" is not a remaining candidate")
+    self.live -= 1
+    last = self.routers[self.live]
+    self.routers[i] = last
+    self._index[last] = i
+    self.routers[self.live] = r
+    self._index[r] = self.live
 
   def all_chosen(self):
     "Return true if all the routers have been marked as chosen"
-    return not self.routers
+    return not self.live
+
+  def remaining(self):
+    "Iterate over the routers that have not been chosen since rewind()"
+    return itertools.islice(self.routers, self.live)
 
   def generate(self):
     "Return a python generator that yields routers according to the policy"
@@ -189,6 +244,106 @@ class Connection(TorCtl.Connection):
     circ.circ_id = self.extend_circuit(0, circ.id_path())
     return circ
 
+##################### Columnar Router Store #######################
+
+def _defining_class(cls, name):
+  "Return the class in cls's (classic) MRO that defines attribute 'name'"
+  if name in cls.__dict__: return cls
+  for base in cls.__bases__:
+    c = _defining_class(base, name)
+    if c: return c
+  return None
+
+class RouterColumns:
+  """A columnar mirror of a list of routers, for evaluating
+  NodeRestrictions over the whole network with a few numpy operations
+  instead of one r_is_ok() call chain per router. Restrictions that
+  implement r_mask() are evaluated on the columns; all others fall back
+  to r_is_ok() for the routers that are still undecided.
+
+  Only available if numpy is installed. Use RouterColumns.get(), which
+  caches the columns for lists that carry a 'generation' counter (such as
+  TorCtl.SortedRouterList, or the TorCtl.FrozenRouterList that
+  ConsensusTracker.current_consensus() hands out) until that list
+  changes."""
+  _cache = None # (list, generation, RouterColumns)
+
+  def __init__(self, sorted_r):
+    self.routers = list(sorted_r)
+    rs = self.routers
+    self.flag_bits = {}
+    for r in rs:
+      for f in r.flags:
+        if f not in self.flag_bits:
+          self.flag_bits[f] = 1 << len(self.flag_bits)
+    def flag_mask(r):
+      m = 0
+      for f in r.flags: m |= self.flag_bits[f]
+      return m
+    self.n = len(rs)
+    self.bw = numpy.array(map(lambda r: r.bw, rs), dtype=numpy.int64)
+    self.list_rank = numpy.array(map(lambda r: r.list_rank, rs),
+                                 dtype=numpy.int64)
+    self.flags = numpy.array(map(flag_mask, rs), dtype=numpy.int64)
+    self.ip = numpy.array(map(lambda r: r.ip, rs), dtype=numpy.int64)
+    self.version = numpy.array(map(lambda r: r.version.version or -1, rs),
+                               dtype=numpy.int64)
+    self.rate_limited = numpy.array(map(lambda r: bool(r.rate_limited), rs),
+                                    dtype=bool)
+    self.country_code = numpy.array(map(lambda r: 
+                          getattr(r, "country_code", None), rs), dtype=object)
+    self.has_country_code = numpy.array(map(lambda c: c != None,
+                                            self.country_code), dtype=bool)
+    self.nickname = numpy.array(map(lambda r: r.nickname, rs), dtype=object)
+    self.idhex = numpy.array(map(lambda r: r.idhex, rs), dtype=object)
+
+  def get(sorted_r):
+    """Return the RouterColumns for 'sorted_r', or None if numpy is not
+    available."""
+    if numpy is None: return None
+    generation = getattr(sorted_r, "generation", None)
+    cached = RouterColumns._cache
+    if generation is not None and cached and cached[0] is sorted_r \
+         and cached[1] == generation:
+      return cached[2]
+    cols = RouterColumns(sorted_r)
+    if generation is not None:
+      RouterColumns._cache = (sorted_r, generation, cols)
+    return cols
+  get = Callable(get)
+
+  def flags_mask(self, flags):
+    "Bitmask of 'flags', or None if one of them is not set on any router"
+    m = 0
+    for f in flags:
+      if f not in self.flag_bits: return None
+      m |= self.flag_bits[f]
+    return m
+
+  def mask(self, rstr, where=None):
+    """Evaluate NodeRestriction 'rstr' over all routers. Rows that are
+    False in 'where' are left False without evaluating them."""
+    m = None
+    # Only trust r_mask() if it comes from the same class as r_is_ok(),
+    # so that subclasses overriding r_is_ok() keep working.
+    cls = rstr.__class__
+    if _defining_class(cls, "r_mask") is _defining_class(cls, "r_is_ok"):
+      m = rstr.r_mask(self, where)
+    if m is None:
+      m = numpy.zeros(self.n, dtype=bool)
+      if where is None: rows = xrange(self.n)
+      else: rows = numpy.flatnonzero(where)
+      for i in rows:
+        m[i] = bool(rstr.r_is_ok(self.routers[i]))
+    elif where is not None:
+      m = m & where
+    return m
+
+  def select(self, rstr):
+    "Return the list of routers accepted by 'rstr', in order"
+    rs = self.routers
+    return map(lambda i: rs[i], numpy.flatnonzero(self.mask(rstr)))
+
 ######################## Node Restrictions ########################
 
 # TODO: We still need more path support implementations
@@ -225,6 +380,10 @@ class PercentileRestriction(NodeRestriction):
     
     return True
 
+  def r_mask(self, cols, where=None):
+    return (cols.list_rank >= len(self.sorted_r)*self.pct_skip/100) & \
+           (cols.list_rank <= len(self.sorted_r)*self.pct_fast/100)
+
   def __str__(self):
     return self.__class__.__name__+"("+str(self.pct_skip)+","+str(self.pct_fast)+")"
 
@@ -241,6 +400,10 @@ class RankRestriction(NodeRestriction):
     
     return True
 
+  def r_mask(self, cols, where=None):
+    return (cols.list_rank >= self.rank_skip) & \
+           (cols.list_rank <= self.rank_stop)
+
   def __str__(self):
     return self.__class__.__name__+"("+str(self.rank_skip)+","+str(self.rank_stop)+")"
     
@@ -279,6 +442,12 @@ class ConserveExitsRestriction(NodeRestriction):
       return True
     return not "Exit" in r.flags
 
+  def r_mask(self, cols, where=None):
+    if self.exit_ports: return None
+    m = cols.flags_mask(["Exit"])
+    if m is None: return numpy.ones(cols.n, dtype=bool)
+    return (cols.flags & m) == 0
+
   def __str__(self):
     return self.__class__.__name__+"()"
 
@@ -297,6 +466,13 @@ class FlagsRestriction(NodeRestriction):
       if f in router.flags: return False
     return True
 
+  def r_mask(self, cols, where=None):
+    mand = cols.flags_mask(self.mandatory)
+    if mand is None: return numpy.zeros(cols.n, dtype=bool)
+    forb = cols.flags_mask(filter(lambda f: f in cols.flag_bits, 
+                                  self.forbidden))
+    return ((cols.flags & mand) == mand) & ((cols.flags & forb) == 0)
+
   def __str__(self):
     return self.__class__.__name__+"("+str(self.mandatory)+","+str(self.forbidden)+")"
 
@@ -308,6 +484,9 @@ class NickRestriction(NodeRestriction):
   def r_is_ok(self, router):
     return router.nickname == self.nickname
 
+  def r_mask(self, cols, where=None):
+    return cols.nickname == self.nickname
+
   def __str__(self):
     return self.__class__.__name__+"("+str(self.nickname)+")"
 
@@ -322,6 +501,9 @@ class IdHexRestriction(NodeRestriction):
   def r_is_ok(self, router):
     return router.idhex == self.idhex
 
+  def r_mask(self, cols, where=None):
+    return cols.idhex == self.idhex
+
   def __str__(self):
     return self.__class__.__name__+"("+str(self.idhex)+")"
  
@@ -332,6 +514,8 @@ class MinBWRestriction(NodeRestriction):
 
   def r_is_ok(self, router): return router.bw >= self.min_bw
 
+  def r_mask(self, cols, where=None): return cols.bw >= self.min_bw
+
   def __str__(self):
     return self.__class__.__name__+"("+str(self.min_bw)+")"
 
@@ -341,6 +525,9 @@ class RateLimitedRestriction(NodeRestriction):
 
   def r_is_ok(self, router): return router.rate_limited == self.limited
 
+  def r_mask(self, cols, where=None):
+    return cols.rate_limited == bool(self.limited)
+
   def __str__(self):
     return self.__class__.__name__+"("+str(self.limited)+")"
    
@@ -358,6 +545,12 @@ class VersionIncludeRestriction(NodeRestriction):
         return True
     return False
 
+  def r_mask(self, cols, where=None):
+    m = numpy.zeros(cols.n, dtype=bool)
+    for e in self.eq:
+      m |= cols.version == (e.version or -1)
+    return m
+
   def __str__(self):
     return self.__class__.__name__+"("+str(self.eq)+")"
 
@@ -375,6 +568,12 @@ class VersionExcludeRestriction(NodeRestriction):
         return False
     return True
 
+  def r_mask(self, cols, where=None):
+    m = numpy.ones(cols.n, dtype=bool)
+    for e in self.exclude:
+      m &= cols.version != (e.version or -1)
+    return m
+
   def __str__(self):
     return self.__class__.__name__+"("+str(map(str, self.exclude))+")"
 
@@ -389,6 +588,12 @@ class VersionRangeRestriction(NodeRestriction):
     return (not self.gr_eq or router.version >= self.gr_eq) and \
         (not self.less_eq or router.version <= self.less_eq)
 
+  def r_mask(self, cols, where=None):
+    m = numpy.ones(cols.n, dtype=bool)
+    if self.gr_eq: m &= cols.version >= (self.gr_eq.version or -1)
+    if self.less_eq: m &= cols.version <= (self.less_eq.version or -1)
+    return m
+
   def __str__(self):
     return self.__class__.__name__+"("+str(self.gr_eq)+","+str(self.less_eq)+")"
 
@@ -426,6 +631,14 @@ class OrNodeRestriction(MetaNodeRestriction):
         return True
     return False
 
+  def r_mask(self, cols, where=None):
+    m = numpy.zeros(cols.n, dtype=bool)
+    for rs in self.rstrs:
+      todo = ~m
+      if where is not None: todo &= where
+      m |= cols.mask(rs, todo)
+    return m
+
   def __str__(self):
     return self.__class__.__name__+"("+str(map(str, self.rstrs))+")"
 
@@ -436,6 +649,8 @@ class NotNodeRestriction(MetaNodeRestriction):
 
   def r_is_ok(self, r): return not self.a.r_is_ok(r)
 
+  def r_mask(self, cols, where=None): return ~cols.mask(self.a, where)
+
   def __str__(self):
     return self.__class__.__name__+"("+str(self.a)+")"
 
@@ -454,6 +669,12 @@ class AtLeastNNodeRestriction(MetaNodeRestriction):
     if cnt < self.n: return False
     else: return True
 
+  def r_mask(self, cols, where=None):
+    cnt = numpy.zeros(cols.n, dtype=numpy.int64)
+    for rs in self.rstrs:
+      cnt += cols.mask(rs, where)
+    return cnt >= self.n
+
   def __str__(self):
     return self.__class__.__name__+"("+str(map(str, self.rstrs))+","+str(self.n)+")"
 
@@ -469,6 +690,13 @@ class NodeRestrictionList(MetaNodeRestriction):
       if not rs.r_is_ok(r): return False
     return True
 
+  def r_mask(self, cols, where=None):
+    if where is None: m = numpy.ones(cols.n, dtype=bool)
+    else: m = where.copy()
+    for rs in self.restrictions:
+      m &= cols.mask(rs, m)
+    return m
+
   def add_restriction(self, restr):
     "Add a NodeRestriction 'restr' to the list of restrictions"
     self.restrictions.append(restr)
@@ -504,6 +732,11 @@ class Subnet16Restriction(PathRestriction):
         return False
     return True
 
+  def next_is_ok(self, path, r):
+    if not path: return True
+    mask16 = struct.unpack(">I", socket.inet_aton("255.255.0.0"))[0]
+    return (path[0].ip & mask16) != (r.ip & mask16)
+
   def __str__(self):
     return self.__class__.__name__+"()"
 
@@ -516,6 +749,9 @@ class UniqueRestriction(PathRestriction):
         return False
     return True
 
+  def next_is_ok(self, path, r):
+    return r not in path
+
   def __str__(self):
     return self.__class__.__name__+"()"
 
@@ -526,6 +762,8 @@ class CountryCodeRestriction(NodeRestriction):
   def r_is_ok(self, r):
     return r.country_code != None
 
+  def r_mask(self, cols, where=None): return cols.has_country_code
+
   def __str__(self):
     return self.__class__.__name__+"()"
 
@@ -537,6 +775,9 @@ class CountryRestriction(NodeRestriction):
   def r_is_ok(self, r):
     return r.country_code == self.country_code
 
+  def r_mask(self, cols, where=None):
+    return cols.country_code == self.country_code
+
   def __str__(self):
     return self.__class__.__name__+"("+str(self.country_code)+")"
 
@@ -548,6 +789,12 @@ class ExcludeCountriesRestriction(NodeRestriction):
   def r_is_ok(self, r):
     return not (r.country_code in self.countries)
 
+  def r_mask(self, cols, where=None):
+    m = numpy.ones(cols.n, dtype=bool)
+    for c in self.countries:
+      m &= cols.country_code != c
+    return m
+
   def __str__(self):
     return self.__class__.__name__+"("+str(self.countries)+")"
 
@@ -556,22 +803,31 @@ class UniqueCountryRestriction(PathRestriction):
   def path_is_ok(self, path):
     for i in xrange(0, len(path)-1):
       for j in xrange(i+1, len(path)):
-        if path[i].country_code == path[j].country_code:
+        if path[i].country_id == path[j].country_id:
           return False;
     return True;
 
+  def next_is_ok(self, path, r):
+    for p in path:
+      if p.country_id == r.country_id:
+        return False
+    return True
+
   def __str__(self):
     return self.__class__.__name__+"()"
 
 class SingleCountryRestriction(PathRestriction):
   """ Ensure every router to have the same country_code """
   def path_is_ok(self, path):
-    country_code = path[0].country_code
+    country_id = path[0].country_id
     for r in path:
-      if country_code != r.country_code:
+      if country_id != r.country_id:
         return False
     return True
 
+  def next_is_ok(self, path, r):
+    return not path or path[0].country_id == r.country_id
+
   def __str__(self):
     return self.__class__.__name__+"()"
 
@@ -588,12 +844,15 @@ class ContinentRestriction(PathRestriction):
     for r in path:
       # Jump over the first router
       if prev:
-        if r.continent != prev.continent:
+        if r.continent_id != prev.continent_id:
           crossings += 1
       prev = r
     if crossings > self.n: return False
     else: return True
 
+  def next_is_ok(self, path, r):
+    return self.path_is_ok(path+[r])
+
   def __str__(self):
     return self.__class__.__name__+"("+str(self.n)+")"
 
@@ -604,11 +863,14 @@ class ContinentJumperRestriction(PathRestriction):
     for r in path:
       # Jump over the first router
       if prev:
-        if r.continent == prev.continent:
+        if r.continent_id == prev.continent_id:
           return False
       prev = r
     return True
 
+  def next_is_ok(self, path, r):
+    return not path or path[-1].continent_id != r.continent_id
+
   def __str__(self):
     return self.__class__.__name__+"()"
 
@@ -617,10 +879,16 @@ class UniqueContinentRestriction(PathRestriction):
   def path_is_ok(self, path):
     for i in xrange(0, len(path)-1):
       for j in xrange(i+1, len(path)):
-        if path[i].continent == path[j].continent:
+        if path[i].continent_id == path[j].continent_id:
           return False;
     return True;
 
+  def next_is_ok(self, path, r):
+    for p in path:
+      if p.continent_id == r.continent_id:
+        return False
+    return True
+
   def __str__(self):
     return self.__class__.__name__+"()"
 
@@ -643,6 +911,9 @@ class OceanPhobicRestriction(PathRestriction):
     if crossings > self.n: return False
     else: return True
 
+  def next_is_ok(self, path, r):
+    return self.path_is_ok(path+[r])
+
   def __str__(self):
     return self.__class__.__name__+"("+str(self.n)+")"
 
@@ -653,42 +924,86 @@ class UniformGenerator(NodeGenerator):
   def generate(self):
     # XXX: hrmm.. this is not really the right thing to check
     while not self.all_chosen():
-      yield random.choice(self.routers)
+      yield self.routers[random.randrange(self.live)]
      
 class ExactUniformGenerator(NodeGenerator):
   """NodeGenerator that produces nodes randomly, yet strictly uniformly 
-     over time"""
+     over time.
+
+     The remaining routers are kept in buckets keyed by their
+     _generated count for this position, so generate() draws straight
+     from the least-used bucket instead of rescanning every router.
+     The buckets only see updates made through this generator, so
+     generators that share routers need distinct positions, and
+     rebuild() must be called after _generated is changed elsewhere
+     (PathBuilder.reset() does). mark_chosen() must not be called while
+     a generate() iterator is still being consumed."""
   def __init__(self, sorted_r, rstr_list, position=0):
     self.position = position
     NodeGenerator.__init__(self, sorted_r, rstr_list)  
 
+  def _bucket_add(self, r):
+    count = r._generated[self.position]
+    bucket = self._buckets.setdefault(count, [])
+    self._slot[r] = (count, len(bucket))
+    bucket.append(r)
+
+  def _bucket_del(self, r):
+    count, i = self._slot.pop(r)
+    bucket = self._buckets[count]
+    last = bucket.pop()
+    if i < len(bucket):
+      bucket[i] = last
+      self._slot[last] = (count, i)
+    if not bucket:
+      del self._buckets[count]
+
   def generate(self):
-    min_gen = min(map(lambda r: r._generated[self.position], self.routers))
-    choices = filter(lambda r: r._generated[self.position]==min_gen, 
-                       self.routers)
-    while choices:
-      r = random.choice(choices)
+    if not self._buckets: return
+    min_gen = min(self._buckets)
+    choices = self._buckets[min_gen]
+    # Partial Fisher-Yates: the first k entries have already been yielded
+    k = 0
+    while k < len(choices):
+      j = random.randrange(k, len(choices))
+      r = choices[j]
+      choices[j] = choices[k]
+      self._slot[choices[j]] = (min_gen, j)
+      choices[k] = r
+      self._slot[r] = (min_gen, k)
+      k += 1
       yield r
-      choices.remove(r)
 
-    choices = filter(lambda r: r._generated[self.position]==min_gen,
-                       self.routers)
     plog("NOTICE", "Ran out of choices in ExactUniformGenerator. Incrementing nodes")
+    del self._buckets[min_gen]
     for r in choices:
       r._generated[self.position] += 1
+      self._bucket_add(r)
+
+  def rewind(self):
+    NodeGenerator.rewind(self)
+    for r in self._chosen:
+      self._bucket_add(r)
+    self._chosen = []
 
   def mark_chosen(self, r):
-    r._generated[self.position] += 1
     NodeGenerator.mark_chosen(self, r)
+    self._bucket_del(r)
+    r._generated[self.position] += 1
+    self._chosen.append(r)
 
   def rebuild(self, sorted_r=None):
     plog("DEBUG", "Rebuilding ExactUniformGenerator")
     NodeGenerator.rebuild(self, sorted_r)
+    self._buckets = {}
+    self._slot = {}
+    self._chosen = []
     for r in self.rstr_routers:
       lgen = len(r._generated)
       if lgen < self.position+1:
         for i in xrange(lgen, self.position+1):
           r._generated.append(0)
+      self._bucket_add(r)
 
 
 class OrderedExitGenerator(NodeGenerator):
@@ -766,7 +1081,7 @@ class BwWeightedGenerator(NodeGenerator):
     self.total_exit_bw = 0
     self.total_guard_bw = 0
     self.total_bw = 0
-    for r in self.routers:
+    for r in self.remaining():
       # TODO: Check max_bandwidth and cap...
       self.total_bw += r.bw
       if "Exit" in r.flags:
@@ -812,7 +1127,7 @@ class BwWeightedGenerator(NodeGenerator):
           self.guard_weight = ((self.total_guard_bw-bw_per_hop)/self.total_guard_bw)
         else: self.guard_weight = 0
     
-    for r in self.routers:
+    for r in self.remaining():
       bw = r.bw
       if "Exit" in r.flags:
         bw *= self.exit_weight
@@ -831,7 +1146,7 @@ class BwWeightedGenerator(NodeGenerator):
       i = random.randint(0, self.total_weighted_bw)
 
       # Go through the routers
-      for r in self.routers:
+      for r in self.remaining():
         # Below zero here means next() -> choose a new random int+router 
         if i < 0: break
         bw = r.bw
@@ -842,7 +1157,7 @@ class BwWeightedGenerator(NodeGenerator):
 
         i -= bw
         if i < 0:
-          plog("DEBUG", "Chosen router with a bandwidth of: " + str(r.bw))
+          plog("DEBUG", "Chosen router with a bandwidth of: %s", r.bw)
           yield r
 
 ####################### Secret Sauce ###########################
@@ -856,7 +1171,20 @@ class NoRouters(PathError):
 class PathSelector:
   """Implementation of path selection policies. Builds a path according
      to entry, middle, and exit generators that satisfies the path 
-     restrictions."""
+     restrictions.
+
+     Paths are built hop by hop: a candidate the path restrictions
+     rule out for the current prefix (see PathRestriction.next_is_ok)
+     is skipped in place. After 'hop_tries' such draws for one hop, the
+     hop is picked from the generator's remaining routers that the
+     restrictions allow, and only if there are none is the partial
+     path thrown away and started again. If no path is found within
+     'path_draws' draws (such a pick counts as one), or the generators
+     run dry without yielding anything, NoRouters is raised, so that
+     restrictions no path can meet fail instead of looping forever."""
+  hop_tries = 64
+  path_draws = 8192
+
   def __init__(self, entry_gen, mid_gen, exit_gen, path_restrict):
     """Constructor. The first three arguments are NodeGenerators with 
      their appropriate restrictions. The 'path_restrict' is a
@@ -865,6 +1193,53 @@ class PathSelector:
     self.mid_gen = mid_gen
     self.exit_gen = exit_gen
     self.path_restrict = path_restrict
+    self.reset_stats()
+
+  def reset_stats(self):
+    "Reset the path construction counters"
+    self.paths = 0     # Paths returned by select_path
+    self.draws = 0     # Routers drawn from the generators for them
+    self.restarts = 0  # Partial paths abandoned
+    self.rewinds = 0   # Times the generators ran dry
+    self.max_draws = 0 # Most draws spent on a single path
+
+  def draws_per_path(self):
+    "Return the mean number of routers drawn per selected path"
+    if not self.paths: return 0.0
+    return float(self.draws)/self.paths
+
+  def _next_hop(self, node_gen, gen, path):
+    """Draw the next hop for 'path' from the python generator 'gen' of
+       the NodeGenerator 'node_gen', counting the draws in self._draws.
+       If hop_tries candidates are all ruled out, one is picked at random
+       from the routers 'node_gen' has left that the path restrictions
+       allow instead, so that a few suitable routers among many are
+       still found. Returns None if there is none. Raises StopIteration
+       if 'gen' runs dry."""
+    for tries in xrange(self.hop_tries):
+      r = gen.next()
+      self._draws += 1
+      if self.path_restrict.next_is_ok(path, r):
+        return r
+    self._draws += 1
+    candidates = filter(lambda r: r not in path and
+                          self.path_restrict.next_is_ok(path, r),
+                        node_gen.remaining())
+    if not candidates: return None
+    return random.choice(candidates)
+
+  def _hops(self, pathlen):
+    """Rewind the generators and return a (NodeGenerator, python
+       generator) pair for each hop of a path of 'pathlen' hops"""
+    self.entry_gen.rewind()
+    self.mid_gen.rewind()
+    self.exit_gen.rewind()
+    entry = (self.entry_gen, self.entry_gen.generate())
+    mid = (self.mid_gen, self.mid_gen.generate())
+    ext = (self.exit_gen, self.exit_gen.generate())
+    if pathlen == 1:
+      return [ext]
+    return [entry]+[mid]*(pathlen-2)+[ext]
 
   def rebuild_gens(self, sorted_r):
     "Rebuild the 3 generators with a new sorted router list"
@@ -875,27 +1250,27 @@ class PathSelector:
   def select_path(self, pathlen):
     """Creates a path of 'pathlen' hops, and returns it as a list of
        Router instances"""
-    self.entry_gen.rewind()
-    self.mid_gen.rewind()
-    self.exit_gen.rewind()
-    entry = self.entry_gen.generate()
-    mid = self.mid_gen.generate()
-    ext = self.exit_gen.generate()
-      
+    hops = self._hops(pathlen)
     plog("DEBUG", "Selecting path..")
 
+    self._draws = 0
+    rewound_at = None
     while True:
+      if self._draws >= self.path_draws:
+        raise NoRouters("No path of "+str(pathlen)+" hops found in "
+                        +str(self._draws)+" draws")
       path = []
       plog("DEBUG", "Building path..")
       try:
-        if pathlen == 1:
-          path = [ext.next()]
-        else:
-          path.append(entry.next())
-          for i in xrange(1, pathlen-1):
-            path.append(mid.next())
-          path.append(ext.next())
-        if self.path_restrict.path_is_ok(path):
+        for i in xrange(pathlen):
+          r = self._next_hop(hops[i][0], hops[i][1], path)
+          if r is None: break
+          path.append(r)
+        if len(path) < pathlen:
+          self.restarts += 1
+          plog("DEBUG", "No candidate for hop %d. Restarting path.",
+                 len(path)+1)
+        elif self.path_restrict.path_is_ok(path):
           self.entry_gen.mark_chosen(path[0])
           for i in xrange(1, pathlen-1):
             self.mid_gen.mark_chosen(path[i])
@@ -903,18 +1278,23 @@ class PathSelector:
           plog("DEBUG", "Marked path.")
           break
         else:
+          self.restarts += 1
           plog("DEBUG", "Path rejected by path restrictions.")
       except StopIteration:
         plog("NOTICE", "Ran out of routers during buildpath..");
-        self.entry_gen.rewind()
-        self.mid_gen.rewind()
-        self.exit_gen.rewind()
-        entry = self.entry_gen.generate()
-        mid = self.mid_gen.generate()
-        ext = self.exit_gen.generate()
+        if rewound_at == self._draws:
+          raise NoRouters("Generators yield no routers")
+        rewound_at = self._draws
+        self.rewinds += 1
+        hops = self._hops(pathlen)
+    self.paths += 1
+    self.draws += self._draws
+    self.max_draws = max(self.max_draws, self._draws)
+    plog("DEBUG", "Selected path after %d draws (%.2f per path on average)",
+           self._draws, self.draws_per_path())
     for r in path:
       r.refcount += 1
-      plog("DEBUG", "Circ refcount "+str(r.refcount)+" for "+r.idhex)
+      plog("DEBUG", "Circ refcount %d for %s", r.refcount, r.idhex)
     return path
 
 # TODO: Implement example manager.
@@ -1133,14 +1513,14 @@ class SelectionManager(BaseSelectionManager):
         exitgen = self.__ordered_exit_gen = \
           OrderedExitGenerator(80, sorted_r, self.exit_rstr)
     elif self.uniform:
-      exitgen = ExactUniformGenerator(sorted_r, self.exit_rstr)
+      exitgen = ExactUniformGenerator(sorted_r, self.exit_rstr, position=2)
     else:
       exitgen = BwWeightedGenerator(sorted_r, self.exit_rstr, self.pathlen, exit=True)
 
     if self.uniform:
       self.path_selector = PathSelector(
-         ExactUniformGenerator(sorted_r, entry_rstr),
-         ExactUniformGenerator(sorted_r, mid_rstr),
+         ExactUniformGenerator(sorted_r, entry_rstr, position=0),
+         ExactUniformGenerator(sorted_r, mid_rstr, position=1),
          exitgen, self.path_rstr)
     else:
       # Remove ConserveExitsRestriction for entry and middle positions
@@ -1389,11 +1769,12 @@ class PathBuilder(TorCtl.ConsensusTracker):
   of the EventHandler.
   """
   def __init__(self, c, selmgr, RouterClass=TorCtl.Router,
-               strm_selector=StreamSelector):
+               strm_selector=StreamSelector, snapshot_file=None):
     """Constructor. 'c' is a Connection, 'selmgr' is a SelectionManager,
     and 'RouterClass' is a class that inherits from Router and is used
-    to create annotated Routers."""
-    TorCtl.ConsensusTracker.__init__(self, c, RouterClass)
+    to create annotated Routers. 'snapshot_file' is passed on to
+    ConsensusTracker."""
+    TorCtl.ConsensusTracker.__init__(self, c, RouterClass, snapshot_file)
     self.last_exit = None
     self.new_nym = False
     self.resolve_port = 0
@@ -1433,6 +1814,9 @@ class PathBuilder(TorCtl.ConsensusTracker):
     for r in self.routers.itervalues():
       for g in xrange(0, len(r._generated)):
         r._generated[g] = 0
+    # The generators bucket routers by these counts
+    path_selector = getattr(self.selmgr, "path_selector", None)
+    if path_selector: path_selector.rebuild_gens(None)
 
   def is_urgent_event(event):
     # If event is stream:NEW*/DETACHED or circ BUILT/FAILED, 
@@ -1582,8 +1966,8 @@ class PathBuilder(TorCtl.ConsensusTracker):
           plog("WARN", "Error closing stream: "+str(e))
         return
       for u in unattached_streams:
-        plog("DEBUG",
-           "Attaching "+str(u.strm_id)+" pending build of "+str(circ.circ_id))
+        plog("DEBUG", "Attaching %s pending build of %s", u.strm_id,
+           circ.circ_id)
         u.pending_circ = circ
       circ.pending_streams.extend(unattached_streams)
       self.circuits[circ.circ_id] = circ
@@ -1591,15 +1975,16 @@ class PathBuilder(TorCtl.ConsensusTracker):
     plog("DEBUG", "Set last exit to "+self.last_exit.idhex)
 
   def circ_status_event(self, c):
-    output = [str(time.time()-c.arrived_at), c.event_name, str(c.circ_id),
-              c.status]
-    if c.path: output.append(",".join(c.path))
-    if c.reason: output.append("REASON=" + c.reason)
-    if c.remote_reason: output.append("REMOTE_REASON=" + c.remote_reason)
-    plog("DEBUG", " ".join(output))
+    if plog_enabled("DEBUG"):
+      output = [str(time.time()-c.arrived_at), c.event_name, str(c.circ_id),
+                c.status]
+      if c.path: output.append(",".join(c.path))
+      if c.reason: output.append("REASON=" + c.reason)
+      if c.remote_reason: output.append("REMOTE_REASON=" + c.remote_reason)
+      plog("DEBUG", " ".join(output))
     # Circuits we don't control get built by Tor
     if c.circ_id not in self.circuits:
-      plog("DEBUG", "Ignoring circ " + str(c.circ_id))
+      plog("DEBUG", "Ignoring circ %s", c.circ_id)
       return
     if c.status == "EXTENDED":
       self.circuits[c.circ_id].last_extended_at = c.arrived_at
@@ -1608,7 +1993,7 @@ class PathBuilder(TorCtl.ConsensusTracker):
       circ = self.circuits[c.circ_id]
       for r in circ.path:
         r.refcount -= 1
-        plog("DEBUG", "Close refcount "+str(r.refcount)+" for "+r.idhex)
+        plog("DEBUG", "Close refcount %d for %s", r.refcount, r.idhex)
         if r.deleted and r.refcount == 0:
           # XXX: This shouldn't happen with StatsRouters.. 
           if r.__class__.__name__ == "StatsRouter":
@@ -1621,7 +2006,7 @@ class PathBuilder(TorCtl.ConsensusTracker):
       for stream in circ.pending_streams:
         # If it was built, let Tor decide to detach or fail the stream
         if not circ.built:
-          plog("DEBUG", "Finding new circ for " + str(stream.strm_id))
+          plog("DEBUG", "Finding new circ for %s", stream.strm_id)
           self.attach_stream_any(stream, stream.detached_from)
         else:
           plog("NOTICE", "Waiting on Tor to hint about stream "+str(stream.strm_id)+" on closed circ "+str(circ.circ_id))
@@ -1637,26 +2022,28 @@ class PathBuilder(TorCtl.ConsensusTracker):
         return
 
   def stream_status_event(self, s):
-    output = [str(time.time()-s.arrived_at), s.event_name, str(s.strm_id),
-              s.status, str(s.circ_id),
-          s.target_host, str(s.target_port)]
-    if s.reason: output.append("REASON=" + s.reason)
-    if s.remote_reason: output.append("REMOTE_REASON=" + s.remote_reason)
-    if s.purpose: output.append("PURPOSE=" + s.purpose)
-    if s.source_addr: output.append("SOURCE_ADDR="+s.source_addr)
+    debug = plog_enabled("DEBUG")
+    if debug:
+      output = [str(time.time()-s.arrived_at), s.event_name, str(s.strm_id),
+                s.status, str(s.circ_id),
+            s.target_host, str(s.target_port)]
+      if s.reason: output.append("REASON=" + s.reason)
+      if s.remote_reason: output.append("REMOTE_REASON=" + s.remote_reason)
+      if s.purpose: output.append("PURPOSE=" + s.purpose)
+      if s.source_addr: output.append("SOURCE_ADDR="+s.source_addr)
     if not re.match(r"\d+.\d+.\d+.\d+", s.target_host):
       s.target_host = "255.255.255.255" # ignore DNS for exit policy check
 
     # Hack to ignore Tor-handled streams
     if s.strm_id in self.streams and self.streams[s.strm_id].ignored:
       if s.status == "CLOSED":
-        plog("DEBUG", "Deleting ignored stream: " + str(s.strm_id))
+        plog("DEBUG", "Deleting ignored stream: %s", s.strm_id)
         del self.streams[s.strm_id]
       else:
-        plog("DEBUG", "Ignoring stream: " + str(s.strm_id))
+        plog("DEBUG", "Ignoring stream: %s", s.strm_id)
       return
 
-    plog("DEBUG", " ".join(output))
+    if debug: plog("DEBUG", " ".join(output))
     # XXX: Copy s.circ_id==0 check+reset from StatsSupport here too?
 
     if s.status == "NEW" or s.status == "NEWRESOLVE":
@@ -1668,7 +2055,7 @@ class PathBuilder(TorCtl.ConsensusTracker):
 
       if s.purpose and s.purpose.find("DIR_") == 0:
         self.streams[s.strm_id].ignored = True
-        plog("DEBUG", "Ignoring stream: " + str(s.strm_id))
+        plog("DEBUG", "Ignoring stream: %s", s.strm_id)
         return
       elif s.source_addr:
         src_addr = s.source_addr.split(":")
@@ -1774,7 +2161,17 @@ class PathBuilder(TorCtl.ConsensusTracker):
       self.streams[s.strm_id].bytes_written += s.bytes_written
 
   def new_consensus_event(self, n):
+    geoip_config = getattr(self.selmgr, "geoip_config", None)
+    if geoip_config:
+      import GeoIPSupport
+      # Before the new routers are built, so that lookups made for them
+      # are kept for annotate_routers()
+      GeoIPSupport.forget_countries()
     TorCtl.ConsensusTracker.new_consensus_event(self, n)
+    if geoip_config:
+      # One GeoIP lookup per distinct IP for the new consensus, rather
+      # than one per router promotion
+      GeoIPSupport.annotate_routers(self.sorted_r)
     self.selmgr.new_consensus(self.current_consensus())
 
   def new_desc_event(self, d):
@@ -1842,8 +2239,7 @@ class CircuitHandler(PathBuilder):
     
     # Circuits we don't control get built by Tor
     if c.circ_id not in self.circuits:
-      plog("DEBUG", "Ignoring circuit " + str(c.circ_id) + 
-         " (controlled by Tor)")
+      plog("DEBUG", "Ignoring circuit %s (controlled by Tor)", c.circ_id)
       return
     
     # EXTENDED
@@ -0,0 +1,180 @@
+#!/usr/bin/python
+"""
+ReplaySupport -- Feed captured control port traffic back through TorCtl
+event handlers without a running Tor, e.g. to measure event decoding
+throughput.
+
+Recordings are written by TorCtl.Connection.record() and played back
+with ReplayConnection.
+"""
+
+import sys
+import time
+import TorCtl
+from TorUtil import plog
+
+class ReplaySocket:
+  """Read-only stand-in for the control port socket that returns the
+     bytes of 'data' and then end of file."""
+  def __init__(self, data):
+    self._data = data
+    self._pos = 0
+
+  def recv(self, n):
+    ret = self._data[self._pos:self._pos+n]
+    self._pos += len(ret)
+    return ret
+
+  def send(self, s): pass
+
+  def close(self): pass
+
+def read_replies(data):
+  """Split raw control port output 'data' into the (isEvent, lines)
+     replies that Connection._read_reply() would produce."""
+  c = TorCtl.Connection(ReplaySocket(data))
+  replies = []
+  while 1:
+    try:
+      replies.append(c._read_reply())
+    except TorCtl.TorCtlClosed:
+      return replies
+
+def bench_events(handler, replies, rounds=1):
+  """Run the event replies in 'replies' through 'handler' 'rounds' times
+     and return the number of events handled per second."""
+  events = filter(lambda r: r[0], replies)
+  nevents = sum(map(lambda r: len(r[1]), events))*rounds
+  start = time.time()
+  for i in xrange(rounds):
+    for isEvent, lines in events:
+      handler._handle1(start, lines)
+  elapsed = time.time() - start
+  if not elapsed: return 0.0
+  return nevents/elapsed
+
+class RecordedLines:
+  """Stand-in for the BufSock of a Connection that returns the received
+     lines of a recording. 'when' is the recorded time of the line last
+     returned."""
+  def __init__(self, lines):
+    self._lines = lines
+    self._pos = 0
+    self.when = 0
+
+  def readline(self):
+    if self._pos >= len(self._lines):
+      return None
+    (self.when, line) = self._lines[self._pos]
+    self._pos += 1
+    return line
+
+  def write(self, s): pass
+
+  def close(self): pass
+
+def load_recording(f):
+  """Read a recording made by Connection.record() from the file object
+     'f'. Returns a list of (when, isEvent, lines) replies, where 'when'
+     is the time in seconds since the start of the recording at which
+     the reply was complete. Malformed lines, such as one cut off by a
+     crash while it was written, are skipped."""
+  received = []
+  base = None
+  offset = 0.0
+  for line in f:
+    if line.startswith("#TORCTL-RECORDING "):
+      # Recordings of later sessions may be appended to the same file
+      start = float(line.split()[1])
+      if base is None: base = start
+      offset = start - base
+      continue
+    i = 0
+    while i < len(line) and line[i].isdigit(): i += 1
+    if not i or i == len(line) or line[i] not in "<>" \
+       or not line.endswith("\n"):
+      plog("NOTICE", "Skipping malformed recording line %r", line)
+      continue
+    if line[i] == "<":
+      received.append((offset + int(line[:i])/1000.0, line[i+1:]))
+  c = TorCtl.Connection(None)
+  c._s = RecordedLines(received)
+  replies = []
+  while 1:
+    try:
+      (isEvent, lines) = c._read_reply()
+    except TorCtl.TorCtlClosed:
+      return replies
+    replies.append((c._s.when, isEvent, lines))
+
+class ReplayConnection(TorCtl.Connection):
+  """Connection stand-in that plays a recording back to its event
+     handler. Everything runs in the thread that calls replay(), so a
+     replay is deterministic. Commands the handler sends are kept in
+     'sent' and answered with the recorded command replies in order,
+     or with a plain 250 OK once those run out. Timers set with
+     set_timer() are not run."""
+  def __init__(self, replies):
+    """Takes the replies returned by load_recording()."""
+    TorCtl.Connection.__init__(self, None)
+    self.replies = replies
+    self._answers = map(lambda r: r[2], filter(lambda r: not r[1], replies))
+    self.sent = []
+
+  def _answer(self, msg):
+    self.sent.append(msg)
+    if self._answers:
+      return self._answers.pop(0)
+    return [("250", "OK", None)]
+
+  def _sendImpl(self, sendFn, msg):
+    return self._answer(msg)
+
+  def _sendManyImpl(self, sendFn, msgs):
+    return map(self._answer, msgs)
+
+  def replay(self, speed=None):
+    """Deliver the recorded events to the event handler. With 'speed'
+       given, events are spaced out like in the recording (2.0 plays
+       twice as fast); otherwise they are delivered as fast as possible.
+       Events are stamped with the replay start time plus their recorded
+       offset. Returns (events, seconds) for the replay."""
+    start = time.time()
+    events = 0
+    for (when, isEvent, lines) in self.replies:
+      if not isEvent: continue
+      if lines[0][0] == "650" and lines[0][1] == "OK":
+        continue # Ignored by Connection._eventLoop() too
+      if speed:
+        delay = start + when/speed - time.time()
+        if delay > 0: time.sleep(delay)
+      if self._handleFn:
+        self._handleFn(start + when, lines)
+      events += len(lines)
+    return (events, time.time() - start)
+
+class _DecodeAllHandler(TorCtl.EventHandler):
+  "Handler that wants every event, so that all of them get decoded"
+  def heartbeat_event(self, event): pass
+
+def main(argv):
+  if len(argv) < 2:
+    print "Syntax: ReplaySupport.py <recording or control port capture> [rounds]"
+    return 1
+  f = open(argv[1], "rb")
+  if f.readline().startswith("#TORCTL-RECORDING "):
+    f.seek(0)
+    replies = map(lambda r: r[1:], load_recording(f))
+  else:
+    f.seek(0)
+    replies = read_replies(f.read())
+  if len(argv) > 2: rounds = int(argv[2])
+  else: rounds = 10
+  print "Decoding all events: %.0f events/sec" % \
+          bench_events(_DecodeAllHandler(), replies, rounds)
+  print "Nothing subscribed: %.0f events/sec" % \
+          bench_events(TorCtl.EventHandler(), replies, rounds)
+  return 0
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv))
@@ -13,6 +13,10 @@ import sys
 import time
 import datetime
 import math
+import copy
+import threading
+import traceback
+import Queue
 
 import PathSupport, TorCtl
 from TorUtil import *
@@ -21,11 +25,12 @@ from TorUtil import meta_port, meta_host, control_port, control_host, control_pa
 from TorCtl import EVENT_TYPE, EVENT_STATE, TorCtlError
 
 import sqlalchemy
+import sqlalchemy.exc
 import sqlalchemy.orm.exc
 from sqlalchemy.orm import scoped_session, sessionmaker, eagerload, lazyload, eagerload_all
 from sqlalchemy import create_engine, and_, or_, not_, func
-from sqlalchemy.sql import func,select
-from sqlalchemy.schema import ThreadLocalMetaData,MetaData
+from sqlalchemy.sql import func,select,bindparam
+from sqlalchemy.schema import ThreadLocalMetaData,MetaData,Index
 from elixir import *
 
 # Nodes with a ratio below this value will be removed from consideration
@@ -34,12 +39,23 @@ MIN_RATIO=0.5
 
 NO_FPE=2**-50
 
+# The listeners' SQL work is queued to a SQLWriter thread and committed
+# in groups of this many events, or after this many seconds.
+SQL_COMMIT_BATCH=500
+SQL_COMMIT_INTERVAL=1.0
+# Events that may be waiting for the SQLWriter before the event thread
+# blocks.
+SQL_QUEUE_SIZE=10000
+# Routers looked up per select, below SQLite's limit on query parameters.
+SQL_IN_CHUNK=500
+
 #################### Model #######################
 
 # In elixir, the session (DB connection) is a property of the model..
 # There can only be one for all of the listeners below that use it
 # See http://elixir.ematia.de/trac/wiki/Recipes/MultipleDatabases
 OP=None
+sql_writer=None
 tc_metadata = MetaData()
 tc_metadata.echo=True
 tc_session = scoped_session(sessionmaker(autoflush=True))
@@ -50,8 +66,29 @@ def setup_db(db_uri, echo=False, drop=False):
   tc_metadata.echo = echo
 
   setup_all()
+  # Rank history is appended and read per router, in time order
+  rank_index = filter(lambda i: i.name == "ix_bwhistory_router_pub",
+                      BwHistory.table.indexes)
+  if rank_index:
+    rank_index = rank_index[0]
+  else:
+    rank_index = Index("ix_bwhistory_router_pub",
+                       BwHistory.table.c.router_idhex,
+                       BwHistory.table.c.pub_time)
   if drop: drop_all()
+  had_history = BwHistory.table.exists()
   create_all()
+  if had_history:
+    # create_all() only indexes the tables it creates
+    try:
+      rank_index.create()
+    except sqlalchemy.exc.SQLAlchemyError:
+      pass # Already there
+
+  global sql_writer
+  if not sql_writer:
+    sql_writer = SQLWriter()
+    sql_writer.start()
 
   if sqlalchemy.__version__ < "0.5.0":
     # DIAF SQLAlchemy. A token gesture at backwards compatibility
@@ -246,49 +283,6 @@ class RouterStats(Entity):
   filt_sbw = Field(Float)
   filt_sbw_ratio = Field(Float)
 
-  def _compute_stats_relation(stats_clause):
-    for rs in RouterStats.query.\
-                   filter(stats_clause).\
-                   options(eagerload_all('router.circuits.extensions')).\
-                   all():
-      rs.circ_fail_to = 0
-      rs.circ_try_to = 0
-      rs.circ_fail_from = 0
-      rs.circ_try_from = 0
-      tot_extend_time = 0
-      tot_extends = 0
-      for c in rs.router.circuits: 
-        for e in c.extensions: 
-          if e.to_node == r:
-            rs.circ_try_to += 1
-            if isinstance(e, FailedExtension):
-              rs.circ_fail_to += 1
-            elif e.hop == 0:
-              tot_extend_time += e.delta
-              tot_extends += 1
-          elif e.from_node == r:
-            rs.circ_try_from += 1
-            if isinstance(e, FailedExtension):
-              rs.circ_fail_from += 1
-            
-        if isinstance(c, FailedCircuit):
-          pass # TODO: Also count timeouts against earlier nodes?
-        elif isinstance(c, DestroyedCircuit):
-          pass # TODO: Count these somehow..
-
-      if tot_extends > 0: rs.avg_first_ext = (1.0*tot_extend_time)/tot_extends
-      else: rs.avg_first_ext = 0
-      if rs.circ_try_from > 0:
-        rs.circ_from_rate = (1.0*rs.circ_fail_from/rs.circ_try_from)
-      if rs.circ_try_to > 0:
-        rs.circ_to_rate = (1.0*rs.circ_fail_to/rs.circ_try_to)
-      if rs.circ_try_to+rs.circ_try_from > 0:
-        rs.circ_bi_rate = (1.0*rs.circ_fail_to+rs.circ_fail_from)/(rs.circ_try_to+rs.circ_try_from)
-
-      tc_session.add(rs)
-    tc_session.commit()
-  _compute_stats_relation = Callable(_compute_stats_relation)
-
   def _compute_stats_query(stats_clause):
     tc_session.clear()
     # http://www.sqlalchemy.org/docs/04/sqlexpression.html#sql_update
@@ -330,42 +324,39 @@ class RouterStats(Entity):
       (RouterStats.table.c.circ_try_to+RouterStats.table.c.circ_try_from)}).execute()
 
 
-    # TODO: Give the streams relation table a sane name and reduce this too
-    for rs in RouterStats.query.filter(stats_clause).\
-                        options(eagerload('router'),
-                                eagerload('router.detached_streams'),
-                                eagerload('router.streams')).all():
-      tot_bw = 0.0
-      s_cnt = 0
-      tot_bytes = 0.0
-      tot_duration = 0.0
-      for s in rs.router.streams:
-        if isinstance(s, ClosedStream):
-          tot_bytes += s.tot_bytes()
-          tot_duration += s.end_time - s.start_time
-          tot_bw += s.bandwidth()
-          s_cnt += 1
-      # FIXME: Hrmm.. do we want to do weighted avg or pure avg here?
-      # If files are all the same size, it shouldn't matter..
-      if s_cnt > 0:
-        rs.sbw = tot_bw/s_cnt
-      else: rs.sbw = None
-      rs.strm_closed = s_cnt
-      rs.strm_try = len(rs.router.streams)+len(rs.router.detached_streams)
-      if rs.sbw:
-        tot_var = 0.0
-        for s in rs.router.streams:
-          if isinstance(s, ClosedStream):
-            tot_var += (s.bandwidth()-rs.sbw)*(s.bandwidth()-rs.sbw)
-        tot_var /= s_cnt
-        rs.sbw_dev = math.sqrt(tot_var)
-      tc_session.add(rs)
+    # Stream stats. ClosedStream.bandwidth() is read_bandwidth.
+    # FIXME: Hrmm.. do we want to do weighted avg or pure avg here?
+    # If files are all the same size, it shouldn't matter..
+    strm_s = select([func.count()], _router_streams(Router.streams))\
+                 .as_scalar()
+    dstrm_s = select([func.count()],
+                 _router_streams(Router.detached_streams)).as_scalar()
+    closed_s = select([func.count()], _router_closed_streams()).as_scalar()
+    sbw_s = select([func.avg(ClosedStream.table.c.read_bandwidth)],
+                 _router_closed_streams()).as_scalar()
+
+    RouterStats.table.update(stats_clause, values=
+      {RouterStats.table.c.strm_try:strm_s+dstrm_s,
+       RouterStats.table.c.strm_closed:closed_s,
+       RouterStats.table.c.sbw:sbw_s}).execute()
+
+    # SQLite has no sqrt(), so only the variance is computed in SQL
+    bw_dev = ClosedStream.table.c.read_bandwidth-RouterStats.table.c.sbw
+    var_s = select([func.avg(bw_dev*bw_dev)],
+                 _router_closed_streams()).as_scalar()
+    devs = []
+    for (rs_id, var) in select([RouterStats.table.c.id, var_s],
+               and_(stats_clause, RouterStats.table.c.sbw != 0)).execute():
+      if var is not None:
+        devs.append({'rs_id':rs_id, 'dev':math.sqrt(var)})
+    if devs:
+      RouterStats.table.update(RouterStats.table.c.id == bindparam('rs_id'),
+        values={RouterStats.table.c.sbw_dev:bindparam('dev')}).execute(devs)
     tc_session.commit()
   _compute_stats_query = Callable(_compute_stats_query)
 
   def _compute_stats(stats_clause):
     RouterStats._compute_stats_query(stats_clause)
-    #RouterStats._compute_stats_relation(stats_clause)
   _compute_stats = Callable(_compute_stats)
 
   def _compute_ranks():
@@ -430,41 +421,29 @@ class RouterStats(Entity):
   _compute_ratios = Callable(_compute_ratios)
 
   def _compute_filtered_relational(min_ratio, stats_clause, filter_clause):
-    badrouters = RouterStats.query.filter(stats_clause).filter(filter_clause).\
-                   filter(RouterStats.sbw_ratio < min_ratio).all()
-
-    # TODO: Turn this into a single query....
-    for rs in RouterStats.query.filter(stats_clause).\
-          options(eagerload_all('router.streams.circuit.routers')).all():
-      tot_sbw = 0
-      sbw_cnt = 0
-      for s in rs.router.streams:
-        if isinstance(s, ClosedStream):
-          skip = False
-          #for br in badrouters:
-          #  if br != rs:
-          #    if br.router in s.circuit.routers:
-          #      skip = True
-          if not skip:
-            # Throw out outliers < mean 
-            # (too much variance for stddev to filter much)
-            if rs.strm_closed == 1 or s.bandwidth() >= rs.sbw:
-              tot_sbw += s.bandwidth()
-              sbw_cnt += 1
-
-      if sbw_cnt: rs.filt_sbw = tot_sbw/sbw_cnt
-      else: rs.filt_sbw = None
-      tc_session.add(rs)
+    tc_session.clear()
+    # TODO: Also skip streams whose circuits used routers with a
+    # sbw_ratio below min_ratio (filter_clause)?
+    # Throw out outliers < mean 
+    # (too much variance for stddev to filter much)
+    filt_s = select([func.avg(ClosedStream.table.c.read_bandwidth)],
+        and_(_router_closed_streams(),
+             or_(RouterStats.table.c.strm_closed == 1,
+                 ClosedStream.table.c.read_bandwidth
+                   >= RouterStats.table.c.sbw))).as_scalar()
+    RouterStats.table.update(stats_clause, values=
+      {RouterStats.table.c.filt_sbw:filt_s}).execute()
+
     if sqlalchemy.__version__ < "0.5.0":
       avg_sbw = RouterStats.query.filter(stats_clause).avg(RouterStats.filt_sbw)
     else:
       avg_sbw = tc_session.query(func.avg(RouterStats.filt_sbw)).filter(stats_clause).scalar()
-    for rs in RouterStats.query.filter(stats_clause).all():
-      if type(rs.filt_sbw) == float and avg_sbw:
-        rs.filt_sbw_ratio = rs.filt_sbw/avg_sbw
-      else:
-        rs.filt_sbw_ratio = None
-      tc_session.add(rs)
+    if avg_sbw:
+      ratio = RouterStats.table.c.filt_sbw/avg_sbw
+    else:
+      ratio = None
+    RouterStats.table.update(stats_clause, values=
+      {RouterStats.table.c.filt_sbw_ratio:ratio}).execute()
     tc_session.commit()
   _compute_filtered_relational = Callable(_compute_filtered_relational)
 
@@ -478,11 +457,9 @@ class RouterStats(Entity):
     tc_session.clear()
     RouterStats.table.drop()
     RouterStats.table.create()
-    for r in Router.query.all():
-      rs = RouterStats()
-      rs.router = r
-      r.stats = rs
-      tc_session.add(r)
+    rows = map(lambda r: {'router_idhex':r[0]},
+               select([Router.table.c.idhex]).execute())
+    if rows: RouterStats.table.insert().execute(rows)
     tc_session.commit()
   reset = Callable(reset)
 
@@ -625,19 +602,14 @@ class RouterStats(Entity):
 #################### Model Support ################
 def reset_all():
   # Need to keep routers around.. 
-  for r in Router.query.all():
-    # This appears to be needed. the relation tables do not get dropped 
-    # automatically.
-    r.circuits = []
-    r.streams = []
-    r.detached_streams = []
-    r.bw_history = [] 
-    r.stats = None
-    tc_session.add(r)
-
   tc_session.commit()
   tc_session.clear()
 
+  # This appears to be needed. the relation tables do not get dropped 
+  # automatically. bw_history and stats live in tables dropped below.
+  for relation in (Router.circuits, Router.streams, Router.detached_streams):
+    relation.property.secondary.delete().execute()
+
   BwHistory.table.drop() # Will drop subclasses
   Extension.table.drop()
   Stream.table.drop() 
@@ -658,8 +630,120 @@ def reset_all():
 
   plog("NOTICE", "Reset all SQL stats")
 
+def _router_streams(relation):
+  """Correlated where clause over the rows of the Router.streams-like
+     many-to-many 'relation' for the router of a RouterStats row"""
+  return and_(Router.table.c.idhex == RouterStats.table.c.router_idhex,
+              relation.property.primaryjoin)
+
+def _router_closed_streams():
+  """Correlated where clause over the ClosedStreams of the router of a 
+     RouterStats row"""
+  return and_(_router_streams(Router.streams),
+              Router.streams.property.secondaryjoin,
+              Stream.table.c.row_type == 'closedstream')
+
 ##################### End Model Support ####################
 
+class SQLWriter(threading.Thread):
+  """Dedicated thread that does the SQL work of the listeners below, so
+  that event handling never waits on the database. The listeners pull
+  whatever they need out of their parent handler on the event thread and
+  schedule() a job that does the queries and inserts here. Jobs run in
+  order and are committed in groups of up to 'batch' jobs or every
+  'interval' seconds, whichever comes first. The queue is bounded, so
+  if the database falls too far behind, schedule() blocks the event
+  thread instead of eating all memory.
+
+  Everything else that touches tc_session while the listeners are
+  attached (stats computation, reset_all()) should go through call(),
+  which runs it on this thread after committing what is queued ahead
+  of it."""
+  def __init__(self, maxsize=SQL_QUEUE_SIZE, batch=SQL_COMMIT_BATCH,
+               interval=SQL_COMMIT_INTERVAL):
+    threading.Thread.__init__(self, name="SQLWriter")
+    self.setDaemon(True)
+    self.jobs = Queue.Queue(maxsize)
+    self.batch = batch
+    self.interval = interval
+    self.pending = 0
+
+  def schedule(self, job):
+    "Queue the callable 'job' to run on the writer thread"
+    self.jobs.put(job)
+
+  def call(self, fn):
+    """Run 'fn' on the writer thread once everything queued before it
+       has been committed, commit again, and return its result (or raise
+       its exception)."""
+    if threading.currentThread() is self:
+      self._commit()
+      ret = fn()
+      self._commit()
+      return ret
+    done = threading.Event()
+    result = []
+    def job():
+      try:
+        self._commit()
+        result.append((fn(), None))
+        self._commit()
+      except Exception, e:
+        result.append((None, e))
+      done.set()
+    self.schedule(job)
+    done.wait()
+    ret, e = result[0]
+    if e: raise e
+    return ret
+
+  def sync(self):
+    "Block until everything scheduled so far has been committed"
+    self.call(lambda: None)
+
+  def _commit(self):
+    if not self.pending: return
+    try:
+      tc_session.commit()
+    except Exception, e:
+      plog("ERROR", "SQL group commit of "+str(self.pending)
+                    +" events failed: "+str(e))
+      traceback.print_exc()
+      tc_session.rollback()
+    self.pending = 0
+    self.last_commit = time.time()
+
+  def run(self):
+    self.last_commit = time.time()
+    while True:
+      if self.pending:
+        timeout = max(0, self.interval-(time.time()-self.last_commit))
+      else:
+        timeout = None
+      try:
+        job = self.jobs.get(True, timeout)
+      except Queue.Empty:
+        self._commit()
+        continue
+      try:
+        job()
+      except Exception, e:
+        plog("ERROR", "Exception in SQL job: "+str(e))
+        traceback.print_exc()
+        # The session can't be used until it is rolled back, which also
+        # drops the uncommitted work of the jobs before this one
+        if self.pending:
+          plog("WARN", "Discarding "+str(self.pending)
+                       +" uncommitted SQL events")
+        tc_session.rollback()
+        self.pending = 0
+        self.last_commit = time.time()
+        continue
+      self.pending += 1
+      if self.pending >= self.batch or \
+         time.time()-self.last_commit >= self.interval:
+        self._commit()
+
 class ConsensusTrackerListener(TorCtl.DualEventListener):
   def __init__(self):
     TorCtl.DualEventListener.__init__(self)
@@ -671,41 +755,62 @@ class ConsensusTrackerListener(TorCtl.DualEventListener):
 
   # TODO: What about non-running routers and uptime information?
   def _update_rank_history(self, idlist):
-    plog("INFO", "Consensus change... Updating rank history")
+    # Snapshot the rank info here. The consensus keeps changing under
+    # the writer thread.
+    ranks = []
     for idhex in idlist:
       if idhex not in self.consensus.routers: continue
       rc = self.consensus.routers[idhex]
       if rc.down: continue
-      try:
-        r = Router.query.options(eagerload('bw_history')).filter_by(
-                                    idhex=idhex).with_labels().one()
-        bwh = BwHistory(router=r, rank=rc.list_rank, bw=rc.bw,
-                        desc_bw=rc.desc_bw, pub_time=r.published)
-        r.bw_history.append(bwh)
-        #tc_session.add(bwh)
-        tc_session.add(r)
-      except sqlalchemy.orm.exc.NoResultFound:
+      ranks.append((idhex, rc.list_rank, rc.bw, rc.desc_bw))
+    sql_writer.schedule(lambda: self._write_rank_history(ranks))
+
+  def _write_rank_history(self, ranks):
+    plog("INFO", "Consensus change... Updating rank history")
+    # A few selects for the ranked routers' publication times and one
+    # executemany per consensus. The existing history is never loaded.
+    tc_session.flush()
+    published = {}
+    idhexes = [r[0] for r in ranks]
+    for i in xrange(0, len(idhexes), SQL_IN_CHUNK):
+      result = tc_session.execute(
+                 select([Router.table.c.idhex, Router.table.c.published],
+                  Router.table.c.idhex.in_(idhexes[i:i+SQL_IN_CHUNK])))
+      published.update(dict((row[0], row[1]) for row in result.fetchall()))
+    rows = []
+    for (idhex, rank, bw, desc_bw) in ranks:
+      if idhex not in published:
         plog("WARN", "No descriptor found for consenus router "+str(idhex))
+        continue
+      rows.append({'router_idhex':idhex, 'rank':rank, 'bw':bw,
+                   'desc_bw':desc_bw, 'pub_time':published[idhex]})
+    if rows: tc_session.execute(BwHistory.table.insert(), rows)
 
     plog("INFO", "Consensus history updated.")
-    tc_session.commit()
 
   def _update_db(self, idlist):
     # FIXME: It is tempting to delay this as well, but we need
     # this info to be present immediately for circuit construction...
-    plog("INFO", "Consensus change... Updating db")
+    # It is queued ahead of the circuit events that refer to it, so the
+    # writer thread still stores it before they need it.
+    routers = []
     for idhex in idlist:
       if idhex in self.consensus.routers:
-        rc = self.consensus.routers[idhex]
-        r = Router.query.filter_by(idhex=rc.idhex).first()
-        if r and r.orhash == rc.orhash:
-          # We already have it stored. (Possible spurious NEWDESC)
-          continue
-        if not r: r = Router()
-        r.from_router(rc)
-        tc_session.add(r)
+        # Copy: ConsensusTracker updates reused routers in place.
+        routers.append(copy.copy(self.consensus.routers[idhex]))
+    sql_writer.schedule(lambda: self._write_routers(routers))
+
+  def _write_routers(self, routers):
+    plog("INFO", "Consensus change... Updating db")
+    for rc in routers:
+      r = Router.query.filter_by(idhex=rc.idhex).first()
+      if r and r.orhash == rc.orhash:
+        # We already have it stored. (Possible spurious NEWDESC)
+        continue
+      if not r: r = Router()
+      r.from_router(rc)
+      tc_session.add(r)
     plog("INFO", "Consensus db updated")
-    tc_session.commit()
 
   def update_consensus(self):
     plog("INFO", "Updating DB with full consensus.")
@@ -717,37 +822,27 @@ class ConsensusTrackerListener(TorCtl.DualEventListener):
       raise TorCtlError("ConsensusTrackerListener can only be attached to ConsensusTracker instances")
     TorCtl.DualEventListener.set_parent(self, parent_handler)
 
+  def _load_op(self):
+    global OP
+    OP = Router.query.filter_by(
+             idhex="0000000000000000000000000000000000000000").first()
+    if not OP:
+      OP = Router(idhex="0000000000000000000000000000000000000000",
+                orhash="000000000000000000000000000",
+                nickname="!!TorClient",
+                published=datetime.datetime.utcnow())
+      tc_session.add(OP)
+
   def heartbeat_event(self, e):
     # This sketchiness is to ensure we have an accurate history
     # of each router's rank+bandwidth for the entire duration of the run..
     if e.state == EVENT_STATE.PRELISTEN:
-      if not self.consensus: 
-        global OP
-        OP = Router.query.filter_by(
-                 idhex="0000000000000000000000000000000000000000").first()
-        if not OP:
-          OP = Router(idhex="0000000000000000000000000000000000000000", 
-                    orhash="000000000000000000000000000", 
-                    nickname="!!TorClient", 
-                    published=datetime.datetime.utcnow())
-          tc_session.add(OP)
-          tc_session.commit()
+      if not self.consensus:
+        sql_writer.schedule(self._load_op)
         self.update_consensus()
-      # XXX: This hack exists because update_rank_history is expensive.
-      # However, even if we delay it till the end of the consensus update, 
-      # it still delays event processing for up to 30 seconds on a fast 
-      # machine.
-      # 
-      # The correct way to do this is give SQL processing
-      # to a dedicated worker thread that pulls events off of a secondary
-      # queue, that way we don't block stream handling on this processing.
-      # The problem is we are pretty heavily burdened with the need to 
-      # stay in sync with our parent event handler. A queue will break this 
-      # coupling (even if we could get all the locking right).
-      #
-      # A lighterweight hack might be to just make the scanners pause
-      # on a condition used to signal we are doing this (and other) heavy 
-      # lifting. We could have them possibly check self.last_desc_at..
+      # The rank history update itself runs on the SQLWriter thread, but
+      # we still wait for the descriptors to settle so that the history
+      # reflects the full consensus.
       if not self.wait_for_signal and e.arrived_at - self.last_desc_at > 60.0:
         if not PathSupport.PathBuilder.is_urgent_event(e):
           plog("INFO", "Newdesc timer is up. Assuming we have full consensus")
@@ -759,15 +854,20 @@ class ConsensusTrackerListener(TorCtl.DualEventListener):
       self.last_desc_at = n.arrived_at
       self.update_consensus()
 
-  def new_desc_event(self, d): 
+  def new_desc_event(self, d):
     if d.state == EVENT_STATE.POSTLISTEN:
       self.last_desc_at = d.arrived_at
       self.consensus = self.parent_handler.current_consensus()
       self._update_db(d.idlist)
 
+def _set_row_type(table, id, row_type):
+  "Change the polymorphic type of a row inside the current transaction"
+  tc_session.execute(table.update(table.c.id == id,
+                                  values={'row_type':row_type}))
+
 class CircuitListener(TorCtl.PreEventListener):
   def set_parent(self, parent_handler):
-    if not filter(lambda f: f.__class__ == ConsensusTrackerListener, 
+    if not filter(lambda f: f.__class__ == ConsensusTrackerListener,
                   parent_handler.post_listeners):
        raise TorCtlError("CircuitListener needs a ConsensusTrackerListener")
     TorCtl.PreEventListener.set_parent(self, parent_handler)
@@ -780,6 +880,20 @@ class CircuitListener(TorCtl.PreEventListener):
     else:
       self.track_parent = False
 
+  def _path_idhex(self, name):
+    """idhex of the circuit hop 'name', which may be a nickname. An unknown
+       nickname gives a KeyError instead, which _known() raises in the job
+       only if the circuit is one of ours, like the lookup used to."""
+    if name[0] != '$':
+      if name not in self.parent_handler.name_to_key: return KeyError(name)
+      name = self.parent_handler.name_to_key[name]
+    return name[1:]
+
+  def _known(self, idhex):
+    "Return the result of _path_idhex(), raising the lookup error if any"
+    if isinstance(idhex, KeyError): raise idhex
+    return idhex
+
   def circ_status_event(self, c):
     if self.track_parent and c.circ_id not in self.parent_handler.circuits:
       return # Ignore circuits that aren't ours
@@ -795,162 +909,192 @@ class CircuitListener(TorCtl.PreEventListener):
     if c.reason: output.append("REASON=" + c.reason)
     if c.remote_reason: output.append("REMOTE_REASON=" + c.remote_reason)
     plog("DEBUG", " ".join(output))
-  
+
+    # Everything we need from the parent handler has to be looked up
+    # now. The SQL work happens later on the SQLWriter thread.
     if c.status == "LAUNCHED":
-      circ = Circuit(circ_id=c.circ_id,launch_time=c.arrived_at,
-                     last_extend=c.arrived_at)
+      path = None
       if self.track_parent:
-        for r in self.parent_handler.circuits[c.circ_id].path:
-          rq = Router.query.options(eagerload('circuits')).filter_by(
-                                idhex=r.idhex).one()
-          circ.routers.append(rq) 
-          #rq.circuits.append(circ) # done automagically?
-          #tc_session.add(rq)
-      tc_session.add(circ)
-      tc_session.commit()
+        path = [r.idhex for r in self.parent_handler.circuits[c.circ_id].path]
+      sql_writer.schedule(lambda: self._circ_launched(c, path))
     elif c.status == "EXTENDED":
-      circ = Circuit.query.options(eagerload('extensions')).filter_by(
-                       circ_id = c.circ_id).first()
-      if not circ: return # Skip circuits from before we came online
+      from_idhex = None # OP
+      if len(c.path) > 1: from_idhex = self._path_idhex(c.path[-2])
+      to_idhex = self._path_idhex(c.path[-1])
+      sql_writer.schedule(lambda:
+                  self._circ_extended(c, from_idhex, to_idhex))
+    elif c.status == "FAILED":
+      from_idhex = None # OP
+      if len(c.path) > 0: from_idhex = self._path_idhex(c.path[-1])
+      to_idhex = None # We have no idea..
+      if self.track_parent:
+        path = self.parent_handler.circuits[c.circ_id].path
+        if len(c.path) < len(path): to_idhex = path[len(c.path)].idhex
+      sql_writer.schedule(lambda:
+                  self._circ_failed(c, reason, from_idhex, to_idhex))
+    elif c.status == "BUILT":
+      sql_writer.schedule(lambda: self._circ_built(c))
+    elif c.status == "CLOSED":
+      sql_writer.schedule(lambda: self._circ_closed(c, lreason, reason))
+
+  def _circ_launched(self, c, path):
+    circ = Circuit(circ_id=c.circ_id,launch_time=c.arrived_at,
+                   last_extend=c.arrived_at)
+    if path:
+      for idhex in path:
+        rq = Router.query.options(eagerload('circuits')).filter_by(
+                              idhex=idhex).one()
+        circ.routers.append(rq)
+        #rq.circuits.append(circ) # done automagically?
+        #tc_session.add(rq)
+    tc_session.add(circ)
+
+  def _circ_extended(self, c, from_idhex, to_idhex):
+    circ = Circuit.query.options(eagerload('extensions')).filter_by(
+                     circ_id = c.circ_id).first()
+    if not circ: return # Skip circuits from before we came online
 
-      e = Extension(circ=circ, hop=len(c.path)-1, time=c.arrived_at)
+    e = Extension(circ=circ, hop=len(c.path)-1, time=c.arrived_at)
 
-      if len(c.path) == 1:
+    if not from_idhex:
+      e.from_node = OP
+    else:
+      e.from_node = Router.query.filter_by(idhex=self._known(from_idhex)).one()
+
+    e.to_node = Router.query.filter_by(idhex=self._known(to_idhex)).one()
+    if not self.track_parent:
+      # FIXME: Eager load here?
+      circ.routers.append(e.to_node)
+      e.to_node.circuits.append(circ)
+      tc_session.add(e.to_node)
+
+    e.delta = c.arrived_at - circ.last_extend
+    circ.last_extend = c.arrived_at
+    circ.extensions.append(e)
+    tc_session.add(e)
+    tc_session.add(circ)
+
+  def _circ_failed(self, c, reason, from_idhex, to_idhex):
+    circ = Circuit.query.filter_by(circ_id = c.circ_id).first()
+    if not circ: return # Skip circuits from before we came online
+
+    circ.expunge()
+    if isinstance(circ, BuiltCircuit):
+      # Convert to destroyed circuit
+      _set_row_type(Circuit.table, circ.id, 'destroyedcircuit')
+      circ = DestroyedCircuit.query.filter_by(id=circ.id).one()
+      circ.destroy_reason = reason
+      circ.destroy_time = c.arrived_at
+    else:
+      # Convert to failed circuit
+      _set_row_type(Circuit.table, circ.id, 'failedcircuit')
+      circ = FailedCircuit.query.options(
+                eagerload('extensions')).filter_by(id=circ.id).one()
+      circ.fail_reason = reason
+      circ.fail_time = c.arrived_at
+      e = FailedExtension(circ=circ, hop=len(c.path), time=c.arrived_at)
+
+      if not from_idhex:
         e.from_node = OP
       else:
-        r_ext = c.path[-2]
-        if r_ext[0] != '$': r_ext = self.parent_handler.name_to_key[r_ext]
-        e.from_node = Router.query.filter_by(idhex=r_ext[1:]).one()
-
-      r_ext = c.path[-1]
-      if r_ext[0] != '$': r_ext = self.parent_handler.name_to_key[r_ext]
-
-      e.to_node = Router.query.filter_by(idhex=r_ext[1:]).one()
-      if not self.track_parent:
-        # FIXME: Eager load here?
-        circ.routers.append(e.to_node)
-        e.to_node.circuits.append(circ)
-        tc_session.add(e.to_node)
- 
+        e.from_node = Router.query.filter_by(
+                        idhex=self._known(from_idhex)).one()
+
+      if to_idhex:
+        e.to_node = Router.query.filter_by(idhex=to_idhex).one()
+      else:
+        e.to_node = None
+
       e.delta = c.arrived_at - circ.last_extend
-      circ.last_extend = c.arrived_at
+      e.reason = reason
       circ.extensions.append(e)
+      circ.fail_time = c.arrived_at
       tc_session.add(e)
-      tc_session.add(circ)
-      tc_session.commit()
-    elif c.status == "FAILED":
-      circ = Circuit.query.filter_by(circ_id = c.circ_id).first()
-      if not circ: return # Skip circuits from before we came online
-        
-      circ.expunge()
-      if isinstance(circ, BuiltCircuit):
-        # Convert to destroyed circuit
-        Circuit.table.update(Circuit.id ==
-                  circ.id).execute(row_type='destroyedcircuit')
-        circ = DestroyedCircuit.query.filter_by(id=circ.id).one()
-        circ.destroy_reason = reason
-        circ.destroy_time = c.arrived_at
-      else:
-        # Convert to failed circuit
-        Circuit.table.update(Circuit.id ==
-                  circ.id).execute(row_type='failedcircuit')
-        circ = FailedCircuit.query.options(
-                  eagerload('extensions')).filter_by(id=circ.id).one()
-        circ.fail_reason = reason
-        circ.fail_time = c.arrived_at
-        e = FailedExtension(circ=circ, hop=len(c.path), time=c.arrived_at)
-
-        if len(c.path) == 0:
-          e.from_node = OP
-        else:
-          r_ext = c.path[-1]
-          if r_ext[0] != '$': r_ext = self.parent_handler.name_to_key[r_ext]
- 
-          e.from_node = Router.query.filter_by(idhex=r_ext[1:]).one()
 
-        if self.track_parent:
-          r=self.parent_handler.circuits[c.circ_id].path[len(c.path)]
-          e.to_node = Router.query.filter_by(idhex=r.idhex).one()
-        else:
-          e.to_node = None # We have no idea..
+    tc_session.add(circ)
 
-        e.delta = c.arrived_at - circ.last_extend
-        e.reason = reason
-        circ.extensions.append(e)
-        circ.fail_time = c.arrived_at
-        tc_session.add(e)
+  def _circ_built(self, c):
+    circ = Circuit.query.filter_by(
+                   circ_id = c.circ_id).first()
+    if not circ: return # Skip circuits from before we came online
 
-      tc_session.add(circ)
-      tc_session.commit()
-    elif c.status == "BUILT":
-      circ = Circuit.query.filter_by(
-                     circ_id = c.circ_id).first()
-      if not circ: return # Skip circuits from before we came online
+    circ.expunge()
+    # Convert to built circuit
+    _set_row_type(Circuit.table, circ.id, 'builtcircuit')
+    circ = BuiltCircuit.query.filter_by(id=circ.id).one()
+
+    circ.built_time = c.arrived_at
+    circ.tot_delta = c.arrived_at - circ.launch_time
+    tc_session.add(circ)
 
+  def _circ_closed(self, c, lreason, reason):
+    circ = BuiltCircuit.query.filter_by(circ_id = c.circ_id).first()
+    if circ:
       circ.expunge()
-      # Convert to built circuit
-      Circuit.table.update(Circuit.id ==
-                circ.id).execute(row_type='builtcircuit')
-      circ = BuiltCircuit.query.filter_by(id=circ.id).one()
-      
-      circ.built_time = c.arrived_at
-      circ.tot_delta = c.arrived_at - circ.launch_time
+      if lreason in ("REQUESTED", "FINISHED", "ORIGIN"):
+        # Convert to closed circuit
+        _set_row_type(Circuit.table, circ.id, 'closedcircuit')
+        circ = ClosedCircuit.query.filter_by(id=circ.id).one()
+        circ.closed_time = c.arrived_at
+      else:
+        # Convert to destroyed circuit
+        _set_row_type(Circuit.table, circ.id, 'destroyedcircuit')
+        circ = DestroyedCircuit.query.filter_by(id=circ.id).one()
+        circ.destroy_reason = reason
+        circ.destroy_time = c.arrived_at
       tc_session.add(circ)
-      tc_session.commit()
-    elif c.status == "CLOSED":
-      circ = BuiltCircuit.query.filter_by(circ_id = c.circ_id).first()
-      if circ:
-        circ.expunge()
-        if lreason in ("REQUESTED", "FINISHED", "ORIGIN"):
-          # Convert to closed circuit
-          Circuit.table.update(Circuit.id ==
-                    circ.id).execute(row_type='closedcircuit')
-          circ = ClosedCircuit.query.filter_by(id=circ.id).one()
-          circ.closed_time = c.arrived_at
-        else:
-          # Convert to destroyed circuit
-          Circuit.table.update(Circuit.id ==
-                    circ.id).execute(row_type='destroyedcircuit')
-          circ = DestroyedCircuit.query.filter_by(id=circ.id).one()
-          circ.destroy_reason = reason
-          circ.destroy_time = c.arrived_at
-        tc_session.add(circ)
-        tc_session.commit()
 
 class StreamListener(CircuitListener):
   def stream_bw_event(self, s):
+    sql_writer.schedule(lambda: self._stream_bw(s))
+
+  def _stream_bw(self, s):
     strm = Stream.query.filter_by(strm_id = s.strm_id).first()
     if strm and strm.start_time and strm.start_time < s.arrived_at:
-      plog("DEBUG", "Got stream bw: "+str(s.strm_id))
+      plog("DEBUG", "Got stream bw: %s", s.strm_id)
       strm.tot_read_bytes += s.bytes_read
       strm.tot_write_bytes += s.bytes_written
       tc_session.add(strm)
-      tc_session.commit()
- 
-  def stream_status_event(self, s):
-    if s.reason: lreason = s.reason
-    else: lreason = "NONE"
-    if s.remote_reason: rreason = s.remote_reason
-    else: rreason = "NONE"
 
+  def stream_status_event(self, s):
     if s.status in ("NEW", "NEWRESOLVE"):
-      strm = Stream(strm_id=s.strm_id, tgt_host=s.target_host, 
-                    tgt_port=s.target_port, init_status=s.status,
-                    tot_read_bytes=0, tot_write_bytes=0)
-      tc_session.add(strm)
-      tc_session.commit()
+      sql_writer.schedule(lambda: self._stream_new(s))
       return
 
-    strm = Stream.query.filter_by(strm_id = s.strm_id).first()
     if self.track_parent and \
       (s.strm_id not in self.parent_handler.streams or \
            self.parent_handler.streams[s.strm_id].ignored):
-      if strm:
-        tc_session.delete(strm)
-        tc_session.commit()
+      sql_writer.schedule(lambda: self._stream_ignored(s))
       return # Ignore streams that aren't ours
 
-    if not strm: 
+    # Look up the circuit in the parent handler now, the SQL work
+    # happens later on the SQLWriter thread.
+    circ_id = s.circ_id
+    if s.status != "SENTCONNECT" and not circ_id and self.track_parent:
+      circ = self.parent_handler.streams[s.strm_id].circ
+      if not circ: circ = self.parent_handler.streams[s.strm_id].pending_circ
+      if circ: circ_id = circ.circ_id
+    sql_writer.schedule(lambda: self._stream_status(s, circ_id))
+
+  def _stream_new(self, s):
+    strm = Stream(strm_id=s.strm_id, tgt_host=s.target_host,
+                  tgt_port=s.target_port, init_status=s.status,
+                  tot_read_bytes=0, tot_write_bytes=0)
+    tc_session.add(strm)
+
+  def _stream_ignored(self, s):
+    strm = Stream.query.filter_by(strm_id = s.strm_id).first()
+    if strm:
+      tc_session.delete(strm)
+
+  def _stream_status(self, s, circ_id):
+    if s.reason: lreason = s.reason
+    else: lreason = "NONE"
+    if s.remote_reason: rreason = s.remote_reason
+    else: rreason = "NONE"
+
+    strm = Stream.query.filter_by(strm_id = s.strm_id).first()
+    if not strm:
       plog("NOTICE", "Ignoring prior stream "+str(s.strm_id))
       return # Ignore prior streams
 
@@ -962,17 +1106,11 @@ class StreamListener(CircuitListener):
       if not strm.circuit:
         plog("NOTICE", "Ignoring prior stream "+str(strm.strm_id)+" with old circuit "+str(s.circ_id))
         tc_session.delete(strm)
-        tc_session.commit()
         return
     else:
       circ = None
-      if s.circ_id:
-        circ = Circuit.query.filter_by(circ_id=s.circ_id).first()
-      elif self.track_parent:
-        circ = self.parent_handler.streams[s.strm_id].circ
-        if not circ: circ = self.parent_handler.streams[s.strm_id].pending_circ
-        if circ:
-          circ = Circuit.query.filter_by(circ_id=circ.circ_id).first()
+      if circ_id:
+        circ = Circuit.query.filter_by(circ_id=circ_id).first()
 
       if not circ:
         plog("WARN", "No circuit for "+str(s.strm_id)+" circ: "+str(s.circ_id))
@@ -982,15 +1120,14 @@ class StreamListener(CircuitListener):
         strm.circuit = circ
 
       # XXX: Verify circ id matches stream.circ
-    
+
     if s.status == "SUCCEEDED":
       strm.start_time = s.arrived_at
-      for r in strm.circuit.routers: 
-        plog("DEBUG", "Added router "+r.idhex+" to stream "+str(s.strm_id))
+      for r in strm.circuit.routers:
+        plog("DEBUG", "Added router %s to stream %s", r.idhex, s.strm_id)
         r.streams.append(strm)
         tc_session.add(r)
       tc_session.add(strm)
-      tc_session.commit()
     elif s.status == "DETACHED":
       for r in strm.circuit.routers:
         r.detached_streams.append(strm)
@@ -1000,17 +1137,14 @@ class StreamListener(CircuitListener):
       strm.circuit.streams.remove(strm)
       strm.circuit = None
       tc_session.add(strm)
-      tc_session.commit()
     elif s.status == "FAILED":
       strm.expunge()
       # Convert to destroyed circuit
-      Stream.table.update(Stream.id ==
-                strm.id).execute(row_type='failedstream')
+      _set_row_type(Stream.table, strm.id, 'failedstream')
       strm = FailedStream.query.filter_by(id=strm.id).one()
       strm.fail_time = s.arrived_at
       strm.fail_reason = reason
       tc_session.add(strm)
-      tc_session.commit()
     elif s.status == "CLOSED":
       if isinstance(strm, FailedStream):
         strm.close_reason = reason
@@ -1018,22 +1152,19 @@ class StreamListener(CircuitListener):
         strm.expunge()
         if not (lreason == "DONE" or (lreason == "END" and rreason == "DONE")):
           # Convert to destroyed circuit
-          Stream.table.update(Stream.id ==
-                    strm.id).execute(row_type='failedstream')
+          _set_row_type(Stream.table, strm.id, 'failedstream')
           strm = FailedStream.query.filter_by(id=strm.id).one()
           strm.fail_time = s.arrived_at
-        else: 
+        else:
           # Convert to destroyed circuit
-          Stream.table.update(Stream.id ==
-                    strm.id).execute(row_type='closedstream')
+          _set_row_type(Stream.table, strm.id, 'closedstream')
           strm = ClosedStream.query.filter_by(id=strm.id).one()
           strm.read_bandwidth = strm.tot_read_bytes/(s.arrived_at-strm.start_time)
           strm.write_bandwidth = strm.tot_write_bytes/(s.arrived_at-strm.start_time)
           strm.end_time = s.arrived_at
-          plog("DEBUG", "Stream "+str(strm.strm_id)+" xmitted "+str(strm.tot_bytes()))
+          plog("DEBUG", "Stream %s xmitted %s", strm.strm_id, strm.tot_bytes())
         strm.close_reason = reason
       tc_session.add(strm)
-      tc_session.commit()
 
 def run_example(host, port):
   """ Example of basic TorCtl usage. See PathSupport for more advanced
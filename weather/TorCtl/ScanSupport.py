@@ -182,9 +182,12 @@ class SQLScanHandler(ScanHandler):
     cond = threading.Condition()
     def notlambda(h):
       cond.acquire()
-      SQLSupport.RouterStats.write_stats(file(rfilename, "w"),
+      # The SQL listeners' writer thread owns the DB. Run there, after
+      # everything it has queued is committed.
+      SQLSupport.sql_writer.call(lambda:
+        SQLSupport.RouterStats.write_stats(file(rfilename, "w"),
                             0, 100, order_by=SQLSupport.RouterStats.sbw,
-                            recompute=True, disp_clause=stats_filter)
+                            recompute=True, disp_clause=stats_filter))
       cond.notify()
       cond.release()
     cond.acquire()
@@ -200,9 +203,10 @@ class SQLScanHandler(ScanHandler):
       cond.acquire()
       f=file(rfilename, "w")
       f.write("slicenum="+str(slice_num)+"\n")
-      SQLSupport.RouterStats.write_bws(f, 0, 100,
+      SQLSupport.sql_writer.call(lambda:
+        SQLSupport.RouterStats.write_bws(f, 0, 100,
                             order_by=SQLSupport.RouterStats.sbw,
-                            recompute=False, disp_clause=stats_filter)
+                            recompute=False, disp_clause=stats_filter))
       f.close()
       cond.notify()
       cond.release()
@@ -213,14 +217,16 @@ class SQLScanHandler(ScanHandler):
 
   def save_sql_file(self, sql_file, new_file):
     cond = threading.Condition()
-    def notlambda(this):
-      cond.acquire()
+    def save():
       SQLSupport.tc_session.close()
       try:
         shutil.copy(sql_file, new_file)
       except Exception,e:
         plog("WARN", "Error moving sql file: "+str(e))
       SQLSupport.reset_all()
+    def notlambda(this):
+      cond.acquire()
+      SQLSupport.sql_writer.call(save)
       cond.notify()
       cond.release()
     cond.acquire()
@@ -50,13 +50,33 @@ from TorUtil import *
 from PathSupport import *
 from TorUtil import meta_port, meta_host, control_port, control_host
 
+# numpy is optional. With it, the StatsHandler reports are computed from
+# a StatsColumns snapshot instead of per-router method calls.
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
 class ReasonRouterList:
-  "Helper class to track which Routers have failed for a given reason"
+  """Helper class to track which Routers have failed for a given reason.
+     The failure and suspicion totals over the routers in the list are
+     kept current as failures are counted (see 
+     StatsHandler._count_reason), and the sorted view is only rebuilt
+     after a change."""
   def __init__(self, reason):
     self.reason = reason
     self.rlist = {}
+    self._failed = 0
+    self._suspected = 0
+    self._sorted = None
+
+  def sort_list(self):
+    "Return the routers in this list, sorted. Cached until the next change."
+    if self._sorted is None:
+      self._sorted = self._sort_list()
+    return self._sorted
 
-  def sort_list(self): raise NotImplemented()
+  def _sort_list(self): raise NotImplemented()
 
   def write_list(self, f):
     "Write the list of failure counts for this reason 'f'"
@@ -76,32 +96,32 @@ class ReasonRouterList:
     
   def add_r(self, r):
     "Add a router to the list for this reason"
+    if r in self.rlist: return
     self.rlist[r] = 1
+    if self.reason in r.reason_failed:
+      self._failed += r.reason_failed[self.reason]
+    if self.reason in r.reason_suspected:
+      self._suspected += r.reason_suspected[self.reason]
+    self._sorted = None
+
+  def count_r(self, r, failed):
+    """Note that the failed (or suspected, if 'failed' is False) count of
+       router 'r' for this reason went up by one. Ignored if 'r' is not
+       in the list; add_r() picks up its counts when it is added."""
+    if r not in self.rlist: return
+    if failed: self._failed += 1
+    else: self._suspected += 1
+    self._sorted = None
 
   def total_suspected(self):
     "Get a list of total suspected failures for this reason"
     # suspected is disjoint from failed. The failed table
     # may not have an entry
-    def notlambda(x, y):
-      if self.reason in y.reason_suspected:
-        if self.reason in y.reason_failed:
-          return (x + y.reason_suspected[self.reason]
-               + y.reason_failed[self.reason])
-        else:
-          return (x + y.reason_suspected[self.reason])
-      else:
-        if self.reason in y.reason_failed:
-          return (x + y.reason_failed[self.reason])
-        else: return x
-    return reduce(notlambda, self.rlist.iterkeys(), 0)
+    return self._suspected + self._failed
 
   def total_failed(self):
     "Get a list of total failures for this reason"
-    def notlambda(x, y):
-      if self.reason in y.reason_failed:
-        return (x + y.reason_failed[self.reason])
-      else: return x
-    return reduce(notlambda, self.rlist.iterkeys(), 0)
+    return self._failed
  
 class SuspectRouterList(ReasonRouterList):
   """Helper class to track all routers suspected of failing for a given
@@ -109,15 +129,19 @@ class SuspectRouterList(ReasonRouterList):
      ReasonRouterList is the sort order and the verification."""
   def __init__(self, reason): ReasonRouterList.__init__(self,reason)
   
-  def sort_list(self):
+  def _sort_list(self):
     rlist = self.rlist.keys()
     rlist.sort(lambda x, y: cmp(y.reason_suspected[self.reason],
                   x.reason_suspected[self.reason]))
     return rlist
    
   def _verify_suspected(self):
-    return reduce(lambda x, y: x + y.reason_suspected[self.reason],
+    tot = reduce(lambda x, y: x + y.reason_suspected[self.reason],
             self.rlist.iterkeys(), 0)
+    if tot != self._suspected:
+      plog("ERROR", "Suspected total for "+self.reason+" is "
+           +str(self._suspected)+", counted "+str(tot))
+    return tot
 
 class FailedRouterList(ReasonRouterList):
   """Helper class to track all routers that failed for a given
@@ -125,20 +149,34 @@ class FailedRouterList(ReasonRouterList):
      ReasonRouterList is the sort order and the verification."""
   def __init__(self, reason): ReasonRouterList.__init__(self,reason)
 
-  def sort_list(self):
+  def _sort_list(self):
     rlist = self.rlist.keys()
     rlist.sort(lambda x, y: cmp(y.reason_failed[self.reason],
                   x.reason_failed[self.reason]))
     return rlist
 
   def _verify_failed(self):
-    return reduce(lambda x, y: x + y.reason_failed[self.reason],
+    tot = reduce(lambda x, y: x + y.reason_failed[self.reason],
             self.rlist.iterkeys(), 0)
+    if tot != self._failed:
+      plog("ERROR", "Failed total for "+self.reason+" is "
+           +str(self._failed)+", counted "+str(tot))
+    return tot
+
 class BandwidthStats:
-  "Class that manages observed bandwidth through a Router"
-  def __init__(self):
-    self.byte_list = []
-    self.duration_list = []
+  """Class that manages observed bandwidth through a Router. 
+
+  Only running sums are kept, so adding a sample takes constant time and
+  memory no matter how long the scan runs. If 'reservoir' is nonzero, a
+  uniform random sample of at most that many observed bandwidths is also
+  kept for percentile()."""
+  def __init__(self, reservoir=0):
+    self.count = 0
+    self.tot_bytes = 0.0 # sum(b)
+    self.sum_b2_d = 0.0  # sum(b^2/d)
+    self.sum_b3_d2 = 0.0 # sum(b^3/d^2)
+    self.reservoir = reservoir
+    self.samples = []
     self.min_bw = 1e10
     self.max_bw = 0
     self.mean = 0
@@ -146,23 +184,13 @@ class BandwidthStats:
 
   def _exp(self): # Weighted avg
     "Expectation - weighted average of the bandwidth through this node"
-    tot_bw = reduce(lambda x, y: x+y, self.byte_list, 0.0)
-    EX = 0.0
-    for i in xrange(len(self.byte_list)):
-      EX += (self.byte_list[i]*self.byte_list[i])/self.duration_list[i]
-    if tot_bw == 0.0: return 0.0
-    EX /= tot_bw
-    return EX
+    if self.tot_bytes == 0.0: return 0.0
+    return self.sum_b2_d/self.tot_bytes
 
   def _exp2(self): # E[X^2]
     "Second moment of the bandwidth"
-    tot_bw = reduce(lambda x, y: x+y, self.byte_list, 0.0)
-    EX = 0.0
-    for i in xrange(len(self.byte_list)):
-      EX += (self.byte_list[i]**3)/(self.duration_list[i]**2)
-    if tot_bw == 0.0: return 0.0
-    EX /= tot_bw
-    return EX
+    if self.tot_bytes == 0.0: return 0.0
+    return self.sum_b3_d2/self.tot_bytes
     
   def _dev(self): # Weighted dev
     "Standard deviation of bandwidth"
@@ -177,15 +205,33 @@ class BandwidthStats:
     "Add an observed transfer of 'bytes' for 'duration' seconds"
     if not bytes: plog("NOTICE", "No bytes for bandwidth")
     bytes /= 1024.
-    self.byte_list.append(bytes)
-    self.duration_list.append(duration)
+    self.count += 1
+    self.tot_bytes += bytes
+    self.sum_b2_d += (bytes*bytes)/duration
+    self.sum_b3_d2 += (bytes**3)/(duration**2)
     bw = bytes/duration
-    plog("DEBUG", "Got bandwidth "+str(bw))
+    plog("DEBUG", "Got bandwidth %s", bw)
     if self.min_bw > bw: self.min_bw = bw
     if self.max_bw < bw: self.max_bw = bw
+    if self.reservoir:
+      # Reservoir sampling: every sample so far is kept with equal 
+      # probability
+      if len(self.samples) < self.reservoir:
+        self.samples.append(bw)
+      else:
+        i = random.randint(0, self.count-1)
+        if i < self.reservoir: self.samples[i] = bw
     self.mean = self._exp()
     self.dev = self._dev()
 
+  def percentile(self, pct):
+    """Return the 'pct' percentile of the sampled bandwidths, or None if
+    no samples are kept"""
+    if not self.samples: return None
+    samples = copy.copy(self.samples)
+    samples.sort()
+    return samples[min(len(samples)-1, int(len(samples)*pct/100.0))]
+
 
 class StatsRouter(TorCtl.Router):
   "Extended Router to handle statistics markup"
@@ -198,7 +244,7 @@ class StatsRouter(TorCtl.Router):
     # StatsRouters should not be destroyed when Tor forgets about them
     # Give them an extra refcount:
     self.refcount += 1
-    plog("DEBUG", "Stats refcount "+str(self.refcount)+" for "+self.idhex)
+    plog("DEBUG", "Stats refcount %d for %s", self.refcount, self.idhex)
 
   def reset(self):
     "Reset all stats on this Router"
@@ -414,12 +460,123 @@ class StatsRouter(TorCtl.Router):
                     +str(per_hour_tot) +" vs "+str(chosen_tot))
 
 
+def _zprob_array(z):
+  "Vectorized TorUtil.zprob() over a numpy array of z values"
+  Z_MAX = 6.0
+  y = 0.5*numpy.fabs(z)
+  w = y*y
+  small = ((((((((0.000124818987 * w
+              -0.001075204047) * w +0.005198775019) * w
+            -0.019198292004) * w +0.059054035642) * w
+          -0.151968751364) * w +0.319152932694) * w
+        -0.531923007300) * w +0.797884560593) * y * 2.0
+  y = y - 2.0
+  large = (((((((((((((-0.000045255659 * y
+                   +0.000152529290) * y -0.000019538132) * y
+                 -0.000676904986) * y +0.001390604284) * y
+               -0.000794620820) * y -0.002034254874) * y
+             +0.006549791214) * y -0.010557625006) * y
+           +0.011630447319) * y -0.009279453341) * y
+         +0.005353579108) * y -0.002141268741) * y
+       +0.000535310849) * y +0.999936657524
+  y = 0.5*numpy.fabs(z)
+  x = numpy.where(y >= Z_MAX*0.5, 1.0, numpy.where(y < 1.0, small, large))
+  x = numpy.where(z == 0.0, 0.0, x)
+  return numpy.where(z > 0.0, (x+1.0)*0.5, (1.0-x)*0.5)
+
+class StatsColumns:
+  """Snapshot of the per-router counters of a list of StatsRouters as
+  numpy arrays, so that the network-wide averages, deviations, z-tests
+  and sort orders of the StatsHandler reports are computed in a few
+  array operations instead of a reduce() over Router method calls."""
+  def __init__(self, routers):
+    self.routers = routers
+    n = len(routers)
+    def col(f, dtype=float):
+      return numpy.fromiter(map(f, routers), dtype, n)
+    self.strm_mean = col(lambda r: r.bwstats.mean)
+    self.bw = col(lambda r: r.bw)
+    self.circ_chosen = col(lambda r: r.circ_chosen)
+    self.circ_failed = col(lambda r: r.circ_failed)
+    self.circ_suspected = col(lambda r: r.circ_suspected)
+    self.strm_chosen = col(lambda r: r.strm_chosen)
+    self.strm_failed = col(lambda r: r.strm_failed)
+    self.strm_suspected = col(lambda r: r.strm_suspected)
+    self.total_extend_time = col(lambda r: r.total_extend_time)
+    self.total_extended = col(lambda r: r.total_extended)
+    self.uptime = col(lambda r: r.current_uptime())
+    self.used = self.circ_chosen != 0
+
+  def _ratio(self, num, den, default):
+    "num/den, or 'default' where den is 0"
+    return numpy.where(den == 0, default, num/numpy.where(den == 0, 1, den))
+
+  def bw_ratio(self):
+    return self._ratio(self.bw, 1024.*self.strm_mean, 0.0)
+
+  def strm_bw_ratio(self):
+    if StatsRouter.global_strm_mean == 0.0:
+      return numpy.zeros(len(self.routers))
+    return self.strm_mean/StatsRouter.global_strm_mean
+
+  def circ_fail_rate(self):
+    return self._ratio(self.circ_failed, self.circ_chosen, 0.0)
+
+  def strm_fail_rate(self):
+    return self._ratio(self.strm_failed, self.strm_chosen, 0.0)
+
+  def circ_suspect_rate(self):
+    return self._ratio(self.circ_suspected+self.circ_failed,
+                       self.circ_chosen, 1.0)
+
+  def strm_suspect_rate(self):
+    return self._ratio(self.strm_suspected+self.strm_failed,
+                       self.strm_chosen, 1.0)
+
+  def avg_extend_time(self):
+    return self._ratio(self.total_extend_time, self.total_extended, 0.0)
+
+  def failed_per_hour(self):
+    return (3600.*(self.circ_failed+self.strm_failed))/self.uptime
+
+  def suspected_per_hour(self):
+    return (3600.*(self.circ_suspected+self.strm_suspected
+          +self.circ_failed+self.strm_failed))/self.uptime
+
+  def ztest(self, vals):
+    """Unweighted z-test over the positive entries of 'vals'. Returns
+    (avg, stddev, z, prob) where z and prob are None if stddev is 0."""
+    pos = vals > 0
+    n = numpy.count_nonzero(pos)
+    if n == 0: return (0, 0, None, None)
+    avg = float(vals.sum())/n
+    d = vals[pos]-avg
+    stddev = math.sqrt(float(numpy.dot(d, d))/n)
+    if not stddev: return (avg, stddev, None, None)
+    z = numpy.zeros(len(vals))
+    z[pos] = numpy.fabs(d/stddev)
+    return (avg, stddev, z, _zprob_array(-z))
+
+  def used_avg(self, vals):
+    "Average of 'vals' over the routers that were used this round"
+    n = numpy.count_nonzero(self.used)
+    if n == 0: return (0, 0)
+    return float(vals[self.used].sum())/n
+
+  def order(self, vals, reverse=False):
+    """Return the routers sorted by 'vals', with ties left in their
+    current order (like a stable sort by the corresponding method)."""
+    if reverse: vals = -vals
+    return [self.routers[i] for i in numpy.argsort(vals, kind="mergesort")]
+
 # TODO: Use __metaclass__ and type to make this inheritance flexible?
 class StatsHandler(PathSupport.PathBuilder):
   """An extension of PathSupport.PathBuilder that keeps track of 
      router statistics for every circuit and stream"""
-  def __init__(self, c, slmgr, RouterClass=StatsRouter, track_ranks=False):
-    PathBuilder.__init__(self, c, slmgr, RouterClass)
+  def __init__(self, c, slmgr, RouterClass=StatsRouter, track_ranks=False,
+               snapshot_file=None):
+    PathBuilder.__init__(self, c, slmgr, RouterClass,
+                         snapshot_file=snapshot_file)
     self.circ_count = 0
     self.strm_count = 0
     self.strm_failed = 0
@@ -429,10 +586,27 @@ class StatsHandler(PathSupport.PathBuilder):
     self.suspect_reasons = {}
     self.track_ranks = track_ranks
 
+  def _columns(self):
+    "A StatsColumns snapshot of sorted_r, or None without numpy"
+    if numpy is None: return None
+    return StatsColumns(self.sorted_r)
+
+  def _set_ztest(self, cols, vals, zattr, pattr):
+    (avg, stddev, z, prob) = cols.ztest(vals)
+    if z is not None:
+      for i in numpy.flatnonzero(vals > 0):
+        r = cols.routers[i]
+        setattr(r, zattr, float(z[i]))
+        setattr(r, pattr, float(prob[i]))
+    return (avg, stddev)
+
   # XXX: Shit, all this stuff should be slice-based
-  def run_zbtest(self): # Unweighted z-test
+  def run_zbtest(self, cols=None): # Unweighted z-test
     """Run unweighted z-test to calculate the probabilities of a node
        having a given stream bandwidth based on the Normal distribution"""
+    if cols is None: cols = self._columns()
+    if cols is not None:
+      return self._set_ztest(cols, cols.strm_mean, "z_bw", "prob_zb")
     n = reduce(lambda x, y: x+(y.bwstats.mean > 0), self.sorted_r, 0)
     if n == 0: return (0, 0)
     avg = reduce(lambda x, y: x+y.bwstats.mean, self.sorted_r, 0)/float(n)
@@ -447,10 +621,13 @@ class StatsHandler(PathSupport.PathBuilder):
         r.prob_zb = TorUtil.zprob(-r.z_bw)
     return (avg, stddev)
 
-  def run_zrtest(self): # Unweighted z-test
+  def run_zrtest(self, cols=None): # Unweighted z-test
     """Run unweighted z-test to calculate the probabilities of a node
        having a given ratio of stream bandwidth to advertised bandwidth
        based on the Normal distribution"""
+    if cols is None: cols = self._columns()
+    if cols is not None:
+      return self._set_ztest(cols, cols.bw_ratio(), "z_ratio", "prob_zr")
     n = reduce(lambda x, y: x+(y.bw_ratio() > 0), self.sorted_r, 0)
     if n == 0: return (0, 0)
     avg = reduce(lambda x, y: x+y.bw_ratio(), self.sorted_r, 0)/float(n)
@@ -465,35 +642,45 @@ class StatsHandler(PathSupport.PathBuilder):
         r.prob_zr = TorUtil.zprob(-r.z_ratio)
     return (avg, stddev)
 
-  def avg_adv_bw(self):
+  def avg_adv_bw(self, cols=None):
+    if cols is None: cols = self._columns()
+    if cols is not None: return cols.used_avg(cols.bw)
     n = reduce(lambda x, y: x+y.was_used(), self.sorted_r, 0)
     if n == 0: return (0, 0)
     avg = reduce(lambda x, y: x+y.bw, 
             filter(lambda r: r.was_used(), self.sorted_r), 0)/float(n)
     return avg 
 
-  def avg_circ_failure(self):
+  def avg_circ_failure(self, cols=None):
+    if cols is None: cols = self._columns()
+    if cols is not None: return cols.used_avg(cols.circ_fail_rate())
     n = reduce(lambda x, y: x+y.was_used(), self.sorted_r, 0)
     if n == 0: return (0, 0)
     avg = reduce(lambda x, y: x+y.circ_fail_rate(), 
             filter(lambda r: r.was_used(), self.sorted_r), 0)/float(n)
     return avg 
 
-  def avg_stream_failure(self):
+  def avg_stream_failure(self, cols=None):
+    if cols is None: cols = self._columns()
+    if cols is not None: return cols.used_avg(cols.strm_fail_rate())
     n = reduce(lambda x, y: x+y.was_used(), self.sorted_r, 0)
     if n == 0: return (0, 0)
     avg = reduce(lambda x, y: x+y.strm_fail_rate(), 
             filter(lambda r: r.was_used(), self.sorted_r), 0)/float(n)
     return avg 
 
-  def avg_circ_suspects(self):
+  def avg_circ_suspects(self, cols=None):
+    if cols is None: cols = self._columns()
+    if cols is not None: return cols.used_avg(cols.circ_suspect_rate())
     n = reduce(lambda x, y: x+y.was_used(), self.sorted_r, 0)
     if n == 0: return (0, 0)
     avg = reduce(lambda x, y: x+y.circ_suspect_rate(), 
             filter(lambda r: r.was_used(), self.sorted_r), 0)/float(n)
     return avg 
 
-  def avg_stream_suspects(self):
+  def avg_stream_suspects(self, cols=None):
+    if cols is None: cols = self._columns()
+    if cols is not None: return cols.used_avg(cols.strm_suspect_rate())
     n = reduce(lambda x, y: x+y.was_used(), self.sorted_r, 0)
     if n == 0: return (0, 0)
     avg = reduce(lambda x, y: x+y.strm_suspect_rate(), 
@@ -528,23 +715,27 @@ class StatsHandler(PathSupport.PathBuilder):
     f = file(filename, "w")
     f.write(StatsHandler.ratio_key)
 
-    (avg, dev) = self.run_zbtest()
+    cols = self._columns()
+    (avg, dev) = self.run_zbtest(cols)
     StatsRouter.global_strm_mean = avg
     StatsRouter.global_strm_dev = dev
-    (avg, dev) = self.run_zrtest()
+    (avg, dev) = self.run_zrtest(cols)
     StatsRouter.global_ratio_mean = avg
     StatsRouter.global_ratio_dev = dev
 
-    StatsRouter.global_bw_mean = self.avg_adv_bw()
+    StatsRouter.global_bw_mean = self.avg_adv_bw(cols)
 
-    StatsRouter.global_cf_mean = self.avg_circ_failure()
-    StatsRouter.global_sf_mean = self.avg_stream_failure()
+    StatsRouter.global_cf_mean = self.avg_circ_failure(cols)
+    StatsRouter.global_sf_mean = self.avg_stream_failure(cols)
     
-    StatsRouter.global_cs_mean = self.avg_circ_suspects()
-    StatsRouter.global_ss_mean = self.avg_stream_suspects()
+    StatsRouter.global_cs_mean = self.avg_circ_suspects(cols)
+    StatsRouter.global_ss_mean = self.avg_stream_suspects(cols)
 
-    strm_bw_ratio = copy.copy(self.sorted_r)
-    strm_bw_ratio.sort(lambda x, y: cmp(x.strm_bw_ratio(), y.strm_bw_ratio()))
+    if cols is not None:
+      strm_bw_ratio = cols.order(cols.strm_bw_ratio())
+    else:
+      strm_bw_ratio = copy.copy(self.sorted_r)
+      strm_bw_ratio.sort(lambda x, y: cmp(x.strm_bw_ratio(), y.strm_bw_ratio()))
     for r in strm_bw_ratio:
       if r.circ_chosen == 0: continue
       f.write(r.idhex+"="+r.nickname+"\n  ")
@@ -578,12 +769,13 @@ class StatsHandler(PathSupport.PathBuilder):
 
     f = file(filename, "w")
     f.write(StatsRouter.key)
-    (avg, dev) = self.run_zbtest()
+    cols = self._columns()
+    (avg, dev) = self.run_zbtest(cols)
     StatsRouter.global_strm_mean = avg
     StatsRouter.global_strm_dev = dev
     f.write("\n\nBW stats: u="+str(round(avg,1))+" s="+str(round(dev,1))+"\n")
 
-    (avg, dev) = self.run_zrtest()
+    (avg, dev) = self.run_zrtest(cols)
     StatsRouter.global_ratio_mean = avg
     StatsRouter.global_ratio_dev = dev
     f.write("BW ratio stats: u="+str(round(avg,1))+" s="+str(round(dev,1))+"\n")
@@ -597,15 +789,46 @@ class StatsHandler(PathSupport.PathBuilder):
             +"/"+str(self.strm_count)+"\n")
 
     # Extend times 
-    n = 0.01+reduce(lambda x, y: x+(y.avg_extend_time() > 0), self.sorted_r, 0)
-    avg_extend = reduce(lambda x, y: x+y.avg_extend_time(), self.sorted_r, 0)/n
-    def notlambda(x, y):
-      return x+(y.avg_extend_time()-avg_extend)*(y.avg_extend_time()-avg_extend) 
-    dev_extend = math.sqrt(reduce(notlambda, self.sorted_r, 0)/float(n))
+    if cols is not None:
+      ext = cols.avg_extend_time()
+      n = 0.01+numpy.count_nonzero(ext > 0)
+      avg_extend = float(ext.sum())/n
+      d = ext-avg_extend
+      dev_extend = math.sqrt(float(numpy.dot(d, d))/n)
+    else:
+      n = 0.01+reduce(lambda x, y: x+(y.avg_extend_time() > 0), self.sorted_r, 0)
+      avg_extend = reduce(lambda x, y: x+y.avg_extend_time(), self.sorted_r, 0)/n
+      def notlambda(x, y):
+        return x+(y.avg_extend_time()-avg_extend)*(y.avg_extend_time()-avg_extend) 
+      dev_extend = math.sqrt(reduce(notlambda, self.sorted_r, 0)/float(n))
 
     f.write("Extend time: u="+str(round(avg_extend,1))
              +" s="+str(round(dev_extend,1)))
     
+    if cols is not None:
+      self._write_sorted_cols(f, cols)
+    else:
+      self._write_sorted(f)
+    
+    # TODO: Sort by failed/selected and suspect/selected ratios
+    # if we ever want to do non-uniform scanning..
+
+    # FIXME: Add failed in here somehow..
+    susp_reasons = self.suspect_reasons.values()
+    susp_reasons.sort(lambda x, y:
+       cmp(y.total_suspected(), x.total_suspected()))
+    self.write_reasons(f, susp_reasons, "Suspect Reasons")
+
+    fail_reasons = self.failed_reasons.values()
+    fail_reasons.sort(lambda x, y:
+       cmp(y.total_failed(), x.total_failed()))
+    self.write_reasons(f, fail_reasons, "Failed Reasons")
+    f.close()
+
+    # FIXME: sort+print by circ extend time
+
+  def _write_sorted(self, f):
+    "Write the sorted router tables of write_stats()"
     # sort+print by bandwidth
     strm_bw_ratio = copy.copy(self.sorted_r)
     strm_bw_ratio.sort(lambda x, y: cmp(x.strm_bw_ratio(), y.strm_bw_ratio()))
@@ -636,23 +859,28 @@ class StatsHandler(PathSupport.PathBuilder):
     suspect_rate.sort(lambda x, y:
        cmp(y.suspected_per_hour(), x.suspected_per_hour()))
     self.write_routers(f, suspect_rate, "Suspect Rates")
-    
-    # TODO: Sort by failed/selected and suspect/selected ratios
-    # if we ever want to do non-uniform scanning..
 
-    # FIXME: Add failed in here somehow..
-    susp_reasons = self.suspect_reasons.values()
-    susp_reasons.sort(lambda x, y:
-       cmp(y.total_suspected(), x.total_suspected()))
-    self.write_reasons(f, susp_reasons, "Suspect Reasons")
-
-    fail_reasons = self.failed_reasons.values()
-    fail_reasons.sort(lambda x, y:
-       cmp(y.total_failed(), x.total_failed()))
-    self.write_reasons(f, fail_reasons, "Failed Reasons")
-    f.close()
-
-    # FIXME: sort+print by circ extend time
+  def _write_sorted_cols(self, f, cols):
+    "_write_sorted(), with the sort orders computed from 'cols'"
+    self.write_routers(f, cols.order(cols.strm_bw_ratio()), "Stream Ratios")
+    self.write_routers(f, cols.order(cols.bw_ratio(), True),
+                       "Bandwidth Ratios")
+    failed = cols.circ_failed+cols.strm_failed
+    failed_order = numpy.argsort(-failed, kind="mergesort")
+    self.write_routers(f, [cols.routers[i] for i in failed_order],
+                       "Failed Counts")
+    # Suspected includes failed
+    suspected = failed+cols.circ_suspected+cols.strm_suspected
+    susp_order = numpy.argsort(-suspected, kind="mergesort")
+    self.write_routers(f, [cols.routers[i] for i in susp_order],
+                       "Suspected Counts")
+    # The rate tables are re-sorts of the count tables
+    fph = cols.failed_per_hour()[failed_order]
+    self.write_routers(f, [cols.routers[i] for i in
+          failed_order[numpy.argsort(-fph, kind="mergesort")]], "Fail Rates")
+    sph = cols.suspected_per_hour()[susp_order]
+    self.write_routers(f, [cols.routers[i] for i in
+          susp_order[numpy.argsort(-sph, kind="mergesort")]], "Suspect Rates")
 
   def reset(self):
     PathSupport.PathBuilder.reset(self)
@@ -678,6 +906,26 @@ class StatsHandler(PathSupport.PathBuilder):
       r.circ_chosen += 1
       r.circ_succeeded += 1
 
+  def _count_reason(self, r, reason, failed):
+    """Count a failure (or suspected failure, if 'failed' is False) of
+       router 'r' for 'reason', keeping the totals of the reason lists
+       current."""
+    if failed: counts = r.reason_failed
+    else: counts = r.reason_suspected
+    if not reason in counts: counts[reason] = 1
+    else: counts[reason] += 1
+    for rlist in (self.failed_reasons.get(reason),
+                  self.suspect_reasons.get(reason)):
+      if rlist: rlist.count_r(r, failed)
+    if failed:
+      if reason not in self.failed_reasons:
+        self.failed_reasons[reason] = FailedRouterList(reason)
+      self.failed_reasons[reason].add_r(r)
+    else:
+      if reason not in self.suspect_reasons:
+        self.suspect_reasons[reason] = SuspectRouterList(reason)
+      self.suspect_reasons[reason].add_r(r)
+
   def circ_status_event(self, c):
     if c.circ_id in self.circuits:
       # TODO: Hrmm, consider making this sane in TorCtl.
@@ -710,12 +958,7 @@ class StatsHandler(PathSupport.PathBuilder):
         # XXX: Differentiate between extender and extendee
         for r in self.circuits[c.circ_id].path[start_f:len(c.path)+1]:
           r.circ_failed += 1
-          if not reason in r.reason_failed:
-            r.reason_failed[reason] = 1
-          else: r.reason_failed[reason]+=1
-          if reason not in self.failed_reasons:
-             self.failed_reasons[reason] = FailedRouterList(reason)
-          self.failed_reasons[reason].add_r(r)
+          self._count_reason(r, reason, True)
 
         for r in self.circuits[c.circ_id].path[len(c.path)+1:]:
           r.circ_uncounted += 1
@@ -724,12 +967,7 @@ class StatsHandler(PathSupport.PathBuilder):
         # suspected..
         for r in self.circuits[c.circ_id].path[:start_f]:
           r.circ_suspected += 1
-          if not reason in r.reason_suspected:
-            r.reason_suspected[reason] = 1
-          else: r.reason_suspected[reason]+=1
-          if reason not in self.suspect_reasons:
-             self.suspect_reasons[reason] = SuspectRouterList(reason)
-          self.suspect_reasons[reason].add_r(r)
+          self._count_reason(r, reason, False)
       elif c.status == "CLOSED":
         # Since PathBuilder deletes the circuit on a failed, 
         # we only get this for a clean close that was not
@@ -744,37 +982,23 @@ class StatsHandler(PathSupport.PathBuilder):
             if lreason in ("REQUESTED", "FINISHED", "ORIGIN"):
               r.circ_succeeded += 1
             else:
-              if not reason in r.reason_suspected:
-                r.reason_suspected[reason] = 1
-              else: r.reason_suspected[reason] += 1
               r.circ_suspected+= 1
-              if reason not in self.suspect_reasons:
-                self.suspect_reasons[reason] = SuspectRouterList(reason)
-              self.suspect_reasons[reason].add_r(r)
+              self._count_reason(r, reason, False)
     PathBuilder.circ_status_event(self, c)
 
   def count_stream_reason_failed(self, s, reason):
     "Count the routers involved in a failure"
     # Update failed count,reason_failed for exit
     r = self.circuits[s.circ_id].exit
-    if not reason in r.reason_failed: r.reason_failed[reason] = 1
-    else: r.reason_failed[reason]+=1
     r.strm_failed += 1
-    if reason not in self.failed_reasons:
-      self.failed_reasons[reason] = FailedRouterList(reason)
-    self.failed_reasons[reason].add_r(r)
+    self._count_reason(r, reason, True)
 
   def count_stream_suspects(self, s, lreason, reason):
     "Count the routers 'suspected' of being involved in a failure"
     if lreason in ("TIMEOUT", "INTERNAL", "TORPROTOCOL" "DESTROY"):
       for r in self.circuits[s.circ_id].path[:-1]:
         r.strm_suspected += 1
-        if not reason in r.reason_suspected:
-          r.reason_suspected[reason] = 1
-        else: r.reason_suspected[reason]+=1
-        if reason not in self.suspect_reasons:
-          self.suspect_reasons[reason] = SuspectRouterList(reason)
-        self.suspect_reasons[reason].add_r(r)
+        self._count_reason(r, reason, False)
     else:
       for r in self.circuits[s.circ_id].path[:-1]:
         r.strm_uncounted += 1
@@ -22,13 +22,14 @@ classes and constants for each event.
 """
 
 __all__ = ["EVENT_TYPE", "TorCtlError", "TorCtlClosed", "ProtocolError",
-           "ErrorReply", "NetworkStatus", "ExitPolicyLine", "Router",
+           "ErrorReply", "NetworkStatus", "ExitPolicyLine", "ExitPolicy", "Router",
            "RouterVersion", "Connection", "parse_ns_body",
            "EventHandler", "DebugEventHandler", "NetworkStatusEvent",
            "NewDescEvent", "CircuitEvent", "StreamEvent", "ORConnEvent",
            "StreamBwEvent", "LogEvent", "AddrMapEvent", "BWEvent",
            "BuildTimeoutSetEvent", "UnknownEvent", "ConsensusTracker",
-           "EventListener", "EVENT_STATE" ]
+           "EventListener", "EVENT_STATE", "SortedRouterList",
+           "FrozenRouterList" ]
 
 import os
 import re
@@ -36,6 +37,7 @@ import struct
 import sys
 import threading
 import Queue
+import bisect
 import datetime
 import traceback
 import socket
@@ -43,6 +45,9 @@ import binascii
 import types
 import time
 import copy
+import marshal
+import zlib
+import weakref
 
 from TorUtil import *
 
@@ -95,8 +100,42 @@ class ErrorReply(TorCtlError):
   "Raised when Tor controller returns an error"
   pass
 
-class NetworkStatus:
+# Platform strings, flag sets and versions are shared by thousands of
+# routers. Keep one copy of each distinct value.
+_flag_sets = {}
+_versions = {}
+
+def _intern_str(s):
+  if type(s) == str: return intern(s)
+  return s
+
+def _intern_flags(flags):
+  "Return the shared tuple for the list of flags 'flags'"
+  flags = tuple(flags)
+  if flags not in _flag_sets:
+    _flag_sets[flags] = tuple(map(intern, flags))
+  return _flag_sets[flags]
+
+def _intern_version(version):
+  "Return the shared RouterVersion for the version string 'version'"
+  if version not in _versions:
+    _versions[version] = RouterVersion(version)
+  return _versions[version]
+
+class _Slotted(object):
+  """Base for the small per-router classes that use __slots__ instead of
+     a __dict__. Keeps them pickleable."""
+  __slots__ = ()
+  def __getstate__(self):
+    return dict([(k, getattr(self, k)) for k in self.__slots__
+                             if k != "__weakref__" and hasattr(self, k)])
+  def __setstate__(self, state):
+    for k, v in state.iteritems(): setattr(self, k, v)
+
+class NetworkStatus(_Slotted):
   "Filled in during NS events"
+  __slots__ = ("nickname", "idhash", "orhash", "ip", "orport", "dirport",
+               "flags", "idhex", "bandwidth", "updated")
   def __init__(self, nickname, idhash, orhash, updated, ip, orport, dirport, flags, bandwidth=None):
     self.nickname = nickname
     self.idhash = idhash
@@ -104,7 +143,7 @@ class NetworkStatus:
     self.ip = ip
     self.orport = int(orport)
     self.dirport = int(dirport)
-    self.flags = flags
+    self.flags = _intern_flags(flags)
     self.idhex = (self.idhash + "=").decode("base64").encode("hex").upper()
     self.bandwidth = bandwidth
     m = re.search(r"(\d+)-(\d+)-(\d+) (\d+):(\d+):(\d+)", updated)
@@ -231,9 +270,10 @@ class UnknownEvent(Event):
     Event.__init__(self, event_name)
     self.event_string = event_string
 
-class ExitPolicyLine:
+class ExitPolicyLine(_Slotted):
   """ Class to represent a line in a Router's exit policy in a way 
       that can be easily checked. """
+  __slots__ = ("match", "ip", "netmask", "port_low", "port_high")
   def __init__(self, match, ip_mask, port_low, port_high):
     self.match = match
     if ip_mask == "*":
@@ -279,9 +319,71 @@ class ExitPolicyLine:
     retr += str(self.port_low)+"-"+str(self.port_high)
     return retr
 
-class RouterVersion:
+class ExitPolicy(_Slotted):
+  """ A Router's exit policy: its ExitPolicyLines, in order. Many routers
+      publish byte-identical policies, so build_from_desc() shares one
+      ExitPolicy per distinct policy text (see get()), along with its 
+      compiled form and the answers it has already given. Don't modify
+      it. 'text' is the policy text it was built from by get(), or None.
+      A policy is only shared while some Router still uses it. """
+  __slots__ = ("lines", "text", "_compiled", "_answers", "__weakref__")
+  _policies = weakref.WeakValueDictionary() # policy text -> ExitPolicy
+  _MAX_ANSWERS = 4096
+
+  def __init__(self, lines):
+    self.lines = tuple(lines)
+    self.text = None
+    self._compiled = tuple(map(lambda l: 
+                   (l.netmask, l.ip, l.port_low, l.port_high, l.match),
+                   self.lines))
+    self._answers = {}
+
+  def get(policy):
+    """ Static method that returns the shared ExitPolicy for the list of
+    accept/reject descriptor lines 'policy'. The lines are only parsed
+    the first time a policy is seen. """
+    text = "\n".join(policy)
+    shared = ExitPolicy._policies.get(text)
+    if shared is None:
+      lines = []
+      for line in policy:
+        ac = re.search(r"^accept (\S+):([^-]+)(?:-(\d+))?", line)
+        rj = re.search(r"^reject (\S+):([^-]+)(?:-(\d+))?", line)
+        if ac:
+          lines.append(ExitPolicyLine(True, *ac.groups()))
+        elif rj:
+          lines.append(ExitPolicyLine(False, *rj.groups()))
+      shared = ExitPolicy(lines)
+      shared.text = text
+      ExitPolicy._policies[text] = shared
+    return shared
+  get = Callable(get)
+
+  def check(self, ip, port):
+    """ Returns True if the first line matching 'ip':'port' is an accept,
+    False if it is a reject, and -1 if no line matches. """
+    key = (ip, port)
+    ret = self._answers.get(key)
+    if ret is None:
+      ip = struct.unpack(">I", socket.inet_aton(ip))[0]
+      ret = -1
+      for (netmask, line_ip, port_low, port_high, match) in self._compiled:
+        if (ip & netmask) == line_ip and port_low <= port <= port_high:
+          ret = match
+          break
+      if len(self._answers) >= ExitPolicy._MAX_ANSWERS:
+        self._answers.clear()
+      self._answers[key] = ret
+    return ret
+
+  def __iter__(self): return iter(self.lines)
+  def __len__(self): return len(self.lines)
+  def __getitem__(self, i): return self.lines[i]
+
+class RouterVersion(_Slotted):
   """ Represents a Router's version. Overloads all comparison operators
       to check for newer, older, or equivalent versions. """
+  __slots__ = ("version", "ver_string")
   def __init__(self, version):
     if version:
       v = re.search("^(\d+).(\d+).(\d+).(\d+)", version).groups()
@@ -307,8 +409,12 @@ class Router:
   """     
   def __init__(self, *args):
     if len(args) == 1:
+      # Everything but the per-router containers is immutable (and
+      # often shared with other routers), so a shallow copy will do.
       for i in args[0].__dict__:
-        self.__dict__[i] =  copy.deepcopy(args[0].__dict__[i])
+        v = args[0].__dict__[i]
+        if type(v) == list or type(v) == dict: v = copy.copy(v)
+        self.__dict__[i] = v
       return
     else:
       (idhex, name, bw, down, exitpolicy, flags, ip, version, os, uptime, published, contact, rate_limited, orhash, ns_bandwidth) = args
@@ -319,20 +425,23 @@ class Router:
     else:
       self.bw = bw
     self.desc_bw = bw
+    if not isinstance(exitpolicy, ExitPolicy):
+      exitpolicy = ExitPolicy(exitpolicy)
     self.exitpolicy = exitpolicy
-    self.flags = flags # Technicaly from NS doc
+    self.flags = _intern_flags(flags) # Technicaly from NS doc
     self.down = down
     self.ip = struct.unpack(">I", socket.inet_aton(ip))[0]
-    self.version = RouterVersion(version)
-    self.os = os
+    self.version = _intern_version(version)
+    self.os = _intern_str(os)
     self.list_rank = 0 # position in a sorted list of routers.
     self.uptime = uptime
     self.published = published
     self.refcount = 0 # How many open circs are we currently in?
     self.deleted = False # Has Tor already deleted this descriptor?
-    self.contact = contact
+    self.contact = _intern_str(contact)
     self.rate_limited = rate_limited
     self.orhash = orhash
+    self.hibernating = False # From 'opt hibernating' in the descriptor
     self._generated = [] # For ExactUniformGenerator
 
   def __str__(self):
@@ -350,7 +459,7 @@ class Router:
     # XXX: Compile these regular expressions? This is an expensive process
     # Use http://docs.python.org/lib/profile.html to verify this is 
     # the part of startup that is slow
-    exitpolicy = []
+    policy = []
     dead = not ("Running" in ns.flags)
     bw_observed = 0
     version = None
@@ -360,26 +469,25 @@ class Router:
     router = "[none]"
     published = "never"
     contact = None
+    hibernating = False
 
     for line in desc:
+      if line.startswith("accept ") or line.startswith("reject "):
+        policy.append(line.rstrip())
+        continue
       rt = re.search(r"^router (\S+) (\S+)", line)
       fp = re.search(r"^opt fingerprint (.+).*on (\S+)", line)
       pl = re.search(r"^platform Tor (\S+).*on ([\S\s]+)", line)
-      ac = re.search(r"^accept (\S+):([^-]+)(?:-(\d+))?", line)
-      rj = re.search(r"^reject (\S+):([^-]+)(?:-(\d+))?", line)
       bw = re.search(r"^bandwidth (\d+) \d+ (\d+)", line)
       up = re.search(r"^uptime (\d+)", line)
       ct = re.search(r"^contact (.+)", line)
       pb = re.search(r"^published (\S+ \S+)", line)
       if re.search(r"^opt hibernating 1", line):
         dead = True 
+        hibernating = True
         if ("Running" in ns.flags):
           plog("INFO", "Hibernating router "+ns.nickname+" is running, flags: "+" ".join(ns.flags))
-      if ac:
-        exitpolicy.append(ExitPolicyLine(True, *ac.groups()))
-      elif rj:
-        exitpolicy.append(ExitPolicyLine(False, *rj.groups()))
-      elif bw:
+      if bw:
         bws = map(int, bw.groups())
         bw_observed = min(bws)
         rate_limited = False
@@ -404,35 +512,64 @@ class Router:
       dead = True
     if not version or not os:
       plog("INFO", "No version and/or OS for router " + ns.nickname)
-    return Router(ns.idhex, ns.nickname, bw_observed, dead, exitpolicy,
+    r = Router(ns.idhex, ns.nickname, bw_observed, dead, 
+        ExitPolicy.get(policy),
         ns.flags, ip, version, os, uptime, published, contact, rate_limited,
         ns.orhash, ns.bandwidth)
+    r.hibernating = hibernating
+    return r
   build_from_desc = Callable(build_from_desc)
 
+  def update_from_ns(self, ns):
+    """ Refresh the fields that come from the NetworkStatus 'ns' (nickname,
+    flags, consensus bandwidth and liveness) without reparsing the 
+    descriptor. Only valid if ns.orhash matches our descriptor. """
+    self.nickname = ns.nickname
+    self.flags = ns.flags
+    if ns.bandwidth != None:
+      self.bw = ns.bandwidth
+    else:
+      self.bw = self.desc_bw
+    self.down = not ("Running" in ns.flags) or self.hibernating or \
+                (not self.desc_bw and ("Valid" in ns.flags))
+    self.deleted = False
+
   def update_to(self, new):
     """ Somewhat hackish method to update this router to be a copy of
     'new' """
     if self.idhex != new.idhex:
       plog("ERROR", "Update of router "+self.nickname+"changes idhex!")
-    plog("DEBUG", "Updating refcount "+str(self.refcount)+" for "+self.idhex)
+    plog("DEBUG", "Updating refcount %d for %s", self.refcount, self.idhex)
     for i in new.__dict__.iterkeys():
       if i == "refcount" or i == "_generated": continue
       self.__dict__[i] = new.__dict__[i]
-    plog("DEBUG", "Updated refcount "+str(self.refcount)+" for "+self.idhex)
+    plog("DEBUG", "Updated refcount %d for %s", self.refcount, self.idhex)
 
   def will_exit_to(self, ip, port):
     """ Check the entire exitpolicy to see if the router will allow
         connections to 'ip':'port' """
-    for line in self.exitpolicy:
-      ret = line.check(ip, port)
-      if ret != -1:
-        return ret
+    ret = self.exitpolicy.check(ip, port)
+    if ret != -1:
+      return ret
     plog("WARN", "No matching exit line for "+self.nickname)
     return False
    
+# Commands whose arguments are credentials, which recordings leave out
+_SECRET_COMMANDS = ("AUTHENTICATE", "AUTHCHALLENGE")
+
+def _scrub_secrets(line):
+  "Return the sent 'line' with the arguments of _SECRET_COMMANDS removed"
+  parts = line.split(None, 1)
+  if len(parts) == 2 and parts[0].upper() in _SECRET_COMMANDS:
+    return parts[0]+" [scrubbed]"+line[len(line.rstrip("\r\n")):]
+  return line
+
 class Connection:
   """A Connection represents a connection to the Tor process via the 
      control port."""
+  # Maximum number of commands read_routers() pipelines at once
+  _PIPELINE_BATCH = 256
+
   def __init__(self, sock):
     """Create a Connection to communicate with the Tor process over the
        socket 'sock'.
@@ -449,6 +586,9 @@ class Connection:
     self._eventQueue = Queue.Queue()
     self._s = BufSock(sock)
     self._debugFile = None
+    self._recordFile = None
+    self._recordLock = threading.Lock()
+    self._recordStart = 0
 
   def set_close_handler(self, handler):
     """Call 'handler' when the Tor process has closed its connection or
@@ -621,17 +761,97 @@ class Connection:
 
     return reply
 
+  def _sendManyImpl(self, sendFn, msgs):
+    """Pipelined version of _sendImpl: writes all of 'msgs' back to back
+       and then waits for all of their replies. Tor answers commands in
+       order, so the replies are matched to their callbacks through
+       self._queue exactly as for single commands. Returns the list of
+       replies in the order of 'msgs'."""
+    if self._thread is None and not self._closed:
+      self.launch_thread(1)
+    # This condition will get notified when the last result is in...
+    condition = threading.Condition()
+    result = [None]*len(msgs)
+    pending = [len(msgs)]
+
+    if self._closedEx is not None:
+      raise self._closedEx
+    elif self._closed:
+      raise TorCtlClosed()
+
+    def make_cb(i):
+      def cb(reply,condition=condition,result=result,pending=pending):
+        condition.acquire()
+        try:
+          result[i] = reply
+          pending[0] -= 1
+          if not pending[0]:
+            condition.notify()
+        finally:
+          condition.release()
+      return cb
+
+    self._sendLock.acquire() # ensure queue+sendmsg is atomic
+    try:
+      for i in xrange(len(msgs)):
+        self._queue.put(make_cb(i))
+      sendFn("".join(msgs))
+    finally:
+      self._sendLock.release()
+
+    condition.acquire()
+    try:
+      while pending[0]:
+        condition.wait()
+    finally:
+      condition.release()
+
+    for reply in result:
+      if reply == "EXCEPTION":
+        raise self._closedEx
+
+    return result
 
   def debug(self, f):
     """DOCDOC"""
     self._debugFile = f
 
+  def record(self, f):
+    """Append all raw control port traffic to the file object 'f', or
+       stop recording if 'f' is None. Each line is stored as the
+       milliseconds since recording started, '<' for received or '>'
+       for sent, and the line as it went over the wire, except that the
+       arguments of AUTHENTICATE and AUTHCHALLENGE are left out. See
+       ReplaySupport for reading it back."""
+    self._recordLock.acquire()
+    try:
+      if f:
+        self._recordStart = time.time()
+        f.write("#TORCTL-RECORDING %.3f\n" % self._recordStart)
+      self._recordFile = f
+    finally:
+      self._recordLock.release()
+
+  def _record(self, direction, lines):
+    self._recordLock.acquire()
+    try:
+      f = self._recordFile
+      if not f: return
+      ms = int((time.time()-self._recordStart)*1000)
+      for line in lines:
+        if direction == ">": line = _scrub_secrets(line)
+        if not line.endswith("\n"): line += "\n"
+        f.write("%d%s%s" % (ms, direction, line))
+    finally:
+      self._recordLock.release()
+
   def set_event_handler(self, handler):
     """Cause future events from the Tor process to be sent to 'handler'.
     """
     if self._handler:
       handler.pre_listeners = self._handler.pre_listeners
       handler.post_listeners = self._handler.post_listeners
+      handler._skip = None
     self._handler = handler
     self._handler.c = self
     self._handleFn = handler._handle1
@@ -648,6 +868,8 @@ class Connection:
       if not line:
         self._closed = True
         raise TorCtlClosed() 
+      if self._recordFile:
+        self._record("<", (line,))
       line = line.strip()
       if self._debugFile:
         self._debugFile.write(str(time.time())+"\t  %s\n" % line)
@@ -668,6 +890,8 @@ class Connection:
         more = []
         while 1:
           line = self._s.readline()
+          if self._recordFile and line:
+            self._record("<", (line,))
           if self._debugFile:
             self._debugFile.write("+++ %s" % line)
           if line in (".\r\n", ".\n", "650 OK\n", "650 OK\r\n"): 
@@ -688,6 +912,8 @@ class Connection:
       if len(lines) > 2:
         amsg = "\n".join(lines[:2]) + "\n"
       self._debugFile.write(str(time.time())+"\t>>> "+amsg)
+    if self._recordFile:
+      self._record(">", msg.splitlines(True))
     self._s.write(msg)
 
   def set_timer(self, in_seconds, type=None):
@@ -724,6 +950,32 @@ class Connection:
 
     return lines
 
+  def sendAndRecvMany(self, msgs, expectedTypes=("250", "251")):
+    """Pipelined version of sendAndRecv: send all commands in 'msgs'
+       without waiting for each reply in between, and return a list with
+       one entry per command. Each entry is either the list of 
+       (tp,body,extra) tuples for that command or, if Tor answered it with
+       an error, the ErrorReply instance, so that one failing command does
+       not lose the replies to the others. Raises ProtocolError on
+       unexpected reply types.
+    """
+    for msg in msgs:
+      assert msg.endswith("\r\n")
+    if not msgs:
+      return []
+
+    ret = []
+    for lines in self._sendManyImpl(self._doSend, msgs):
+      reply = lines
+      for tp, msg, _ in lines:
+        if tp[0] in '45':
+          reply = ErrorReply("%s %s"%(tp, msg))
+          break
+        if tp not in expectedTypes:
+          raise ProtocolError("Unexpectd message type %r"%tp)
+      ret.append(reply)
+    return ret
+
   def authenticate(self, secret=""):
     """Sends an authenticating secret (password) to Tor.  You'll need to call 
        this method (or authenticate_cookie) before Tor can start.
@@ -790,6 +1042,19 @@ class Connection:
        TorCtl.NetworkStatus instances."""
     return parse_ns_body(self.sendAndRecv("GETINFO ns/"+who+"\r\n")[0][2])
 
+  def get_network_statuses(self, wholist):
+    """Pipelined version of get_network_status for several 'who's at once.
+       Returns a list with, for each entry of 'wholist', either its list of
+       TorCtl.NetworkStatus instances or the ErrorReply Tor answered with."""
+    ret = []
+    msgs = map(lambda who: "GETINFO ns/"+who+"\r\n", wholist)
+    for lines in self.sendAndRecvMany(msgs):
+      if isinstance(lines, ErrorReply):
+        ret.append(lines)
+      else:
+        ret.append(parse_ns_body(lines[0][2]))
+    return ret
+
   def get_address_mappings(self, type="all"):
     # TODO: Also parse errors and GMTExpiry
     body = self.sendAndRecv("GETINFO address-mappings/"+type+"\r\n")
@@ -823,6 +1088,11 @@ class Connection:
   def get_router(self, ns):
     """Fill in a Router class corresponding to a given NS class"""
     desc = self.sendAndRecv("GETINFO desc/id/" + ns.idhex + "\r\n")[0][2]
+    return self._build_router(desc, ns)
+
+  def _build_router(self, desc, ns):
+    """Parse 'desc' into a Router for 'ns', or return None if the
+       descriptor does not match the ns fingerprint."""
     sig_start = desc.find("\nrouter-signature\n")+len("\nrouter-signature\n")
     fp_base64 = sha1(desc[:sig_start]).digest().encode("base64")[:-2]
     r = Router.build_from_desc(desc.split("\n"), ns)
@@ -839,18 +1109,25 @@ class Connection:
     """
     bad_key = 0
     new = []
-    for ns in nslist:
-      try:
-        r = self.get_router(ns)
-        if r: new.append(r)
-      except ErrorReply:
-        bad_key += 1
-        if "Running" in ns.flags:
-          plog("NOTICE", "Running router "+ns.nickname+"="
-             +ns.idhex+" has no descriptor")
-      except:
-        traceback.print_exception(*sys.exc_info())
-        continue
+    # The GETINFOs are pipelined in batches, so reading a full consensus
+    # is bound by bandwidth rather than by one round trip per router.
+    for b in xrange(0, len(nslist), self._PIPELINE_BATCH):
+      batch = nslist[b:b+self._PIPELINE_BATCH]
+      replies = self.sendAndRecvMany(map(lambda ns:
+                     "GETINFO desc/id/" + ns.idhex + "\r\n", batch))
+      for ns, lines in zip(batch, replies):
+        if isinstance(lines, ErrorReply):
+          bad_key += 1
+          if "Running" in ns.flags:
+            plog("NOTICE", "Running router "+ns.nickname+"="
+               +ns.idhex+" has no descriptor")
+          continue
+        try:
+          r = self._build_router(lines[0][2], ns)
+          if r: new.append(r)
+        except:
+          traceback.print_exception(*sys.exc_info())
+          continue
   
     return new
 
@@ -861,7 +1138,25 @@ class Connection:
     """
     if not isinstance(name, str):
       name = " ".join(name)
-    lines = self.sendAndRecv("GETINFO %s\r\n"%name)
+    return self._parse_info(self.sendAndRecv("GETINFO %s\r\n"%name))
+
+  def get_infos(self, names):
+    """Pipelined version of get_info for several names at once. Returns a
+       list with, for each entry of 'names', either the dict get_info would
+       return or the ErrorReply Tor answered with."""
+    ret = []
+    for b in xrange(0, len(names), self._PIPELINE_BATCH):
+      msgs = map(lambda name: "GETINFO %s\r\n"%name,
+                 names[b:b+self._PIPELINE_BATCH])
+      for lines in self.sendAndRecvMany(msgs):
+        if isinstance(lines, ErrorReply):
+          ret.append(lines)
+        else:
+          ret.append(self._parse_info(lines))
+    return ret
+
+  def _parse_info(self, lines):
+    "Turn the reply lines of a GETINFO into a dict"
     d = {}
     for _,msg,more in lines:
       if msg == "OK":
@@ -958,10 +1253,11 @@ class Connection:
     """
     if hop:
       self.sendAndRecv("ATTACHSTREAM %d %d HOP=%d\r\n"%(streamid, circid, hop))
-      plog("DEBUG", "Attaching stream: "+str(streamid)+" to hop "+str(hop)+" of circuit "+str(circid))
+      plog("DEBUG", "Attaching stream: %s to hop %s of circuit %s", streamid,
+           hop, circid)
     else:
       self.sendAndRecv("ATTACHSTREAM %d %d\r\n"%(streamid, circid))
-      plog("DEBUG", "Attaching stream: "+str(streamid)+" to circuit "+str(circid))
+      plog("DEBUG", "Attaching stream: %s to circuit %s", streamid, circid)
 
   def close_stream(self, streamid, reason=0, flags=()):
     """DOCDOC"""
@@ -995,6 +1291,189 @@ def parse_ns_body(data):
       nslist.append(NetworkStatus(*(m.groups() + (flags,))))
   return nslist
 
+# Event decoders, keyed by event type. Each takes the event type, the rest
+# of the first reply line and the data block, and returns an Event.
+_circ_re = re.compile(r"(\d+)\s+(\S+)(\s\S+)?(\s\S+)?(\s\S+)?(\s\S+)?")
+_stream_re = re.compile(r"(\S+)\s+(\S+)\s+(\S+)\s+(\S+)?:(\d+)(\sREASON=\S+)?(\sREMOTE_REASON=\S+)?(\sSOURCE=\S+)?(\sSOURCE_ADDR=\S+)?(\s+PURPOSE=\S+)?")
+_orconn_re = re.compile(r"(\S+)\s+(\S+)(\sAGE=\S+)?(\sREAD=\S+)?(\sWRITTEN=\S+)?(\sREASON=\S+)?(\sNCIRCS=\S+)?")
+_addrmap_re = re.compile(r'(\S+)\s+(\S+)\s+(\"[^"]+\"|\w+)')
+_buildtimeout_re = re.compile(r"(\S+)\sTOTAL_TIMES=(\d+)\sTIMEOUT_MS=(\d+)\sXM=(\d+)\sALPHA=(\S+)\sCUTOFF_QUANTILE=(\S+)")
+_guard_re = re.compile(r"(\S+)\s(\S+)\s(\S+)")
+
+def _decode_circ(evtype, body, data):
+  m = _circ_re.match(body)
+  if not m:
+    raise ProtocolError("CIRC event misformatted.")
+  ident,status,path,purpose,reason,remote = m.groups()
+  ident = int(ident)
+  if path:
+    if "PURPOSE=" in path:
+      remote = reason
+      reason = purpose
+      purpose=path
+      path=[]
+    elif "REASON=" in path:
+      remote = reason
+      reason = path
+      purpose = ""
+      path=[]
+    else:
+      path_verb = path.strip().split(",")
+      path = []
+      for p in path_verb:
+        path.append(p.replace("~", "=").split("=")[0])
+  else:
+    path = []
+
+  if purpose and "REASON=" in purpose:
+    remote=reason
+    reason=purpose
+    purpose=""
+
+  if purpose: purpose = purpose[9:]
+  if reason: reason = reason[8:]
+  if remote: remote = remote[15:]
+  return CircuitEvent(evtype, ident, status, path, purpose, reason, remote)
+
+def _decode_stream(evtype, body, data):
+  m = _stream_re.match(body)
+  if not m:
+    raise ProtocolError("STREAM event misformatted.")
+  ident,status,circ,target_host,target_port,reason,remote,source,source_addr,purpose = m.groups()
+  ident,circ = int(ident),int(circ)
+  if not target_host: # This can happen on SOCKS_PROTOCOL failures
+    target_host = "(none)"
+  if reason: reason = reason[8:]
+  if remote: remote = remote[15:]
+  if source: source = source[8:]
+  if source_addr: source_addr = source_addr[13:]
+  if purpose:
+    purpose = purpose.lstrip()
+    purpose = purpose[8:]
+  return StreamEvent(evtype, ident, status, circ, target_host,
+           int(target_port), reason, remote, source, source_addr, purpose)
+
+def _decode_orconn(evtype, body, data):
+  m = _orconn_re.match(body)
+  if not m:
+    raise ProtocolError("ORCONN event misformatted.")
+  target, status, age, read, wrote, reason, ncircs = m.groups()
+
+  if ncircs: ncircs = int(ncircs[8:])
+  else: ncircs = 0
+  if reason: reason = reason[8:]
+  if age: age = int(age[5:])
+  else: age = 0
+  if read: read = int(read[6:])
+  else: read = 0
+  if wrote: wrote = int(wrote[9:])
+  else: wrote = 0
+  return ORConnEvent(evtype, status, target, age, read, wrote,
+            reason, ncircs)
+
+def _decode_stream_bw(evtype, body, data):
+  # One of the most frequent events: split instead of a regexp
+  f = body.split(None, 3)
+  if len(f) < 3 or not (f[0].isdigit() and f[1].isdigit() and f[2].isdigit()):
+    raise ProtocolError("STREAM_BW event misformatted.")
+  return StreamBwEvent(evtype, f[0], f[1], f[2])
+
+def _decode_bw(evtype, body, data):
+  f = body.split(None, 2)
+  if len(f) < 2 or not (f[0].isdigit() and f[1].isdigit()):
+    raise ProtocolError("BANDWIDTH event misformatted.")
+  return BWEvent(evtype, long(f[0]), long(f[1]))
+
+def _decode_log(evtype, body, data):
+  return LogEvent(evtype, body)
+
+def _decode_newdesc(evtype, body, data):
+  ids = []
+  for i in body.split(" "):
+    ids.append(i.replace("~", "=").split("=")[0].replace("$",""))
+  return NewDescEvent(evtype, ids)
+
+def _decode_addrmap(evtype, body, data):
+  # TODO: Also parse errors and GMTExpiry
+  m = _addrmap_re.match(body)
+  if not m:
+    raise ProtocolError("ADDRMAP event misformatted.")
+  fromaddr, toaddr, when = m.groups()
+  if when.upper() == "NEVER":  
+    when = None
+  else:
+    when = time.strptime(when[1:-1], "%Y-%m-%d %H:%M:%S")
+  return AddrMapEvent(evtype, fromaddr, toaddr, when)
+
+def _decode_ns(evtype, body, data):
+  return NetworkStatusEvent(evtype, parse_ns_body(data))
+
+def _decode_newconsensus(evtype, body, data):
+  return NewConsensusEvent(evtype, parse_ns_body(data))
+
+def _decode_buildtimeout_set(evtype, body, data):
+  m = _buildtimeout_re.match(body)
+  set_type, total_times, timeout_ms, xm, alpha, quantile = m.groups()
+  return BuildTimeoutSetEvent(evtype, set_type, int(total_times),
+                               int(timeout_ms), int(xm), float(alpha),
+                               float(quantile))
+
+def _decode_guard(evtype, body, data):
+  m = _guard_re.match(body)
+  entry, guard, status = m.groups()
+  return GuardEvent(evtype, entry, guard, status)
+
+def _decode_timer(evtype, body, data):
+  return TimerEvent(evtype, data)
+
+_event_decoders = {
+  "CIRC" : _decode_circ,
+  "STREAM" : _decode_stream,
+  "ORCONN" : _decode_orconn,
+  "STREAM_BW" : _decode_stream_bw,
+  "BW" : _decode_bw,
+  "DEBUG" : _decode_log,
+  "INFO" : _decode_log,
+  "NOTICE" : _decode_log,
+  "WARN" : _decode_log,
+  "ERR" : _decode_log,
+  "NEWDESC" : _decode_newdesc,
+  "ADDRMAP" : _decode_addrmap,
+  "NS" : _decode_ns,
+  "NEWCONSENSUS" : _decode_newconsensus,
+  "BUILDTIMEOUT_SET" : _decode_buildtimeout_set,
+  "GUARD" : _decode_guard,
+  "TORCTL_TIMER" : _decode_timer
+  }
+
+# EventSink method that handles each event type
+_event_methods = {
+  "CIRC" : "circ_status_event",
+  "STREAM" : "stream_status_event",
+  "ORCONN" : "or_conn_status_event",
+  "STREAM_BW" : "stream_bw_event",
+  "BW" : "bandwidth_event",
+  "DEBUG" : "msg_event",
+  "INFO" : "msg_event",
+  "NOTICE" : "msg_event",
+  "WARN" : "msg_event",
+  "ERR" : "msg_event",
+  "NEWDESC" : "new_desc_event",
+  "ADDRMAP" : "address_mapped_event",
+  "NS" : "ns_event",
+  "NEWCONSENSUS" : "new_consensus_event",
+  "BUILDTIMEOUT_SET" : "buildtimeout_set_event",
+  "GUARD" : "guard_event",
+  "TORCTL_TIMER" : "timer_event"
+  }
+
+def _event_map(sink):
+  "Map event types to the bound handler methods of 'sink'"
+  m = {}
+  for evtype, name in _event_methods.iteritems():
+    m[evtype] = getattr(sink, name)
+  return m
+
 class EventSink:
   def heartbeat_event(self, event): pass
   def unknown_event(self, event): pass
@@ -1023,25 +1502,7 @@ class EventListener(EventSink):
      """
   def __init__(self):
     """Create a new EventHandler."""
-    self._map1 = {
-      "CIRC" : self.circ_status_event,
-      "STREAM" : self.stream_status_event,
-      "ORCONN" : self.or_conn_status_event,
-      "STREAM_BW" : self.stream_bw_event,
-      "BW" : self.bandwidth_event,
-      "DEBUG" : self.msg_event,
-      "INFO" : self.msg_event,
-      "NOTICE" : self.msg_event,
-      "WARN" : self.msg_event,
-      "ERR" : self.msg_event,
-      "NEWDESC" : self.new_desc_event,
-      "ADDRMAP" : self.address_mapped_event,
-      "NS" : self.ns_event,
-      "NEWCONSENSUS" : self.new_consensus_event,
-      "BUILDTIMEOUT_SET" : self.buildtimeout_set_event,
-      "GUARD" : self.guard_event,
-      "TORCTL_TIMER" : self.timer_event
-      }
+    self._map1 = _event_map(self)
     self.parent_handler = None
     self._sabotage()
 
@@ -1068,32 +1529,35 @@ class EventHandler(EventSink):
      class."""
   def __init__(self):
     """Create a new EventHandler."""
-    self._map1 = {
-      "CIRC" : self.circ_status_event,
-      "STREAM" : self.stream_status_event,
-      "ORCONN" : self.or_conn_status_event,
-      "STREAM_BW" : self.stream_bw_event,
-      "BW" : self.bandwidth_event,
-      "DEBUG" : self.msg_event,
-      "INFO" : self.msg_event,
-      "NOTICE" : self.msg_event,
-      "WARN" : self.msg_event,
-      "ERR" : self.msg_event,
-      "NEWDESC" : self.new_desc_event,
-      "ADDRMAP" : self.address_mapped_event,
-      "NS" : self.ns_event,
-      "NEWCONSENSUS" : self.new_consensus_event,
-      "BUILDTIMEOUT_SET" : self.buildtimeout_set_event,
-      "GUARD" : self.guard_event,
-      "TORCTL_TIMER" : self.timer_event
-      }
+    self._map1 = _event_map(self)
     self.c = None # Gets set by Connection.set_event_hanlder()
     self.pre_listeners = []
     self.post_listeners = []
+    self._skip = None
+
+  def _skipped_events(self):
+    """Return the set of event types that neither this handler nor any
+       of its listeners do anything with, so they need not be decoded.
+       Nothing is skipped if a heartbeat_event is overridden."""
+    sinks = [self] + self.pre_listeners + self.post_listeners
+    skip = set()
+    for s in sinks:
+      if not _is_noop(s, "heartbeat_event"):
+        return skip
+    for evtype, name in _event_methods.iteritems():
+      for s in sinks:
+        if not _is_noop(s, name): break
+      else:
+        skip.add(evtype)
+    return skip
 
   def _handle1(self, timestamp, lines):
     """Dispatcher: called from Connection when an event is received."""
+    if self._skip is None:
+      self._skip = self._skipped_events()
     for code, msg, data in lines:
+      if self._skip and msg.split(" ",1)[0].upper() in self._skip:
+        continue
       event = self._decode1(msg, data)
       event.arrived_at = timestamp
       event.state=EVENT_STATE.PRELISTEN
@@ -1114,128 +1578,10 @@ class EventHandler(EventSink):
     else:
       evtype,body = body,""
     evtype = evtype.upper()
-    if evtype == "CIRC":
-      m = re.match(r"(\d+)\s+(\S+)(\s\S+)?(\s\S+)?(\s\S+)?(\s\S+)?", body)
-      if not m:
-        raise ProtocolError("CIRC event misformatted.")
-      ident,status,path,purpose,reason,remote = m.groups()
-      ident = int(ident)
-      if path:
-        if "PURPOSE=" in path:
-          remote = reason
-          reason = purpose
-          purpose=path
-          path=[]
-        elif "REASON=" in path:
-          remote = reason
-          reason = path
-          purpose = ""
-          path=[]
-        else:
-          path_verb = path.strip().split(",")
-          path = []
-          for p in path_verb:
-            path.append(p.replace("~", "=").split("=")[0])
-      else:
-        path = []
-
-      if purpose and "REASON=" in purpose:
-        remote=reason
-        reason=purpose
-        purpose=""
-
-      if purpose: purpose = purpose[9:]
-      if reason: reason = reason[8:]
-      if remote: remote = remote[15:]
-      event = CircuitEvent(evtype, ident, status, path, purpose, reason, remote)
-    elif evtype == "STREAM":
-      #plog("DEBUG", "STREAM: "+body)
-      m = re.match(r"(\S+)\s+(\S+)\s+(\S+)\s+(\S+)?:(\d+)(\sREASON=\S+)?(\sREMOTE_REASON=\S+)?(\sSOURCE=\S+)?(\sSOURCE_ADDR=\S+)?(\s+PURPOSE=\S+)?", body)
-      if not m:
-        raise ProtocolError("STREAM event misformatted.")
-      ident,status,circ,target_host,target_port,reason,remote,source,source_addr,purpose = m.groups()
-      ident,circ = map(int, (ident,circ))
-      if not target_host: # This can happen on SOCKS_PROTOCOL failures
-        target_host = "(none)"
-      if reason: reason = reason[8:]
-      if remote: remote = remote[15:]
-      if source: source = source[8:]
-      if source_addr: source_addr = source_addr[13:]
-      if purpose:
-        purpose = purpose.lstrip()
-        purpose = purpose[8:]
-      event = StreamEvent(evtype, ident, status, circ, target_host,
-               int(target_port), reason, remote, source, source_addr, purpose)
-    elif evtype == "ORCONN":
-      m = re.match(r"(\S+)\s+(\S+)(\sAGE=\S+)?(\sREAD=\S+)?(\sWRITTEN=\S+)?(\sREASON=\S+)?(\sNCIRCS=\S+)?", body)
-      if not m:
-        raise ProtocolError("ORCONN event misformatted.")
-      target, status, age, read, wrote, reason, ncircs = m.groups()
-
-      #plog("DEBUG", "ORCONN: "+body)
-      if ncircs: ncircs = int(ncircs[8:])
-      else: ncircs = 0
-      if reason: reason = reason[8:]
-      if age: age = int(age[5:])
-      else: age = 0
-      if read: read = int(read[6:])
-      else: read = 0
-      if wrote: wrote = int(wrote[9:])
-      else: wrote = 0
-      event = ORConnEvent(evtype, status, target, age, read, wrote,
-                reason, ncircs)
-    elif evtype == "STREAM_BW":
-      m = re.match(r"(\d+)\s+(\d+)\s+(\d+)", body)
-      if not m:
-        raise ProtocolError("STREAM_BW event misformatted.")
-      event = StreamBwEvent(evtype, *m.groups())
-    elif evtype == "BW":
-      m = re.match(r"(\d+)\s+(\d+)", body)
-      if not m:
-        raise ProtocolError("BANDWIDTH event misformatted.")
-      read, written = map(long, m.groups())
-      event = BWEvent(evtype, read, written)
-    elif evtype in ("DEBUG", "INFO", "NOTICE", "WARN", "ERR"):
-      event = LogEvent(evtype, body)
-    elif evtype == "NEWDESC":
-      ids_verb = body.split(" ")
-      ids = []
-      for i in ids_verb:
-        ids.append(i.replace("~", "=").split("=")[0].replace("$",""))
-      event = NewDescEvent(evtype, ids)
-    elif evtype == "ADDRMAP":
-      # TODO: Also parse errors and GMTExpiry
-      m = re.match(r'(\S+)\s+(\S+)\s+(\"[^"]+\"|\w+)', body)
-      if not m:
-        raise ProtocolError("ADDRMAP event misformatted.")
-      fromaddr, toaddr, when = m.groups()
-      if when.upper() == "NEVER":  
-        when = None
-      else:
-        when = time.strptime(when[1:-1], "%Y-%m-%d %H:%M:%S")
-      event = AddrMapEvent(evtype, fromaddr, toaddr, when)
-    elif evtype == "NS":
-      event = NetworkStatusEvent(evtype, parse_ns_body(data))
-    elif evtype == "NEWCONSENSUS":
-      event = NewConsensusEvent(evtype, parse_ns_body(data))
-    elif evtype == "BUILDTIMEOUT_SET":
-      m = re.match(
-        r"(\S+)\sTOTAL_TIMES=(\d+)\sTIMEOUT_MS=(\d+)\sXM=(\d+)\sALPHA=(\S+)\sCUTOFF_QUANTILE=(\S+)",
-        body)
-      set_type, total_times, timeout_ms, xm, alpha, quantile = m.groups()
-      event = BuildTimeoutSetEvent(evtype, set_type, int(total_times),
-                                   int(timeout_ms), int(xm), float(alpha),
-                                   float(quantile))
-    elif evtype == "GUARD":
-      m = re.match(r"(\S+)\s(\S+)\s(\S+)", body)
-      entry, guard, status = m.groups()
-      event = GuardEvent(evtype, entry, guard, status)
-    elif evtype == "TORCTL_TIMER":
-      event = TimerEvent(evtype, data)
-    else:
-      event = UnknownEvent(evtype, body)
-
-    return event
+    decode = _event_decoders.get(evtype)
+    if decode:
+      return decode(evtype, body, data)
+    return UnknownEvent(evtype, body)
 
   def add_event_listener(self, evlistener):
     if isinstance(evlistener, PreEventListener):
@@ -1243,6 +1589,7 @@ class EventHandler(EventSink):
     if isinstance(evlistener, PostEventListener):
       self.post_listeners.append(evlistener)
     evlistener.set_parent(self)
+    self._skip = None
 
   def heartbeat_event(self, event):
     """Called before any event is received. Convenience function
@@ -1311,6 +1658,108 @@ class EventHandler(EventSink):
   def timer_event(self, event):
     pass
 
+class FrozenRouterList(list):
+  """
+  A copy of a SortedRouterList as of one of its generations, made by
+  SortedRouterList.frozen_copy(). It carries that 'generation' along, so
+  that views derived from it can be cached. Do not modify it.
+  """
+  def __init__(self, routers, generation):
+    list.__init__(self, routers)
+    self.generation = generation
+
+class SortedRouterList(list):
+  """
+  A list of the running Routers sorted by descending bandwidth (ties
+  broken by idhex), kept in order incrementally. Routers are located by
+  bisection on the key they were inserted with, so a single router can be
+  added, removed or re-sorted after a bandwidth change without sorting
+  the whole list. list_rank is only reassigned from the first position
+  that changed, when update_ranks() is called.
+
+  It is a plain list otherwise, so it can be handed to NodeGenerators
+  and restrictions as is. Do not modify it with the list methods.
+
+  'generation' is bumped on every change, so that views derived from the
+  list (such as PathSupport.RouterColumns) know when to refresh.
+  """
+  def __init__(self, routers=()):
+    list.__init__(self)
+    self.generation = 0
+    self._keys = []
+    self._key_of = {} # idhex -> key the router is stored under
+    self._dirty = None # First position whose list_rank may be stale
+    self._frozen = None # FrozenRouterList of the current generation
+    self.rebuild(routers)
+
+  def _key(self, r):
+    return (-r.bw, r.idhex)
+
+  def __copy__(self):
+    # Copies are usually re-sorted by other criteria, so don't carry
+    # the index along.
+    return list(self)
+
+  def frozen_copy(self):
+    """Return a FrozenRouterList of the current contents. The list is only
+    copied again once it has changed, so callers in between share one
+    copy."""
+    if self._frozen is None or self._frozen.generation != self.generation:
+      self._frozen = FrozenRouterList(self, self.generation)
+    return self._frozen
+
+  def rebuild(self, routers):
+    """Replace the contents with the running routers in 'routers'"""
+    routers = [r for r in routers if not r.down]
+    routers.sort(lambda x, y: cmp(self._key(x), self._key(y)))
+    self[:] = routers
+    self._keys = map(self._key, routers)
+    self._key_of = {}
+    for r, k in zip(routers, self._keys):
+      self._key_of[r.idhex] = k
+    self._mark(0)
+    self.update_ranks()
+
+  def _mark(self, i):
+    self.generation += 1
+    if self._dirty is None or i < self._dirty:
+      self._dirty = i
+
+  def discard(self, idhex):
+    """Remove the router with 'idhex', if present"""
+    if idhex not in self._key_of: return
+    key = self._key_of.pop(idhex)
+    i = bisect.bisect_left(self._keys, key)
+    del self._keys[i]
+    del self[i]
+    self._mark(i)
+
+  def update(self, r):
+    """Insert, move or remove 'r' according to its current bw and down
+       state."""
+    if r.down:
+      self.discard(r.idhex)
+      return
+    key = self._key(r)
+    if self._key_of.get(r.idhex) == key:
+      # Same position, but the object or its flags may have changed
+      self[bisect.bisect_left(self._keys, key)] = r
+      self.generation += 1
+      return
+    self.discard(r.idhex)
+    i = bisect.bisect_left(self._keys, key)
+    self._keys.insert(i, key)
+    self.insert(i, r)
+    self._key_of[r.idhex] = key
+    self._mark(i)
+
+  def update_ranks(self):
+    """Reassign list_rank from the first position that changed"""
+    if self._dirty is None: return
+    for i in xrange(self._dirty, len(self)): self[i].list_rank = i
+    self._dirty = None
+    self.generation += 1
+
 class Consensus:
   """
   A Consensus is a pickleable container for the members of
@@ -1330,16 +1779,127 @@ class ConsensusTracker(EventHandler):
   """
   A ConsensusTracker is an EventHandler that tracks the current
   consensus of Tor in self.ns_map, self.routers and self.sorted_r
+
+  If 'snapshot_file' is given, the parsed consensus and descriptors are
+  saved there after every consensus, and loaded from there on startup.
+  Only the descriptors whose digest changed since the snapshot are then
+  fetched from Tor.
   """
-  def __init__(self, c, RouterClass=Router):
+  _SNAPSHOT_MAGIC = "TORCTL-SNAPSHOT\n"
+  _SNAPSHOT_VERSION = 1
+
+  def __init__(self, c, RouterClass=Router, snapshot_file=None):
     EventHandler.__init__(self)
     c.set_event_handler(self)
     self.ns_map = {}
     self.routers = {}
-    self.sorted_r = []
+    self.sorted_r = SortedRouterList()
     self.name_to_key = {}
     self.RouterClass = RouterClass
+    self.snapshot_file = snapshot_file
+    if snapshot_file:
+      self._load_snapshot()
     self.update_consensus()
+    self._save_snapshot()
+
+  def _save_snapshot(self):
+    """Write ns_map and the routers to self.snapshot_file. The file is
+    the magic string and a 2 byte format version, followed by the
+    zlib-compressed marshal of (ns rows, policy texts, router rows)."""
+    if not self.snapshot_file: return
+    start = time.time()
+    ns_rows = []
+    for ns in self.ns_map.itervalues():
+      ns_rows.append((ns.nickname, ns.idhash, ns.orhash,
+                      ns.updated.strftime("%Y-%m-%d %H:%M:%S"), ns.ip,
+                      ns.orport, ns.dirport, ns.flags, ns.bandwidth))
+    policies = []
+    policy_idx = {}
+    router_rows = []
+    # In sorted order, so that the load doesn't need to reorder much
+    for r in list(self.sorted_r) + filter(lambda r: r.down,
+                                          self.routers.values()):
+      if r.deleted or r.exitpolicy.text is None: continue
+      if r.exitpolicy.text not in policy_idx:
+        policy_idx[r.exitpolicy.text] = len(policies)
+        policies.append(r.exitpolicy.text)
+      if isinstance(r.published, datetime.datetime):
+        published = r.published.timetuple()[0:6]
+      else:
+        published = r.published
+      if r.version.version: version = r.version.ver_string
+      else: version = None
+      router_rows.append((r.idhex, r.nickname, r.desc_bw, r.bw, r.down,
+                          r.hibernating, policy_idx[r.exitpolicy.text],
+                          r.flags, r.ip, version, r.os, r.uptime, published,
+                          r.contact, r.rate_limited, r.orhash))
+    data = zlib.compress(marshal.dumps((ns_rows, policies, router_rows)))
+    tmp = self.snapshot_file+".tmp"
+    try:
+      f = open(tmp, "wb")
+      try:
+        f.write(self._SNAPSHOT_MAGIC)
+        f.write(struct.pack(">H", self._SNAPSHOT_VERSION))
+        f.write(data)
+      finally:
+        f.close()
+      os.rename(tmp, self.snapshot_file)
+    except (IOError, OSError), e:
+      plog("WARN", "Can't write consensus snapshot %s: %s",
+           self.snapshot_file, e)
+      return
+    plog("DEBUG", "Saved %d routers to %s in %.3fs", len(router_rows),
+         self.snapshot_file, time.time()-start)
+
+  def _load_snapshot(self):
+    """Fill ns_map and the routers from self.snapshot_file, if there is a
+    usable one. update_consensus() then only needs to fetch what changed.
+    Returns True if the snapshot was loaded."""
+    start = time.time()
+    try:
+      f = open(self.snapshot_file, "rb")
+      try:
+        magic = f.read(len(self._SNAPSHOT_MAGIC))
+        fmt = f.read(2)
+        data = f.read()
+      finally:
+        f.close()
+    except IOError, e:
+      plog("INFO", "No consensus snapshot loaded from %s: %s",
+           self.snapshot_file, e)
+      return False
+    if magic != self._SNAPSHOT_MAGIC or len(fmt) != 2 or \
+       struct.unpack(">H", fmt)[0] != self._SNAPSHOT_VERSION:
+      plog("NOTICE", "Ignoring consensus snapshot %s of unknown format",
+           self.snapshot_file)
+      return False
+    try:
+      (ns_rows, policies, router_rows) = marshal.loads(zlib.decompress(data))
+      nslist = map(lambda row: NetworkStatus(*row), ns_rows)
+      policies = map(lambda text: ExitPolicy.get(text.split("\n")), policies)
+      routers = []
+      for (idhex, nickname, desc_bw, bw, down, hibernating, policy, flags,
+           ip, version, platform, uptime, published, contact, rate_limited,
+           orhash) in router_rows:
+        if type(published) == tuple:
+          published = datetime.datetime(*published)
+        r = Router(idhex, nickname, desc_bw, down, policies[policy], flags,
+                   socket.inet_ntoa(struct.pack(">I", ip)), version, platform,
+                   uptime, published, contact, rate_limited, orhash, bw)
+        r.hibernating = hibernating
+        routers.append(r)
+    except (EOFError, ValueError, TypeError, IndexError, zlib.error,
+            struct.error, socket.error), e:
+      plog("NOTICE", "Ignoring corrupt consensus snapshot %s: %s",
+           self.snapshot_file, e)
+      return False
+    self._update_consensus(nslist)
+    for r in routers:
+      self.routers[r.idhex] = self.RouterClass(r)
+    self.sorted_r.rebuild(self.routers.values())
+    plog("INFO", "Loaded %d routers from %s in %.3fs", len(routers),
+         self.snapshot_file, time.time()-start)
+    return True
 
   def _read_routers(self, nslist):
     # Routers can fall out of our consensus five different ways:
@@ -1348,9 +1908,28 @@ class ConsensusTracker(EventHandler):
     # 3. They lose the Running flag
     # 4. They list a bandwidth of 0
     # 5. They have 'opt hibernating' set
-    routers = self.c.read_routers(nslist) # Sets .down if 3,4,5
+    #
+    # Most routers keep the same descriptor from one consensus to the
+    # next. If the descriptor digest is unchanged, only the NS-derived
+    # fields need refreshing, so skip the GETINFO and the parse.
+    fetch = []
+    cached = []
+    for ns in nslist:
+      if ns.idhex in self.routers and self.routers[ns.idhex].orhash == ns.orhash:
+        r = self.routers[ns.idhex]
+        if r.nickname != ns.nickname:
+          plog("NOTICE", "Router "+r.idhex+" changed names from "
+             +r.nickname+" to "+ns.nickname)
+        r.update_from_ns(ns) # Sets .down if 3,4,5
+        cached.append(r)
+      else:
+        fetch.append(ns)
+    routers = self.c.read_routers(fetch) # Sets .down if 3,4,5
+    plog("DEBUG", "Reused "+str(len(cached))+" unchanged descriptors, read "
+       +str(len(routers))+" of "+str(len(fetch))+" new ones")
     old_idhexes = set(self.routers.keys())
     new_idhexes = set(map(lambda r: r.idhex, routers)) 
+    new_idhexes.update(set(map(lambda r: r.idhex, cached)))
     for r in routers:
       if r.idhex in self.routers:
         if self.routers[r.idhex].nickname != r.nickname:
@@ -1365,13 +1944,15 @@ class ConsensusTracker(EventHandler):
 
     removed_idhexes = old_idhexes - new_idhexes
     removed_idhexes.update(set(map(lambda r: r.idhex,
-                                   filter(lambda r: r.down, routers))))
+                                   filter(lambda r: r.down, routers+cached))))
 
     for i in removed_idhexes:
       if i not in self.routers: continue
       self.routers[i].down = True
       if "Running" in self.routers[i].flags:
-        self.routers[i].flags.remove("Running")
+        # Flag tuples are shared. Don't modify in place.
+        self.routers[i].flags = _intern_flags(filter(lambda f: f != "Running",
+                                                     self.routers[i].flags))
       if self.routers[i].refcount == 0:
         self.routers[i].deleted = True
         if self.routers[i].__class__.__name__ == "StatsRouter":
@@ -1383,9 +1964,12 @@ class ConsensusTracker(EventHandler):
         plog("INFO", "Postponing expiring non-running router "+i)
         self.routers[i].deleted = True
 
-    self.sorted_r = filter(lambda r: not r.down, self.routers.itervalues())
-    self.sorted_r.sort(lambda x, y: cmp(y.bw, x.bw))
-    for i in xrange(len(self.sorted_r)): self.sorted_r[i].list_rank = i
+    for r in routers+cached:
+      if r.idhex in self.routers:
+        self.sorted_r.update(self.routers[r.idhex])
+    for i in removed_idhexes:
+      self.sorted_r.discard(i)
+    self.sorted_r.update_ranks()
 
     # XXX: Verification only. Can be removed.
     self._sanity_check(self.sorted_r)
@@ -1416,26 +2000,33 @@ class ConsensusTracker(EventHandler):
   def new_consensus_event(self, n):
     self._update_consensus(n.nslist)
     self._read_routers(self.ns_map.values())
+    self._save_snapshot()
     plog("DEBUG", str(time.time()-n.arrived_at)+" Read " + str(len(n.nslist))
        +" NC => " + str(len(self.sorted_r)) + " routers")
  
   def new_desc_event(self, d):
     update = False
-    for i in d.idlist:
-      r = None
-      try:
-        ns = self.c.get_network_status("id/"+i)
-        r = self.c.read_routers(ns)
-      except ErrorReply, e:
-        plog("WARN", "Error reply for "+i+" after NEWDESC: "+str(e))
+    # Fetch all NS documents, then all descriptors, as two pipelined
+    # batches instead of two round trips per id.
+    nslist = []
+    for i, ns in zip(d.idlist,
+                     self.c.get_network_statuses(map(lambda i: "id/"+i,
+                                                     d.idlist))):
+      if isinstance(ns, ErrorReply):
+        plog("WARN", "Error reply for "+i+" after NEWDESC: "+str(ns))
         continue
-      if not r:
-        plog("WARN", "No router desc for "+i+" after NEWDESC")
-        continue
-      elif len(r) != 1:
+      if len(ns) != 1:
         plog("WARN", "Multiple descs for "+i+" after NEWDESC")
-      r = r[0]
-      ns = ns[0]
+      if ns:
+        nslist.append(ns[0])
+    routers = {}
+    for r in self.c.read_routers(nslist):
+      routers[r.idhex] = r
+    for ns in nslist:
+      if ns.idhex not in routers:
+        plog("WARN", "No router desc for "+ns.idhex+" after NEWDESC")
+        continue
+      r = routers[ns.idhex]
       self.name_to_key[ns.nickname] = "$"+ns.idhex
       if r and r.idhex in self.ns_map:
         if ns.orhash != self.ns_map[r.idhex].orhash:
@@ -1446,10 +2037,9 @@ class ConsensusTracker(EventHandler):
           self.routers[r.idhex].update_to(r)
         else:
           self.routers[r.idhex] = self.RouterClass(r)
+        self.sorted_r.update(self.routers[r.idhex])
     if update:
-      self.sorted_r = filter(lambda r: not r.down, self.routers.itervalues())
-      self.sorted_r.sort(lambda x, y: cmp(y.bw, x.bw))
-      for i in xrange(len(self.sorted_r)): self.sorted_r[i].list_rank = i
+      self.sorted_r.update_ranks()
     plog("DEBUG", str(time.time()-d.arrived_at)+ " Read " + str(len(d.idlist))
        +" ND => "+str(len(self.sorted_r))+" routers. Update: "+str(update))
     # XXX: Verification only. Can be removed.
@@ -1457,9 +2047,24 @@ class ConsensusTracker(EventHandler):
     return update
 
   def current_consensus(self):
-    return Consensus(self.ns_map, self.sorted_r, self.routers, 
+    # sorted_r is reordered in place by later events, so hand out a copy
+    # that stays as it is, like the fresh list every consensus used to get.
+    # It is shared until sorted_r changes, and keeps its generation for
+    # PathSupport.RouterColumns.
+    return Consensus(self.ns_map, self.sorted_r.frozen_copy(), self.routers, 
                      self.name_to_key)
 
+# The do-nothing default implementations of the event methods
+_noop_event_funcs = set()
+for _name in _event_methods.values()+["heartbeat_event", "unknown_event"]:
+  for _cls in (EventSink, EventHandler):
+    if _name in _cls.__dict__:
+      _noop_event_funcs.add(_cls.__dict__[_name])
+
+def _is_noop(sink, name):
+  "Return true if 'sink' does not override the event method 'name'"
+  return getattr(getattr(sink, name), "im_func", None) in _noop_event_funcs
+
 class DebugEventHandler(EventHandler):
   """Trivial debug event handler: reassembles all parsed events to stdout."""
   def circ_status_event(self, circ_event): # CircuitEvent()
@@ -15,6 +15,9 @@ import binascii
 import math
 import time
 import ConfigParser
+import logging
+import threading
+import Queue
 
 if sys.version_info < (2, 5):
   from sha import sha as sha1
@@ -23,7 +26,7 @@ else:
 
 __all__ = ["Enum", "Enum2", "Callable", "sort_list", "quote", "escape_dots", "unescape_dots",
       "BufSock", "secret_to_key", "urandom_rng", "s2k_gen", "s2k_check", "plog", 
-     "ListenSocket", "zprob", "logfile", "loglevel"]
+     "plog_enabled", "ListenSocket", "zprob", "logfile", "loglevel"]
 
 # TODO: This isn't the right place for these.. But at least it's unified.
 tor_port = 9060
@@ -304,15 +307,119 @@ loglevel = "DEBUG"
 loglevels = {"DEBUG" : 0, "INFO" : 1, "NOTICE" : 2, "WARN" : 3, "ERROR" : 4, "NONE" : 5}
 logfile=None
 
-def plog(level, msg): # XXX: Timestamps
-  if(loglevels[level] >= loglevels[loglevel]):
-    t = time.strftime("%a %b %d %H:%M:%S %Y")
-    if logfile:
-      logfile.write(level+'['+t+']:'+msg+"\n")
-      logfile.flush()
-    else:
-      print level, '[', t, ']:', msg
-      sys.stdout.flush()
+# plog() goes through the "TorCtl" logger of the standard logging module.
+# NOTICE has no stdlib equivalent, so it gets a level of its own.
+logging.addLevelName(25, "NOTICE")
+_log_levels = {"DEBUG" : logging.DEBUG, "INFO" : logging.INFO,
+               "NOTICE" : 25, "WARN" : logging.WARNING,
+               "ERROR" : logging.ERROR}
+_log_names = {}
+for _name, _level in _log_levels.iteritems():
+  _log_names[_level] = _name
+
+class PlogHandler(logging.Handler):
+  """Handler that writes records in the traditional plog format to
+     TorUtil.logfile, or to stdout if it is unset."""
+  def __init__(self):
+    logging.Handler.__init__(self)
+    self._stamp_sec = None
+    self._stamp = None
+
+  def emit(self, record):
+    try:
+      sec = int(record.created)
+      if sec != self._stamp_sec:
+        self._stamp = time.strftime("%a %b %d %H:%M:%S %Y",
+                                    time.localtime(sec))
+        self._stamp_sec = sec
+      level = _log_names.get(record.levelno, record.levelname)
+      msg = record.getMessage()
+      if logfile:
+        logfile.write(level+'['+self._stamp+']:'+msg+"\n")
+        logfile.flush()
+      else:
+        sys.stdout.write(level+' [ '+self._stamp+' ]: '+msg+"\n")
+        sys.stdout.flush()
+    except (KeyboardInterrupt, SystemExit):
+      raise
+    except:
+      self.handleError(record)
+
+class QueueHandler(logging.Handler):
+  """Handler that hands records to a background thread, which passes
+     them on to 'target'. Keeps slow log files and terminals off the
+     calling thread."""
+  def __init__(self, target):
+    logging.Handler.__init__(self)
+    self.target = target
+    self.queue = Queue.Queue()
+    self.thread = threading.Thread(target=self._run)
+    self.thread.setDaemon(True)
+    self.thread.start()
+
+  def emit(self, record):
+    # Format now: the args may be changed by the caller before we run
+    record.msg = record.getMessage()
+    record.args = None
+    record.exc_info = None
+    self.queue.put(record)
+
+  def _run(self):
+    while True:
+      record = self.queue.get()
+      if record is None: break
+      self.target.handle(record)
+
+  def close(self):
+    self.queue.put(None)
+    self.thread.join()
+    logging.Handler.close(self)
+
+logger = logging.getLogger("TorCtl")
+logger.propagate = False
+logger.setLevel(logging.DEBUG)
+_handler = PlogHandler()
+logger.addHandler(_handler)
+
+# loglevel is a plain module variable that callers assign directly, so
+# the numeric threshold is recomputed only when it is seen to change.
+_threshold_for = None
+_threshold = 0
+
+def plog_enabled(level):
+  "Return true if messages at 'level' would currently be logged"
+  global _threshold_for, _threshold
+  if loglevel is not _threshold_for:
+    _threshold = loglevels[loglevel]
+    _threshold_for = loglevel
+  return loglevels[level] >= _threshold
+
+def plog(level, msg, *args):
+  """Log 'msg' at 'level'. If 'args' are given, 'msg' is a %-format
+     string that is only expanded if the message is actually logged."""
+  global _threshold_for, _threshold
+  if loglevel is not _threshold_for:
+    _threshold = loglevels[loglevel]
+    _threshold_for = loglevel
+  if loglevels[level] >= _threshold:
+    logger.log(_log_levels[level], msg, *args)
+
+def plog_use_queue(enable=True):
+  """Write plog() output from a background thread (enable=True), or
+     synchronously again (enable=False). Switching back drains the
+     messages still queued."""
+  global _handler
+  if enable and not isinstance(_handler, QueueHandler):
+    new = QueueHandler(_handler)
+  elif not enable and isinstance(_handler, QueueHandler):
+    new = _handler.target
+  else:
+    return
+  logger.addHandler(new)
+  logger.removeHandler(_handler)
+  if isinstance(_handler, QueueHandler):
+    _handler.close()
+  _handler = new
 
 # Stolen from
 # http://www.nmr.mgh.harvard.edu/Neural_Systems_Group/gary/python/stats.py
@@ -7,6 +7,28 @@ Configuration settings.
 @var updater_port: The Tor control port for the updater to use. This port 
     must be configured in the torrc file.
 @var base_url: The root URL for the Tor Weather web application.
+@var mail_rate: The sustained number of notification emails per second the
+    mailer may hand to the SMTP relay.
+@var mail_burst: The number of emails the mailer may send back to back 
+    before it is held to C{mail_rate}.
+@var mail_threads: The number of concurrent SMTP connections the mailer uses.
+@var check_processes: The number of worker processes the subscription checks
+    are split across after each consensus; 1 checks them all in the updater's
+    own process. Values above 1 are only safe if the workers are forked
+    before the process starts any threads, as the listener does with
+    C{updaters.start_check_pool}; forking them from a threaded process can
+    deadlock.
+@var router_directory: The file the updater publishes the memory-mapped router
+    directory to after each consensus, for the web views' router lookups (see
+    L{weatherapp.routerdir}). It must be readable by the web server. C{None}
+    disables it, and the lookups query the database.
+@var tor_source: Where the updater reads the consensus and the router
+    descriptors from: C{'control'} fetches them over the control port,
+    C{'datadir'} reads the files Tor caches in C{tor_data_dir} and
+    C{'files'} reads only those files, without connecting to Tor at all (for
+    tests and benchmarks). The listener always uses the control port.
+@var tor_data_dir: The DataDirectory of the local Tor, for the C{'datadir'}
+    and C{'files'} sources. The updater needs read access to it.
 """
 
 # XXX: Make bulletproof
@@ -17,3 +39,18 @@ control_port = 9051
 
 #The base URL for the Tor Weather web application:
 base_url = 'http://www.weather.torproject.org'
+
+#Pacing for notification emails so that the SMTP relay doesn't throttle us:
+mail_rate = 2.0
+mail_burst = 50
+mail_threads = 2
+
+#Subscriber shards to check in parallel (1 = no worker processes):
+check_processes = 1
+
+#Router directory for the web workers' lookups (None = query the database):
+router_directory = None
+
+#Source of the consensus and descriptors ('control', 'datadir' or 'files'):
+tor_source = 'control'
+tor_data_dir = '/var/lib/tor'
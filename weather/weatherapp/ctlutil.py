@@ -1,14 +1,25 @@
 """This module contains the CtlUtil class. CtlUtil objects set up a connection
 to TorCtl and handle communication concerning consensus documents and 
-descriptor files.
+descriptor files. It also contains the L{DescriptorCache} class, which keeps
+the current descriptors in memory so that CtlUtil objects don't have to fetch
+them from Tor.
+
+Depending on C{config.tor_source}, CtlUtil objects read the consensus and the
+descriptors from the control port or from the files Tor caches in its
+DataDirectory (see L{torfiles}).
 
 @var debugfile: The debug file used by TorCtl .
 @var unparsable_email_file: A log file for contacts with unparsable emails.
+@type descriptor_cache: L{DescriptorCache}
+@var descriptor_cache: The descriptor cache shared by all CtlUtil objects in
+    this process. It is kept warm by the listener from NEWDESC events.
 """
 
 import socket
+import threading
 from TorCtl import TorCtl
 from config import config
+from weatherapp import torfiles
 import logging
 import re
 import string
@@ -19,6 +30,147 @@ debugfile = open('log/debug', 'w')
 #for unparsable emails
 unparsable_email_file = 'log/unparsable_emails.txt'
 
+class DescriptorCache:
+    """An in-memory cache of router descriptors keyed by fingerprint. The 
+    cache is filled once with C{desc/all-recent} by L{load} and afterwards
+    only the descriptors named in NEWDESC events are refetched by L{update},
+    which spreads the control port load over the hour instead of fetching
+    every descriptor when a new consensus arrives. The descriptors of
+    routers that drop out of the consensus are removed by L{prune}.
+
+    Both methods take a C{TorCtl.Connection}, so they can be called from a
+    C{TorCtl.EventHandler} with its own connection.
+    """
+
+    def __init__(self):
+        self._descs = {}
+        self._warm = False
+        self._lock = threading.Lock()
+        self._loading = False
+        self._updated = set()
+
+    def _get_fingerprint(self, desc):
+        """Returns the fingerprint published in C{desc} with spaces removed,
+        or the empty string if it doesn't publish one."""
+        for line in desc.split('\n'):
+            if line.startswith('opt fingerprint'):
+                return line.replace('opt fingerprint', '').replace(' ', '')
+            if line.startswith('fingerprint '):
+                return line.replace('fingerprint', '').replace(' ', '')
+        return ''
+
+    def is_warm(self):
+        """@rtype: bool
+        @return: C{True} once the cache has been loaded, C{False} before."""
+        return self._warm
+
+    def load(self, control):
+        """Replaces the contents of the cache with every descriptor Tor
+        currently has. Descriptors that L{update} refetches while the
+        snapshot is being read are newer than it, so they are kept.
+
+        @type control: TorCtl.Connection
+        @param control: An authenticated connection to Tor.
+        """
+        self._lock.acquire()
+        try:
+            self._loading = True
+            self._updated = set()
+        finally:
+            self._lock.release()
+        descs = {}
+        try:
+            all_recent = control.get_info("desc/all-recent").values()[0]
+            for desc in all_recent.split("-----END SIGNATURE-----"):
+                finger = self._get_fingerprint(desc)
+                if finger != '':
+                    descs[finger] = desc
+        finally:
+            self._lock.acquire()
+            try:
+                for node_id in self._updated:
+                    if node_id in self._descs:
+                        descs[node_id] = self._descs[node_id]
+                    else:
+                        descs.pop(node_id, None)
+                self._descs = descs
+                self._warm = True
+                self._loading = False
+                self._updated = set()
+            finally:
+                self._lock.release()
+        logging.info("Loaded %d descriptors into the cache." % len(descs))
+
+    def update(self, control, idlist):
+        """Refetches the descriptors of the routers in C{idlist}, as given by
+        C{TorCtl.NewDescEvent.idlist}. Routers Tor no longer has a descriptor
+        for are dropped from the cache.
+
+        @type control: TorCtl.Connection
+        @param control: An authenticated connection to Tor.
+        @type idlist: list[str]
+        @param idlist: Fingerprints of the routers with new descriptors.
+        """
+        #One pipelined request rather than a round trip per router
+        replies = control.get_infos(["desc/id/" + node_id
+                                     for node_id in idlist])
+        self._lock.acquire()
+        try:
+            for node_id, reply in zip(idlist, replies):
+                desc = ''
+                if isinstance(reply, TorCtl.ErrorReply):
+                    logging.error("ErrorReply: %s" % str(reply))
+                else:
+                    desc = reply.values()[0]
+                if desc == '':
+                    self._descs.pop(node_id, None)
+                else:
+                    self._descs[node_id] = desc
+                if self._loading:
+                    self._updated.add(node_id)
+        finally:
+            self._lock.release()
+
+    def prune(self, fingerprints):
+        """Drops the descriptors of the routers that aren't in
+        C{fingerprints}, so that routers that left the network aren't
+        reported as present any more.
+
+        @type fingerprints: list[str]
+        @param fingerprints: Fingerprints of the routers in the current
+            consensus, with no spaces.
+        """
+        keep = set(fingerprints)
+        self._lock.acquire()
+        try:
+            gone = [finger for finger in self._descs if finger not in keep]
+            for finger in gone:
+                del self._descs[finger]
+        finally:
+            self._lock.release()
+        if gone:
+            logging.info("Dropped %d descriptors of routers no longer in the "
+                         "consensus." % len(gone))
+
+    def get(self, node_id):
+        """@type node_id: str
+        @param node_id: Fingerprint of the router with no spaces.
+        @rtype: str
+        @return: The cached descriptor for C{node_id}, or the empty string if
+            there is none."""
+        return self._descs.get(node_id, '')
+
+    def get_all(self):
+        """@rtype: list[str]
+        @return: All cached descriptors."""
+        self._lock.acquire()
+        try:
+            return self._descs.values()
+        finally:
+            self._lock.release()
+
+descriptor_cache = DescriptorCache()
+
 class CtlUtil:
     """A class that handles communication with the local Tor process via
     TorCtl.
@@ -39,7 +191,10 @@ class CtlUtil:
     @type authenticator: str
     @ivar authenticator: Authenticator string of the TorCtl connection.
     @type control: TorCtl Connection
-    @ivar control: Connection to TorCtl.
+    @ivar control: Connection to TorCtl. C{None} with the C{'files'} source.
+    @type files: L{torfiles.TorDataFiles}
+    @ivar files: The DataDirectory files the consensus and the descriptors
+        are read from, or C{None} if they are fetched over the control port.
     """
     _CONTROL_HOST = '127.0.0.1'
     _CONTROL_PORT = config.control_port 
@@ -47,8 +202,31 @@ class CtlUtil:
     
     def __init__(self, control_host = _CONTROL_HOST, 
                 control_port = _CONTROL_PORT, sock = None, 
-                authenticator = _AUTHENTICATOR):
-        """Initialize the CtlUtil object, connect to TorCtl."""
+                authenticator = _AUTHENTICATOR, source = None,
+                data_dir = None):
+        """Initialize the CtlUtil object, connect to TorCtl.
+
+        @type source: str
+        @param source: Where the consensus and the descriptors come from:
+            C{'control'}, C{'datadir'} or C{'files'} (see
+            C{config.tor_source}). Defaults to C{config.tor_source}.
+        @type data_dir: str
+        @param data_dir: Tor's DataDirectory, for the C{'datadir'} and
+            C{'files'} sources. Defaults to C{config.tor_data_dir}.
+        """
+        if source is None:
+            source = config.tor_source
+        self.files = None
+        if source in ('datadir', 'files'):
+            if data_dir is None:
+                data_dir = config.tor_data_dir
+            self.files = torfiles.TorDataFiles(data_dir)
+            self.files.load()
+        if source == 'files':
+            # Nothing is read from the control port
+            self.sock = None
+            self.control = None
+            return
 
         self.sock = sock
 
@@ -83,6 +261,8 @@ class CtlUtil:
         """Closes the connection when the CtlUtil object is garbage collected.
         (From original Tor Weather)
         """
+        if self.sock is None:
+            return
         
         self.sock.close()
         del self.sock
@@ -106,6 +286,9 @@ class CtlUtil:
         @return: String representation of the single consensus entry or the
                  empty string if the consensus entry cannot be retrieved.
         """
+        if self.files is not None:
+            return self.files.get_consensus_entry(node_id)
+
         # get_info method returns a dictionary with single mapping, with
         # all the info stored as the single value, so this extracts the string
         cons = ''
@@ -129,6 +312,9 @@ class CtlUtil:
         @rtype: str
         @return: String representation of entire consensus document.
         """
+        if self.files is not None:
+            return self.files.get_consensus()
+
         # get_info method returns a dictionary with single mapping, with
         # all the info stored as the single value, so this extracts the string
         return self.control.get_info("ns/all").values()[0]
@@ -144,6 +330,12 @@ class CtlUtil:
         @return: String representation of the single descirptor file or
         the empty string if no such descriptor file exists.
         """
+        if self.files is not None:
+            return self.files.get_descriptor(node_id)
+
+        if descriptor_cache.is_warm():
+            return descriptor_cache.get(node_id)
+
         # get_info method returns a dictionary with single mapping, with
         # all the info stored as the single value, so this extracts the string
         desc = ''
@@ -162,6 +354,9 @@ class CtlUtil:
         @rtype: str
         @return: String representation of all descriptor files.
         """
+        if self.files is not None:
+            return '\n'.join(self.files.get_descriptors())
+
         # get_info method returns a dictionary with single mapping, with
         # all the info stored as the single value, so this extracts the string
         return self.control.get_info("desc/all-recent").values()[0]
@@ -173,12 +368,21 @@ class CtlUtil:
         @rtype: list[str]
         @return: List of strings representing all individual descriptor files.
         """
+        if self.files is not None:
+            return self.files.get_descriptors()
+
+        if descriptor_cache.is_warm():
+            return descriptor_cache.get_all()
+
         # Individual descriptors are delimited by -----END SIGNATURE-----
         return self.get_full_descriptor().split("-----END SIGNATURE-----")
 
     def get_rec_version_list(self):
         """Get a list of currently recommended versions sorted in ascending
         order."""
+        if self.files is not None:
+            return self.files.get_recommended_versions()
+
         return self.control.get_info("status/version/recommended").\
         values()[0].split(',')
 
@@ -1,5 +1,5 @@
-"""The emails module contains methods to send individual confirmation and confirmed emails as well as methods to return tuples needed by Django's 
-send_mass_mail() method. Emails are sent after all database checks/updates. 
+"""The emails module contains methods to send individual confirmation and confirmed emails as well as methods to return the email tuples that the
+L{mailer} sends. Emails are sent after all database checks/updates. 
 
 @type _SENDER: str
 @var _SENDER: The email address for the Tor Weather emailer
@@ -48,6 +48,28 @@ send_mass_mail() method. Emails are sent after all database checks/updates.
 @type _GENERIC_FOOTER: str
 @var _GENERIC_FOOTER: A footer containing unsubscribe and preferences page
     links.
+@type _DIGEST_SUBJ: str
+@var _DIGEST_SUBJ: The subject line for a digest of several notifications
+    sent to the same address in one update cycle.
+@type _DIGEST_MAIL: str
+@var _DIGEST_MAIL: The introduction at the top of a digest email.
+@type PRIORITY_NODE_DOWN: int
+@var PRIORITY_NODE_DOWN: The sending priority of node down notifications.
+    Every email tuple carries one of the C{PRIORITY_*} values as its last
+    item, and the mailer sends lower values first when it is rate limited.
+@type PRIORITY_VERSION: int
+@var PRIORITY_VERSION: The sending priority of version notifications.
+@type PRIORITY_BANDWIDTH: int
+@var PRIORITY_BANDWIDTH: The sending priority of low bandwidth
+    notifications.
+@type PRIORITY_T_SHIRT: int
+@var PRIORITY_T_SHIRT: The sending priority of T-shirt notifications.
+@type PRIORITY_WELCOME: int
+@var PRIORITY_WELCOME: The sending priority of welcome emails.
+@type _DIGEST_SEPARATOR: str
+@var _DIGEST_SEPARATOR: The text separating the individual notifications in
+    a digest email. Each notification keeps its own footer, so the 
+    unsubscribe and preferences links of every subscription are preserved.
 """
 import re
 
@@ -140,6 +162,18 @@ _GENERIC_FOOTER = "\n\nYou can unsubscribe from these reports at any time "+\
     "by visiting the following url:\n\n%s\n\nor change your Tor Weather "+\
     "notification preferences here: \n\n%s"
 
+PRIORITY_NODE_DOWN = 0
+PRIORITY_VERSION = 1
+PRIORITY_BANDWIDTH = 2
+PRIORITY_T_SHIRT = 3
+PRIORITY_WELCOME = 4
+
+_DIGEST_SUBJ = '%s Notifications'
+_DIGEST_MAIL = "This is a Tor Weather Report.\n\n"+\
+    "Several notifications about the Tor nodes you've been observing were "+\
+    "issued since the last report. They are listed below."
+_DIGEST_SEPARATOR = "\n\n" + "-" * 72 + "\n%s\n\n"
+
 
 def _get_router_name(fingerprint, name):
     """Returns a string representation of the name and fingerprint of
@@ -256,7 +290,7 @@ def bandwidth_tuple(recipient, fingerprint, name,  observed, threshold,
     msg = _LOW_BANDWIDTH_MAIL % (router, observed, threshold)
     msg = _add_generic_footer(msg, unsubURL, prefURL)
 
-    return (subj, msg, sender, [recipient])
+    return (subj, msg, sender, [recipient], PRIORITY_BANDWIDTH)
 
 def node_down_tuple(recipient, fingerprint, name, grace_pd, unsubs_auth, 
                     pref_auth):
@@ -274,7 +308,8 @@ def node_down_tuple(recipient, fingerprint, name, grace_pd, unsubs_auth,
     @param pref_auth: The user's unique preferences auth key
     @rtype: tuple
     @return: A tuple listing information about the email to be sent, which is
-        used by the send_mass_mail method in updaters.
+        used by the mailer: subject, message, sender, recipients and
+        sending priority.
     """
     router = _get_router_name(fingerprint, name)
     subj = _SUBJECT_HEADER + _NODE_DOWN_SUBJ
@@ -286,7 +321,7 @@ def node_down_tuple(recipient, fingerprint, name, grace_pd, unsubs_auth,
     prefURL = url_helper.get_preferences_url(pref_auth)
     msg = _NODE_DOWN_MAIL % (router, num_hours)
     msg = _add_generic_footer(msg, unsubURL, prefURL)
-    return (subj, msg, sender, [recipient])
+    return (subj, msg, sender, [recipient], PRIORITY_NODE_DOWN)
 
 def t_shirt_tuple(recipient, fingerprint, name, avg_bandwidth, 
                   hours_since_triggered, is_exit, unsubs_auth, pref_auth):
@@ -309,7 +344,8 @@ def t_shirt_tuple(recipient, fingerprint, name, avg_bandwidth,
     @param pref_auth: The user's unique preferences auth key
     @rtype: tuple
     @return: A tuple listing information about the email to be sent, which is
-        used by the send_mass_mail method in updaters.
+        used by the mailer: subject, message, sender, recipients and
+        sending priority.
     """
     router = _get_router_name(fingerprint, name)
     stable_message = 'running'
@@ -324,7 +360,7 @@ def t_shirt_tuple(recipient, fingerprint, name, avg_bandwidth,
     msg = _T_SHIRT_MAIL % (router, stable_message, days_running, 
                            avg_bandwidth)
     msg = _add_generic_footer(msg, unsubURL, prefURL)
-    return (subj, msg, sender, [recipient])
+    return (subj, msg, sender, [recipient], PRIORITY_T_SHIRT)
 
 def welcome_tuple(recipient, fingerprint, name, exit):
     """Returns a tuple for the welcome email. If the operator runs an exit
@@ -339,7 +375,8 @@ def welcome_tuple(recipient, fingerprint, name, exit):
     @param exit: C{True} if the router is an exit node, C{False} if not.
     @rtype: tuple
     @return: A tuple listing information about the email to be sent, which is
-        used by the send_mass_mail method in updaters.
+        used by the mailer: subject, message, sender, recipients and
+        sending priority.
     """
     router = _get_router_name(fingerprint, name)
     subj = _SUBJECT_HEADER + _WELCOME_SUBJ
@@ -350,7 +387,7 @@ def welcome_tuple(recipient, fingerprint, name, exit):
         append = _LEGAL_INFO
     url = url_helper.get_home_url()
     msg = _WELCOME_MAIL % (router, url, append)
-    return (subj, msg, sender, [recipient])
+    return (subj, msg, sender, [recipient], PRIORITY_WELCOME)
 
 def version_tuple(recipient, fingerprint, name, version_type, unsubs_auth, 
                   pref_auth):
@@ -366,9 +403,8 @@ def version_tuple(recipient, fingerprint, name, version_type, unsubs_auth,
         user's preferences for this notification type.
 
     @rtype: tuple
-    @return: A tuple containing information about the email to be sent in
-             an appropriate format for the C{send_mass_mail()} function in
-             C{updaters}.
+    @return: A tuple containing information about the email to be sent, in
+             the format the other C{*_tuple} methods return.
     """
     router = _get_router_name(fingerprint, name)
     subj = _SUBJECT_HEADER + _VERSION_SUBJ
@@ -380,4 +416,66 @@ def version_tuple(recipient, fingerprint, name, version_type, unsubs_auth,
     msg = _VERSION_MAIL % (router, version_type, downloadURL)
     msg = _add_generic_footer(msg, unsubURL, prefURL)
                            
-    return (subj, msg, sender, [recipient])
+    return (subj, msg, sender, [recipient], PRIORITY_VERSION)
+
+def digest_tuples(email_list, exclude=()):
+    """Combines all email tuples addressed to the same recipient into a
+    single digest email, so that the number of emails sent scales with the
+    number of recipients rather than with the number of notifications.
+    Recipients with only one notification, and recipients listed in 
+    C{exclude}, get their email tuples unchanged. Recipients keep the 
+    position of their first notification in C{email_list}.
+
+    @type email_list: list
+    @param email_list: The list of tuples representing emails to send, in
+        the format returned by the other C{*_tuple} methods.
+    @type exclude: list
+    @param exclude: Email addresses that should not receive digests.
+    @rtype: list
+    @return: The list of tuples representing emails to send, with at most one
+        digest tuple per recipient.
+    """
+    exclude = set(exclude)
+    grouped = {}
+    digest_list = []
+
+    for email in email_list:
+        recipient = email[3][0]
+        if recipient in exclude:
+            digest_list.append(email)
+        elif recipient in grouped:
+            grouped[recipient].append(email)
+        else:
+            grouped[recipient] = [email]
+            digest_list.append(recipient)
+
+    for i, entry in enumerate(digest_list):
+        if isinstance(entry, tuple):
+            continue
+        group = grouped[entry]
+        if len(group) == 1:
+            digest_list[i] = group[0]
+            continue
+        msg = _DIGEST_MAIL
+        for (subj, body, sender, recipients, priority) in group:
+            if subj.startswith(_SUBJECT_HEADER):
+                subj = subj[len(_SUBJECT_HEADER):]
+            msg += _DIGEST_SEPARATOR % subj + body
+        subj = _SUBJECT_HEADER + _DIGEST_SUBJ % len(group)
+        priority = min([email[4] for email in group])
+        digest_list[i] = (subj, msg, _SENDER, [entry], priority)
+
+    return digest_list
+
+def get_priority(email):
+    """Returns the sending priority of an email tuple, where lower numbers
+    should be sent first. Node down notifications come first, then version,
+    bandwidth, T-shirt and welcome emails. A digest gets the priority of the
+    most urgent notification it contains.
+
+    @type email: tuple
+    @param email: A tuple in the format returned by the C{*_tuple} methods.
+    @rtype: int
+    @return: One of the C{PRIORITY_*} values.
+    """
+    return email[4]
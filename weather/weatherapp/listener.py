@@ -1,5 +1,7 @@
 """A module for listening to TorCtl for new consensus events. When one occurs,
-initializes the checker/updater cascade in the updaters module."""
+initializes the checker/updater cascade in the updaters module. NEWDESC events
+are used to keep C{ctlutil.descriptor_cache} up to date in between, unless
+the descriptors are read from Tor's DataDirectory (C{config.tor_source})."""
 
 import sys, os
 import logging
@@ -7,6 +9,7 @@ import socket
 
 from config import config
 from weatherapp import updaters
+from weatherapp.ctlutil import descriptor_cache
 from TorCtl import TorCtl
 
 #very basic log setup
@@ -15,24 +18,37 @@ logging.basicConfig(format = '%(asctime) - 15s (%(process)d) %(message)s',
 
 class MyEventHandler(TorCtl.EventHandler):
     """Extends C{TorCtl.EventHandler} so that C{updaters.run_all} is called
-    when a NEWCONSENSUS event is received.
+    when a NEWCONSENSUS event is received and the descriptor cache is 
+    refreshed when a NEWDESC event is received.
     """
+    def new_desc_event(self, event):
+        """Refetch the descriptors named in a NEWDESC event into 
+        C{ctlutil.descriptor_cache}.
+
+        @type event: TorCtl.NewDescEvent
+        @param event: The NEWDESC event.
+        """
+        descriptor_cache.update(self.c, event.idlist)
+
     def new_consensus_event(self, event):
         """Call C{updaters.run_all()} when a NEWCONSENSUS event is received.
 
-        @param event: The NEWCONSENSUS event. Not used by the function,
-                      but included so that this overrides 
-                      C{TorCtl.EventHandler.new_consensus_event}
+        @type event: TorCtl.NewConsensusEvent
+        @param event: The NEWCONSENSUS event. The descriptors of routers that
+                      aren't in it are dropped from the cache.
         """
 
         logging.info('Got a new consensus. Updating router table and ' + \
                      'checking all subscriptions.')
+        descriptor_cache.prune([ns.idhex for ns in event.nslist])
         updaters.run_all()
 
 def listen():
     """Sets up a connection to TorCtl and launches a thread to listen for
     new consensus events.
     """
+    # Fork the check workers while this is the only thread
+    updaters.start_check_pool()
     sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     ctrl_host = '127.0.0.1'
     ctrl_port = config.control_port
@@ -41,7 +57,15 @@ def listen():
     ctrl.launch_thread(daemon=0)
     ctrl.authenticate(config.authenticator)
     ctrl.set_event_handler(MyEventHandler())
-    ctrl.set_events([TorCtl.EVENT_TYPE.NEWCONSENSUS])
+    if config.tor_source == 'control':
+        # Subscribe first, so that no NEWDESC is missed while the cache
+        # loads; load() keeps the descriptors refetched meanwhile.
+        ctrl.set_events([TorCtl.EVENT_TYPE.NEWCONSENSUS, 
+                         TorCtl.EVENT_TYPE.NEWDESC])
+        descriptor_cache.load(ctrl)
+    else:
+        # CtlUtil reads the cached descriptors from the DataDirectory
+        ctrl.set_events([TorCtl.EVENT_TYPE.NEWCONSENSUS])
     print 'Listening for new consensus events.'
     logging.info('Listening for new consensus events.')
 
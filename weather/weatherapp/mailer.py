@@ -0,0 +1,345 @@
+"""A rate-limited mailer for the notification emails generated by the
+updaters module. Instead of handing every email to the SMTP relay at once with
+C{send_mass_mail}, emails are put on a priority queue and sent by a small pool
+of worker threads that share a token bucket, so that the relay never sees more
+than C{config.mail_burst} emails back to back and is otherwise held to
+C{config.mail_rate} emails per second. Node down notifications are sent before
+anything else (see L{emails.get_priority}); whatever doesn't fit in the rate
+budget drains over the following minutes, and urgent emails queued by a later
+update cycle still overtake it.
+
+Emails still waiting when the process exits are saved to
+C{pending_email_file} and sent by the next process to start a mailer.
+
+@type failed_email_file: str
+@var failed_email_file: A log file for emails that couldn't be sent.
+@type pending_email_file: str
+@var pending_email_file: Where the emails left unsent at exit are saved.
+"""
+import atexit
+import cPickle
+import heapq
+import logging
+import os
+import threading
+import time
+from Queue import PriorityQueue, Empty
+from smtplib import SMTPRecipientsRefused, SMTPResponseException
+
+from config import config
+from weatherapp import emails
+
+from django.core.mail import EmailMessage, get_connection
+
+failed_email_file = 'log/failed_emails.txt'
+pending_email_file = 'log/pending_emails.pickle'
+
+class TokenBucket:
+    """A thread-safe token bucket. Tokens are added at C{rate} per second up
+    to a maximum of C{capacity}, and every sent email consumes one token.
+
+    @type rate: float
+    @ivar rate: The number of tokens added per second.
+    @type capacity: int
+    @ivar capacity: The maximum number of tokens the bucket can hold.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = float(rate)
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._last = time.time()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        """Adds the tokens accumulated since the last refill. Must be called
+        with C{self._lock} held."""
+        now = time.time()
+        self._tokens = min(self.capacity,
+                           self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def consume(self):
+        """Takes one token from the bucket, blocking until one is available.
+        """
+        while True:
+            self._lock.acquire()
+            try:
+                self._refill()
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            finally:
+                self._lock.release()
+            time.sleep(wait)
+
+class Mailer:
+    """Sends email tuples in priority order through C{threads} SMTP
+    connections, paced by a shared L{TokenBucket}. The worker threads are
+    started on the first call to L{send} and keep running until
+    L{shutdown}.
+
+    @type bucket: L{TokenBucket}
+    @ivar bucket: The token bucket shared by all worker threads.
+    @type threads: int
+    @ivar threads: The number of worker threads (and SMTP connections).
+    @type _MAX_TRIES: int
+    @cvar _MAX_TRIES: How often an email that fails with a temporary (4xx)
+        SMTP error is tried before it is given up on.
+    @type _RETRY_DELAY: float
+    @cvar _RETRY_DELAY: Seconds before the first retry of such an email. The
+        delay doubles with every further try, so that a relay that is
+        throttling us gets time to recover.
+    @type _SHUTDOWN_WAIT: float
+    @cvar _SHUTDOWN_WAIT: Seconds L{shutdown} waits for the queue to drain
+        before it saves what is left.
+    """
+    _MAX_TRIES = 3
+    _RETRY_DELAY = 60.0
+    _SHUTDOWN_WAIT = 30.0
+
+    def __init__(self, rate, burst, threads):
+        self.bucket = TokenBucket(rate, burst)
+        self.threads = threads
+        self._queue = PriorityQueue()
+        self._seq = 0
+        self._tries = {}
+        # Heap of (not before, priority, seq, email) for retries not yet due
+        self._deferred = []
+        self._sending = 0
+        self._lock = threading.Lock()
+        self._workers = []
+
+    def _start_workers(self):
+        """Starts the worker threads if they aren't running yet."""
+        if self._workers:
+            return
+        for i in range(self.threads):
+            worker = threading.Thread(target=self._work,
+                                      name='mailer-%d' % i)
+            worker.setDaemon(True)
+            worker.start()
+            self._workers.append(worker)
+
+    def send(self, email_list):
+        """Queues the emails in C{email_list} for sending and returns
+        immediately.
+
+        @type email_list: list
+        @param email_list: The list of tuples representing emails to send, in
+            the format returned by the C{emails.*_tuple} methods.
+        """
+        self._lock.acquire()
+        try:
+            self._start_workers()
+            for email in email_list:
+                # The sequence number keeps emails of equal priority in the
+                # order they were queued.
+                self._queue.put((emails.get_priority(email), self._seq, email))
+                self._seq += 1
+        finally:
+            self._lock.release()
+        logging.info('Queued %d emails, %d waiting to be sent.' % \
+                     (len(email_list), self._queue.qsize()))
+
+    def join(self):
+        """Blocks until every queued email, and every retry of one, has been
+        sent or has failed."""
+        while True:
+            self._queue.join()
+            self._lock.acquire()
+            try:
+                if not self._deferred:
+                    return
+                wait = self._deferred[0][0] - time.time()
+            finally:
+                self._lock.release()
+            time.sleep(max(wait, 0.01))
+
+    def send_pending(self):
+        """Queues the emails a previous process left in
+        L{pending_email_file}, and removes the file."""
+        try:
+            f = open(pending_email_file, 'rb')
+        except IOError:
+            return
+        try:
+            try:
+                pending = cPickle.load(f)
+            finally:
+                f.close()
+            os.remove(pending_email_file)
+        except (IOError, OSError, EOFError, cPickle.UnpicklingError), e:
+            logging.error('Cannot read pending emails: %s' % e)
+            return
+        logging.info('Sending %d emails left by the last run.' % len(pending))
+        self.send(pending)
+
+    def shutdown(self, timeout=None):
+        """Gives the workers up to C{timeout} seconds (L{_SHUTDOWN_WAIT} by
+        default) to send the queued emails, then stops them and saves the
+        emails that are left, including retries that aren't due yet, to
+        L{pending_email_file}. Registered to run at exit by L{get_mailer}.
+        """
+        if timeout is None:
+            timeout = self._SHUTDOWN_WAIT
+        deadline = time.time() + timeout
+        while time.time() < deadline and not self._idle():
+            time.sleep(0.1)
+        # Stop markers sort before any email, so every worker takes one
+        # as soon as it is done with the email it is sending
+        for worker in self._workers:
+            self._queue.put((float('-inf'), -1, None))
+        for worker in self._workers:
+            worker.join(max(deadline + 10 - time.time(), 0.1))
+
+        left = []
+        while True:
+            try:
+                priority, seq, email = self._queue.get_nowait()
+            except Empty:
+                break
+            if email is not None:
+                left.append(email)
+            self._queue.task_done()
+        self._lock.acquire()
+        try:
+            left.extend([email for (due, priority, seq, email)
+                         in sorted(self._deferred)])
+            self._deferred = []
+        finally:
+            self._lock.release()
+        if not left:
+            return
+        try:
+            f = open(pending_email_file, 'wb')
+            try:
+                cPickle.dump(left, f, cPickle.HIGHEST_PROTOCOL)
+            finally:
+                f.close()
+        except IOError, e:
+            logging.error('Cannot save %d pending emails: %s' % (len(left), e))
+            return
+        logging.info('Saved %d pending emails.' % len(left))
+
+    def _idle(self):
+        """Returns whether no email is queued or being sent. Retries that
+        aren't due yet don't count."""
+        self._lock.acquire()
+        try:
+            return self._queue.empty() and not self._sending
+        finally:
+            self._lock.release()
+
+    def _queue_due(self):
+        """Moves the retries that are due from L{_deferred} to the queue, and
+        returns the seconds until the next one is due (C{None} if there is
+        none)."""
+        self._lock.acquire()
+        try:
+            now = time.time()
+            while self._deferred and self._deferred[0][0] <= now:
+                due, priority, seq, email = heapq.heappop(self._deferred)
+                self._queue.put((priority, seq, email))
+            if self._deferred:
+                return max(self._deferred[0][0] - now, 0.01)
+            return None
+        finally:
+            self._lock.release()
+
+    def _is_temporary(self, e):
+        """Returns whether the exception C{e} raised while sending an email
+        is a temporary (4xx) SMTP failure that is worth retrying."""
+        if isinstance(e, SMTPRecipientsRefused):
+            codes = [code for (code, msg) in e.recipients.values()]
+            return bool(codes) and max(codes) < 500
+        if isinstance(e, SMTPResponseException):
+            return e.smtp_code < 500
+        return False
+
+    def _failed(self, priority, seq, email, e):
+        """Handles the failure C{e} to send C{email}: the email is queued
+        again after L{_RETRY_DELAY} (doubled for every earlier retry) if the
+        failure is temporary and it hasn't been tried L{_MAX_TRIES} times,
+        and logged to L{failed_email_file} otherwise."""
+        self._lock.acquire()
+        try:
+            tries = self._tries.pop(seq, 0) + 1
+            if self._is_temporary(e) and tries < self._MAX_TRIES:
+                self._tries[seq] = tries
+                due = time.time() + self._RETRY_DELAY * 2 ** (tries - 1)
+                heapq.heappush(self._deferred, (due, priority, seq, email))
+                return
+        finally:
+            self._lock.release()
+        try:
+            failed = open(failed_email_file, 'a')
+            failed.write('%s %s\n' % (', '.join(email[3]), e))
+            failed.close()
+        except IOError, e:
+            logging.error('Cannot log failed email: %s' % e)
+
+    def _work(self):
+        """Worker thread loop. Each worker keeps its own SMTP connection,
+        which Django opens on demand and reopens after errors. No exception
+        ends the loop, so that the queue keeps draining; only L{shutdown}
+        does. The worker that waits for a deferred retry moves it to the
+        queue when it is due."""
+        connection = get_connection(fail_silently=False)
+        while True:
+            try:
+                priority, seq, email = self._queue.get(True,
+                                                       self._queue_due())
+            except Empty:
+                continue
+            if email is None:
+                # Stop marker from shutdown()
+                self._queue.task_done()
+                return
+            self._lock.acquire()
+            self._sending += 1
+            self._lock.release()
+            try:
+                self.bucket.consume()
+                try:
+                    subj, msg, sender, recipients, priority = email
+                    message = EmailMessage(subj, msg, sender, recipients,
+                                           connection=connection)
+                    message.send()
+                    self._lock.acquire()
+                    self._tries.pop(seq, None)
+                    self._lock.release()
+                except Exception, e:
+                    logging.error('Cannot send email to %s: %r' %
+                                  (', '.join(email[3]), e))
+                    # The next send reopens the connection
+                    try:
+                        connection.close()
+                    except Exception:
+                        connection.connection = None
+                    self._failed(priority, seq, email, e)
+            finally:
+                self._lock.acquire()
+                self._sending -= 1
+                self._lock.release()
+                self._queue.task_done()
+
+_mailer = None
+
+def get_mailer():
+    """Returns the process-wide L{Mailer}, creating it with the pacing
+    settings in C{config} the first time it is needed. The new mailer also
+    sends the emails the last process left unsent, and saves its own at
+    exit.
+
+    @rtype: L{Mailer}
+    @return: The shared mailer.
+    """
+    global _mailer
+    if _mailer is None:
+        _mailer = Mailer(config.mail_rate, config.mail_burst,
+                         config.mail_threads)
+        _mailer.send_pending()
+        atexit.register(_mailer.shutdown)
+    return _mailer
@@ -0,0 +1,48 @@
+"""A Django command module to bring the database of an existing deployment up
+to date with the current models, using
+$ python manage.py upgradedb
+syncdb only creates missing tables, so columns added to existing tables have
+to be added here."""
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+class Command(BaseCommand):
+    """Represents a Django manage.py command that adds the columns missing
+    from an existing database.
+
+    @type help: str
+    @cvar help: Help text for the command
+    @type _COLUMNS: list [(str, str, str, bool)]
+    @cvar _COLUMNS: The table, column, model field type and default value of
+        every column added since the first release."""
+
+    help = 'Add the columns newer versions of Tor Weather need to the database'
+
+    _COLUMNS = [('weatherapp_subscriber', 'digest', 'BooleanField', True)]
+
+    def handle(self, *args, **options):
+        """Called when upgradedb is called from the command line. Adds every
+        column in L{_COLUMNS} that the database doesn't have yet."""
+        cursor = connection.cursor()
+        tables = connection.introspection.get_table_list(cursor)
+        for (table, column, field_type, default) in self._COLUMNS:
+            if table not in tables:
+                raise CommandError('Table %s does not exist; run syncdb first.'
+                                   % table)
+            description = connection.introspection.get_table_description(
+                                                                cursor, table)
+            if column in [row[0] for row in description]:
+                continue
+            if isinstance(default, bool):
+                if connection.vendor == 'postgresql':
+                    default = default and 'TRUE' or 'FALSE'
+                else:
+                    default = default and '1' or '0'
+            cursor.execute('ALTER TABLE %s ADD COLUMN %s %s NOT NULL '
+                           'DEFAULT %s' % (connection.ops.quote_name(table),
+                                           connection.ops.quote_name(column),
+                                connection.creation.data_types[field_type],
+                                           default))
+            print 'Added %s.%s' % (table, column)
+        transaction.commit_unless_managed()
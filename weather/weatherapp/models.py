@@ -22,6 +22,7 @@ import re
 from copy import copy
 
 from config import url_helper
+from weatherapp import routerdir
 
 from django.db import models
 from django import forms
@@ -197,6 +198,17 @@ class Subscriber(models.Model):
     @type sub_date: DateTimeField (datetime)
     @ivar sub_date: Datetime at which the L{Subscriber} subscribed. Default 
         value is the current time, evaluated by a call to C{datetime.now}.
+    @type digest: BooleanField (bool)
+    @ivar digest: Whether notifications for this L{Subscriber} may be combined
+        with the other notifications sent to the same address in one update
+        cycle; C{True} if they may, C{False} if each notification should be 
+        sent as its own email. Digests are combined per address, so this is
+        a setting of the address rather than of the subscription: the
+        preferences page changes it for all of the address's L{Subscriber}s,
+        and new L{Subscriber}s take it over from the address's existing ones.
+        If they still disagree, the address gets no digests. Default value is
+        C{True}. Databases created before this field existed need
+        C{python manage.py upgradedb}.
     """
 
     _EMAIL_MAX_LEN = 75
@@ -205,7 +217,8 @@ class Subscriber(models.Model):
                   'confirm_auth': get_rand_string,
                   'unsubs_auth': get_rand_string,
                   'pref_auth': get_rand_string,
-                  'sub_date': datetime.now }
+                  'sub_date': datetime.now,
+                  'digest': True }
 
     email = models.EmailField(max_length=_EMAIL_MAX_LEN, 
             default=None, blank=False)
@@ -218,6 +231,7 @@ class Subscriber(models.Model):
     pref_auth = models.CharField(max_length=_AUTH_MAX_LEN,
             default=_DEFAULTS['pref_auth'])
     sub_date = models.DateTimeField(default=_DEFAULTS['sub_date'])
+    digest = models.BooleanField(default=_DEFAULTS['digest'])
 
     def __unicode__(self):
         """Returns a simple description of this L{Subscriber}, namely
@@ -1178,6 +1192,10 @@ class SubscribeForm(GenericForm):
             the database; C{True} if it does, C{False} if it doesn't.
         """
 
+        directory = routerdir.get_directory()
+        if directory is not None:
+            return directory.has_router(fingerprint)
+
         # The router fingerprint field is unique, so we only need to worry
         # about the router not existing, not there being two routers.
         try:
@@ -1211,7 +1229,10 @@ class SubscribeForm(GenericForm):
             raise Exception(url_extension)
             #raise UserAlreadyExistsError(url_extension)
         else:
-            subscriber = Subscriber(email=email, router=router)
+            # The digest preference is per address (see Subscriber.digest)
+            digest = not Subscriber.objects.filter(email=email,
+                                                   digest=False).exists()
+            subscriber = Subscriber(email=email, router=router, digest=digest)
             subscriber.save()
             return subscriber
  
@@ -1247,6 +1268,13 @@ class PreferencesForm(GenericForm):
     @type _USER_INFO_STR: str
     @cvar _USER_INFO_STR: Format of user info displayed at the top of the page.
 
+    @type _DIGEST_LABEL: str
+    @cvar _DIGEST_LABEL: Text displayed next to the L{digest} checkbox.
+
+    @type digest: BooleanField
+    @ivar digest: Checkbox letting users choose whether the notifications
+        for all of their subscriptions are combined into one email per update
+        cycle.
     @type user: L{Subscriber}
     @ivar user: The user/subscriber accessing their preferences.
     @type user_info: str
@@ -1256,6 +1284,13 @@ class PreferencesForm(GenericForm):
     _USER_INFO_STR = '<p><span>Email:</span> %s</p> \
             <p><span>Router Name:</span> %s</p> \
             <p><span>Router Fingerprint:</span> %s</p>'
+    _DIGEST_LABEL = 'Combine the notifications for all routers I am \
+            subscribed to with this email address into one email'
+
+    digest = forms.BooleanField(required=False,
+            label=_DIGEST_LABEL,
+            widget=forms.CheckboxInput(attrs={'class':
+                                              GenericForm._CLASS_CHECK}))
 
     def __init__(self, user, data = None):
         """Calls GenericForm __init__ method and saves C{user} and
@@ -1265,7 +1300,9 @@ class PreferencesForm(GenericForm):
         # If no data, is provided, then create using preferences as initial
         # form data. Otherwise, use provided data.
         if data == None:
-            GenericForm.__init__(self, initial=user.get_preferences())
+            initial = user.get_preferences()
+            initial['digest'] = user.digest
+            GenericForm.__init__(self, initial=initial)
         else:
             GenericForm.__init__(self, data)
  
@@ -1302,6 +1339,11 @@ class PreferencesForm(GenericForm):
 
         old_data = self.preferences
 
+        # Digests are combined per address (see Subscriber.digest)
+        if new_data['digest'] != self.user.digest:
+            Subscriber.objects.filter(email=self.user.email).update(
+                    digest=new_data['digest'])
+
         # If there already was a subscription, get it and update it or delete
         # it depending on the current value.
         if old_data['get_node_down']:
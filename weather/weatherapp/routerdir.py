@@ -0,0 +1,299 @@
+"""A read-only, memory-mapped directory of the routers in the database, so
+that the web workers can look routers up by fingerprint or name without a
+database round trip. The updater writes it with L{publish} after every
+consensus; each web worker maps the file with L{get_directory}, so the pages
+are shared between the worker processes instead of every worker caching its
+own copy. A new directory is written to a temporary file and renamed over
+the old one, and readers switch to it on their next lookup.
+
+The file consists of a header, the router records sorted by fingerprint, the
+name index and two blobs with every name followed by a newline, once as is
+and once in lower case. The name index lists the routers sorted by lower
+case name, and the blobs are laid out in the same order.
+
+@type _HEADER: str
+@var _HEADER: The struct format of the header: magic, format version, number
+    of routers, offset of the name blob and offset of the lower case name
+    blob.
+@type _RECORD: str
+@var _RECORD: The struct format of a router record: fingerprint, flags and
+    position of the router's name in the name index.
+@type _NAME: str
+@var _NAME: The struct format of a name index entry: offset and length of the
+    name in the name blobs, and the position of the router's record.
+"""
+import logging
+import mmap
+import os
+import struct
+import threading
+
+from config import config
+
+_MAGIC = 'TWRTRDIR'
+_VERSION = 1
+_HEADER = '>8sHIII'
+_RECORD = '>40sBI'
+_NAME = '>III'
+_HEADER_LEN = struct.calcsize(_HEADER)
+_RECORD_LEN = struct.calcsize(_RECORD)
+_NAME_LEN = struct.calcsize(_NAME)
+
+_FLAG_UP = 1
+_FLAG_EXIT = 2
+
+def _utf8(s):
+    """Returns C{s} as a UTF-8 encoded str."""
+    if isinstance(s, unicode):
+        return s.encode('utf-8')
+    return str(s)
+
+def write_directory(path, routers):
+    """Writes a router directory to C{path}, replacing any existing one
+    atomically.
+
+    @type path: str
+    @param path: Where to write the directory.
+    @type routers: iterable of tuples (str, str, bool, bool)
+    @param routers: The fingerprint, name, up and exit flag of every router.
+    @rtype: int
+    @return: The number of routers written.
+    """
+    routers = sorted([(_utf8(fingerprint), _utf8(name), up, exit)
+                      for (fingerprint, name, up, exit) in routers])
+    by_name = sorted(range(len(routers)),
+                     key=lambda i: (routers[i][1].lower(), routers[i][1]))
+    name_pos = [0] * len(routers)
+    for pos, i in enumerate(by_name):
+        name_pos[i] = pos
+
+    records = []
+    for i, (fingerprint, name, up, exit) in enumerate(routers):
+        flags = (up and _FLAG_UP or 0) | (exit and _FLAG_EXIT or 0)
+        records.append(struct.pack(_RECORD, fingerprint, flags, name_pos[i]))
+
+    names = []
+    index = []
+    offset = 0
+    for i in by_name:
+        name = routers[i][1]
+        index.append(struct.pack(_NAME, offset, len(name), i))
+        names.append(name + '\n')
+        offset += len(name) + 1
+    names = ''.join(names)
+
+    names_off = _HEADER_LEN + len(routers) * (_RECORD_LEN + _NAME_LEN)
+    header = struct.pack(_HEADER, _MAGIC, _VERSION, len(routers), names_off,
+                         names_off + len(names))
+    tmp = path + '.tmp'
+    f = open(tmp, 'wb')
+    try:
+        f.write(header)
+        f.write(''.join(records))
+        f.write(''.join(index))
+        f.write(names)
+        f.write(names.lower())
+    finally:
+        f.close()
+    os.rename(tmp, path)
+    return len(routers)
+
+class RouterDirectory:
+    """A memory-mapped router directory written by L{write_directory}.
+
+    @type path: str
+    @ivar path: The file the directory was mapped from.
+    @type ident: tuple
+    @ivar ident: The inode, size and modification time of the mapped file,
+        to tell whether the file at L{path} has been replaced since.
+    """
+
+    def __init__(self, path):
+        f = open(path, 'rb')
+        try:
+            st = os.fstat(f.fileno())
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+        self.path = path
+        self.ident = (st.st_ino, st.st_size, st.st_mtime)
+        if st.st_size < _HEADER_LEN:
+            raise ValueError('%s is not a router directory' % path)
+        (magic, version, self._count, self._names_off,
+         self._lower_off) = struct.unpack_from(_HEADER, self._map)
+        if magic != _MAGIC or version != _VERSION:
+            raise ValueError('%s is not a version %d router directory' %
+                             (path, _VERSION))
+        self._index_off = _HEADER_LEN + self._count * _RECORD_LEN
+
+    def __len__(self):
+        return self._count
+
+    def _record(self, i):
+        """Returns the fingerprint, flags and name position of record C{i}.
+        """
+        return struct.unpack_from(_RECORD, self._map,
+                                  _HEADER_LEN + i * _RECORD_LEN)
+
+    def _name_entry(self, pos):
+        """Returns the offset, length and record of name index entry
+        C{pos}."""
+        return struct.unpack_from(_NAME, self._map,
+                                  self._index_off + pos * _NAME_LEN)
+
+    def _name(self, pos, blob_off=None):
+        """Returns the name at position C{pos} of the name index, from the
+        lower case blob if C{blob_off} says so."""
+        if blob_off is None:
+            blob_off = self._names_off
+        offset, length, i = self._name_entry(pos)
+        return self._map[blob_off + offset:blob_off + offset + length]
+
+    def get(self, fingerprint):
+        """Looks a router up by fingerprint.
+
+        @type fingerprint: str
+        @param fingerprint: The router's fingerprint, without spaces.
+        @rtype: tuple (str, bool, bool) or None
+        @return: The name, up and exit flag of the router, or C{None} if
+            there is no router with that fingerprint.
+        """
+        fingerprint = _utf8(fingerprint)
+        lo, hi = 0, self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._record(mid)[0].rstrip('\0') < fingerprint:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo == self._count:
+            return None
+        found, flags, pos = self._record(lo)
+        if found.rstrip('\0') != fingerprint:
+            return None
+        return (self._name(pos).decode('utf-8'), bool(flags & _FLAG_UP),
+                bool(flags & _FLAG_EXIT))
+
+    def has_router(self, fingerprint):
+        """Returns whether the directory has a router with the fingerprint
+        C{fingerprint}.
+
+        @rtype: bool
+        """
+        return self.get(fingerprint) is not None
+
+    def fingerprints_named(self, name):
+        """Returns the fingerprints of the routers named exactly C{name}.
+
+        @type name: str
+        @param name: The router name to look for.
+        @rtype: list [str]
+        @return: The fingerprints, without spaces.
+        """
+        name = _utf8(name)
+        lower = name.lower()
+        lo, hi = 0, self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._name(mid, self._lower_off) < lower:
+                lo = mid + 1
+            else:
+                hi = mid
+        fingerprints = []
+        while lo < self._count and self._name(lo, self._lower_off) == lower:
+            if self._name(lo) == name:
+                i = self._name_entry(lo)[2]
+                fingerprints.append(self._record(i)[0].rstrip('\0'))
+            lo += 1
+        return fingerprints
+
+    def names_containing(self, value):
+        """Returns the names of the routers whose name contains C{value},
+        ignoring case, in alphabetical order. Names shared by several
+        routers are listed once per router.
+
+        @type value: str
+        @param value: The text to look for.
+        @rtype: list [str]
+        """
+        value = _utf8(value).lower()
+        if not value or '\n' in value:
+            return []
+        names = []
+        start = self._lower_off
+        end = self._lower_off + (self._lower_off - self._names_off)
+        while True:
+            found = self._map.find(value, start, end)
+            if found == -1:
+                break
+            # The blobs line up, so the name's offset in the lower case blob
+            # gives it in the other one too
+            name_start = self._map.rfind('\n', self._lower_off, found) + 1
+            if name_start == 0:
+                name_start = self._lower_off
+            name_end = self._map.find('\n', found, end)
+            shift = self._lower_off - self._names_off
+            names.append(self._map[name_start - shift:name_end - shift]
+                         .decode('utf-8'))
+            start = name_end + 1
+        return names
+
+_directory = None
+_directory_lock = threading.Lock()
+
+def get_directory(path=None):
+    """Returns the router directory at C{path}, mapping it again if the
+    file has been replaced since it was last mapped.
+
+    @type path: str
+    @param path: The directory file. Defaults to
+        C{config.router_directory}.
+    @rtype: L{RouterDirectory} or None
+    @return: The directory, or C{None} if there is none (yet), in which case
+        the caller should query the database instead.
+    """
+    global _directory
+    if path is None:
+        path = config.router_directory
+    if not path:
+        return None
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    _directory_lock.acquire()
+    try:
+        directory = _directory
+        if directory is None or directory.path != path or \
+           directory.ident != (st.st_ino, st.st_size, st.st_mtime):
+            try:
+                directory = RouterDirectory(path)
+            except (IOError, OSError, ValueError, struct.error), e:
+                logging.warning('Cannot map router directory %s: %s' %
+                                (path, e))
+                return None
+            _directory = directory
+        return directory
+    finally:
+        _directory_lock.release()
+
+def publish(routers, path=None):
+    """Writes the router directory for the web workers, if one is
+    configured.
+
+    @type routers: iterable of tuples (str, str, bool, bool)
+    @param routers: The fingerprint, name, up and exit flag of every router.
+    @type path: str
+    @param path: The directory file. Defaults to
+        C{config.router_directory}.
+    """
+    if path is None:
+        path = config.router_directory
+    if not path:
+        return
+    try:
+        count = write_directory(path, routers)
+    except (IOError, OSError), e:
+        logging.error('Cannot write router directory %s: %s' % (path, e))
+    else:
+        logging.info('Published %d routers to %s.' % (count, path))
@@ -2,17 +2,23 @@
 The test module. To run tests, cd to weather and run 'python manage.py
 test weatherapp'.
 """
+import os
+import tempfile
 import time
 from datetime import datetime, timedelta
 
 from models import Subscriber, Subscription, Router, NodeDownSub, TShirtSub, \
-                   VersionSub, BandwidthSub
+                   VersionSub, BandwidthSub, PreferencesForm
 import emails
-from ctlutil import CtlUtil
+import routerdir
+import updaters
+from ctlutil import CtlUtil, DescriptorCache
+from TorCtl import TorCtl, PathSupport
 
 from django.test import TestCase
 from django.test.client import Client
 from django.core import mail
+from django.utils import simplejson
 
 class TestWeb(TestCase):
     """Tests the Tor Weather application via post requests"""
@@ -377,6 +383,78 @@ class TestWeb(TestCase):
         #Test that no messages have been sent
         time.sleep(3)
         self.assertEqual(len(mail.outbox), 0)
+
+    def test_digest_preference(self):
+        """Make sure the digest preference is changed for all of an address's
+        subscriptions and taken over by its new ones."""
+        other = Router(fingerprint = '5678', name = 'def')
+        other.save()
+        first = Subscriber(email = 'name@place.com',
+                           router = Router.objects.get(fingerprint = '1234'),
+                           confirmed = True)
+        first.save()
+        second = Subscriber(email = 'name@place.com', router = other,
+                            confirmed = True)
+        second.save()
+        TShirtSub(subscriber = first).save()
+
+        form = PreferencesForm(first, {'get_t_shirt': True,
+                                       'node_down_grace_pd_unit': 'H',
+                                       'version_type': 'UNRECOMMENDED'})
+        self.assertTrue(form.is_valid())
+        form.change_subscriptions(form.cleaned_data)
+        self.assertEqual([s.digest for s in Subscriber.objects.all()],
+                         [False, False])
+
+        Router(fingerprint = '9012', name = 'ghi').save()
+        self.client.post('/subscribe/', {'email_1':'name@place.com',
+                                         'email_2' : 'name@place.com',
+                                         'fingerprint' : '9012',
+                                         'node_down_grace_pd_unit': 'H',
+                                         'version_type': 'UNRECOMMENDED',
+                                         'get_t_shirt' : True},
+                                         follow = True)
+        self.assertFalse(Subscriber.objects.get(
+                                    router__fingerprint = '9012').digest)
+
+    def test_router_directory(self):
+        """Make sure the router lookups give the same answers from the
+        published router directory as from the database."""
+        Router(fingerprint = '5678', name = 'xabcx', up = False).save()
+        Router(fingerprint = '9012', name = 'dup').save()
+        Router(fingerprint = '3456', name = 'dup').save()
+        queries = [('/router_name_lookup/', 'abc'),
+                   ('/router_name_lookup/', 'ABC'),
+                   ('/router_name_lookup/', 'zzz'),
+                   ('/router_fingerprint_lookup/', 'abc'),
+                   ('/router_fingerprint_lookup/', 'dup'),
+                   ('/router_fingerprint_lookup/', 'zzz')]
+        def lookup_all():
+            results = []
+            for url, query in queries:
+                result = simplejson.loads(self.client.get(url,
+                                                {'query': query}).content)
+                if isinstance(result, list):
+                    result.sort()
+                results.append(result)
+            return results
+        from_db = lookup_all()
+
+        path = tempfile.mktemp()
+        routerdir.publish(Router.objects.values_list('fingerprint', 'name',
+                                                     'up', 'exit'), path)
+        old_path = routerdir.config.router_directory
+        routerdir.config.router_directory = path
+        try:
+            directory = routerdir.get_directory()
+            self.assertEqual(directory.get('5678'), (u'xabcx', False, False))
+            self.assertEqual(directory.get('1234'), (u'abc', True, True))
+            self.assertEqual(directory.get('123'), None)
+            from_directory = lookup_all()
+        finally:
+            routerdir.config.router_directory = old_path
+            os.remove(path)
+        self.assertEqual(from_db, from_directory)
     
 class TestNotifications(TestCase):
     """Test the notification side of Tor Weather"""
@@ -455,3 +533,258 @@ class TestNotifications(TestCase):
 
                                
                                    
+
+    def test_digest(self):
+        """Make sure all notifications for one recipient are combined into a
+        single digest, and that excluded recipients are left alone."""
+        email_list = [('[Tor Weather] Node Down!', 'down', 'a@b.com', 
+                       ['name@place.com'], emails.PRIORITY_NODE_DOWN),
+                      ('[Tor Weather] Welcome to Tor!', 'hi', 'a@b.com',
+                       ['other@place.com'], emails.PRIORITY_WELCOME),
+                      ('[Tor Weather] Low bandwidth!', 'low', 'a@b.com',
+                       ['name@place.com'], emails.PRIORITY_BANDWIDTH)]
+
+        digest = emails.digest_tuples(email_list)
+        self.assertEqual(len(digest), 2)
+        self.assertEqual(digest[0][3], ['name@place.com'])
+        self.assertTrue('Node Down!' in digest[0][1])
+        self.assertTrue('low' in digest[0][1])
+        self.assertEqual(digest[1], email_list[1])
+
+        #Make sure recipients who opted out get every email separately
+        digest = emails.digest_tuples(email_list, ['name@place.com'])
+        self.assertEqual(digest, email_list)
+
+    def test_priority(self):
+        """Make sure node down notifications, alone or in a digest, are sent
+        before everything else."""
+        down = emails.node_down_tuple('name@place.com', '1234', 'myrouter',
+                                      '1', 'unsubs', 'pref')
+        welcome = emails.welcome_tuple('other@place.com', '1234', 'myrouter',
+                                       False)
+        self.assertTrue(emails.get_priority(down) < 
+                        emails.get_priority(welcome))
+
+        digest = emails.digest_tuples([welcome, down, 
+                                       (welcome[0], welcome[1], welcome[2],
+                                        ['name@place.com'], welcome[4])])
+        self.assertEqual(emails.get_priority(digest[1]), 
+                         emails.get_priority(down))
+
+        #The priority doesn't depend on the wording of the email
+        edited = (down[0] + ' (edited)', 'reworded', down[2], down[3],
+                  down[4])
+        self.assertEqual(emails.get_priority(edited), 
+                         emails.get_priority(down))
+
+    def test_descriptor_cache(self):
+        """Make sure the descriptor cache is loaded by fingerprint and only
+        refreshes the descriptors it is told about."""
+        class FakeControl:
+            def __init__(self, descs):
+                self.descs = descs
+            def get_info(self, key):
+                if key == 'desc/all-recent':
+                    return {key: '-----END SIGNATURE-----'.join(
+                                                self.descs.values())}
+                return {key: self.descs.get(key.replace('desc/id/', ''), '')}
+            def get_infos(self, keys):
+                return [self.get_info(key) for key in keys]
+
+        control = FakeControl({'1234': 'router a\nopt fingerprint 12 34\n',
+                               '5678': 'router b\nfingerprint 56 78\n'})
+        cache = DescriptorCache()
+        self.assertFalse(cache.is_warm())
+        cache.load(control)
+        self.assertTrue(cache.is_warm())
+        self.assertEqual(cache.get('5678'), 'router b\nfingerprint 56 78\n')
+
+        control.descs['1234'] = 'router c\nopt fingerprint 12 34\n'
+        del control.descs['5678']
+        cache.update(control, ['1234', '5678'])
+        self.assertEqual(cache.get('1234'), 'router c\nopt fingerprint 12 34\n')
+        self.assertEqual(cache.get('5678'), '')
+
+        control.descs['5678'] = 'router b\nfingerprint 56 78\n'
+        cache.load(control)
+        cache.prune(['5678'])
+        self.assertEqual(cache.get('1234'), '')
+        self.assertEqual(cache.get_all(), ['router b\nfingerprint 56 78\n'])
+
+    def test_descriptor_cache_load_race(self):
+        """Make sure a descriptor refetched while the cache loads isn't
+        replaced by the older one in the snapshot being loaded."""
+        cache = DescriptorCache()
+        class FakeControl:
+            def get_info(self, key):
+                if key == 'desc/all-recent':
+                    # A NEWDESC handled while the snapshot is read
+                    cache.update(self, ['1234'])
+                    return {key: 'router old\nopt fingerprint 12 34\n'}
+                return {key: 'router new\nopt fingerprint 12 34\n'}
+            def get_infos(self, keys):
+                return [self.get_info(key) for key in keys]
+
+        cache.load(FakeControl())
+        self.assertEqual(cache.get('1234'),
+                         'router new\nopt fingerprint 12 34\n')
+
+    def test_router_columns_shared(self):
+        """Make sure generators rebuilt for the same consensus share one set
+        of router columns, and that a changed router list gets new ones."""
+        if PathSupport.numpy is None:
+            return
+        routers = [TorCtl.Router('%040X' % i, 'router%d' % i, 1000 * i, False,
+                                 [], ['Fast', 'Running'], '10.0.0.%d' % i,
+                                 '0.2.2.20', 'Linux', 0, None, '', False,
+                                 '', None)
+                   for i in range(1, 6)]
+        sorted_r = TorCtl.SortedRouterList(routers)
+        rstr = PathSupport.NodeRestrictionList(
+                                [PathSupport.FlagsRestriction(['Fast'])])
+
+        consensus = sorted_r.frozen_copy()
+        PathSupport.UniformGenerator(consensus, rstr)
+        columns = PathSupport.RouterColumns._cache[2]
+        self.assertTrue(sorted_r.frozen_copy() is consensus)
+        PathSupport.UniformGenerator(sorted_r.frozen_copy(), rstr)
+        self.assertTrue(PathSupport.RouterColumns._cache[2] is columns)
+
+        routers[0].bw = 10000
+        sorted_r.update(routers[0])
+        sorted_r.update_ranks()
+        changed = sorted_r.frozen_copy()
+        self.assertEqual(list(consensus), routers[::-1])
+        self.assertEqual(changed[0], routers[0])
+        PathSupport.UniformGenerator(changed, rstr)
+        self.assertFalse(PathSupport.RouterColumns._cache[2] is columns)
+
+    def test_path_draws_bounded(self):
+        """Make sure a path whose hops avoid the entry's /16 subnet is found
+        when only a few routers qualify, and that the search gives up if
+        there is no such path instead of drawing forever."""
+        def routers(ips):
+            return [TorCtl.Router('%040X' % i, 'router%d' % i, 1000, False,
+                                  [], ['Running'], ip, '0.2.2.20', 'Linux',
+                                  0, None, '', False, '', None)
+                    for i, ip in enumerate(ips)]
+        def selector(sorted_r):
+            ok = PathSupport.NodeRestrictionList([])
+            return PathSupport.PathSelector(
+                PathSupport.ExactUniformGenerator(sorted_r, ok, position=0),
+                PathSupport.ExactUniformGenerator(sorted_r, ok, position=1),
+                PathSupport.ExactUniformGenerator(sorted_r, ok, position=2),
+                PathSupport.PathRestrictionList(
+                                [PathSupport.Subnet16Restriction()]))
+
+        #200 routers in one /16 and one each in two others
+        tight = routers(['10.0.%d.%d' % (i / 250, i % 250 + 1)
+                         for i in range(200)] + ['10.1.0.1', '10.2.0.1'])
+        path_selector = selector(tight)
+        for i in range(5):
+            path = path_selector.select_path(3)
+            for r in path[1:]:
+                self.assertNotEqual(r.ip >> 16, path[0].ip >> 16)
+
+        same_subnet = routers(['10.0.0.%d' % i for i in range(1, 50)])
+        path_selector = selector(same_subnet)
+        self.assertRaises(PathSupport.NoRouters,
+                          path_selector.select_path, 3)
+        self.assertTrue(path_selector.max_draws <= path_selector.path_draws)
+
+    def test_data_dir_files(self):
+        """Make sure a CtlUtil reading Tor's cached files finds the
+        consensus entries, the most recent descriptors and the recommended
+        versions without a control port connection."""
+        data_dir = tempfile.mkdtemp()
+        finger = '3132333435363738393031323334353637383930'
+        spaced = ' '.join([finger[i:i+4] for i in range(0, 40, 4)])
+        def desc(published, version):
+            return ('@downloaded-at %s\nrouter abc 10.0.0.1 9001 0 0\n'
+                    'platform Tor %s on Linux\npublished %s\n'
+                    'opt fingerprint %s\nbandwidth 1000 2000 3000\n'
+                    'accept *:80\nreject *:*\nrouter-signature\n'
+                    '-----BEGIN SIGNATURE-----\nx\n-----END SIGNATURE-----\n'
+                    % (published, version, published, spaced))
+        files = {'cached-consensus':
+                     'network-status-version 3\n'
+                     'server-versions 0.2.1.26,0.2.1.28\n'
+                     'r abc MTIzNDU2Nzg5MDEyMzQ1Njc4OTA x 2010-06-01 '
+                     '12:00:00 10.0.0.1 9001 0\n'
+                     's Fast Running Stable Valid\n'
+                     'directory-footer\n',
+                 'cached-descriptors': desc('2010-06-01 11:00:00', '0.2.1.26'),
+                 'cached-descriptors.new': desc('2010-06-01 12:00:00',
+                                                '0.2.1.28')}
+        try:
+            for name, text in files.items():
+                f = open(os.path.join(data_dir, name), 'w')
+                f.write(text)
+                f.close()
+            ctl_util = CtlUtil(source='files', data_dir=data_dir)
+            self.assertEqual(ctl_util.get_finger_name_list(), 
+                             [(finger, 'abc')])
+            self.assertTrue(ctl_util.is_up(finger))
+            self.assertTrue(ctl_util.is_stable(finger))
+            self.assertTrue(ctl_util.is_exit(finger))
+            self.assertFalse(ctl_util.is_up('1234'))
+            self.assertEqual(ctl_util.get_version(finger), '0.2.1.28')
+            self.assertEqual(ctl_util.get_bandwidth(finger), 3)
+            self.assertEqual(ctl_util.get_rec_version_list(),
+                             ['0.2.1.26', '0.2.1.28'])
+        finally:
+            for name in files:
+                os.remove(os.path.join(data_dir, name))
+            os.rmdir(data_dir)
+
+    def test_sharded_checks(self):
+        """Make sure checking subscriptions shard by shard gives the same
+        emails and subscription updates as checking them serially, and
+        that subscriptions confirmed after the snapshot are left alone."""
+        class FakeCtlUtil:
+            def get_bandwidth(self, fingerprint):
+                return {'1234': 10, '5678': 500}[fingerprint]
+            def get_version_type(self, fingerprint):
+                return 'OBSOLETE'
+
+        routers = [Router(name='a', fingerprint='1234', up=True),
+                   Router(name='b', fingerprint='5678', up=True)]
+        for router in routers:
+            router.save()
+        for i in range(6):
+            subscriber = Subscriber(email='name%d@place.com' % i,
+                                    router=routers[i % 2], confirmed=True)
+            subscriber.save()
+            BandwidthSub(subscriber=subscriber, threshold=100).save()
+            VersionSub(subscriber=subscriber, notify_type='OBSOLETE').save()
+            NodeDownSub(subscriber=subscriber, grace_pd=1,
+                        triggered=True).save()
+
+        def state():
+            return ([s.emailed for s in BandwidthSub.objects.order_by('id')],
+                    [s.emailed for s in VersionSub.objects.order_by('id')],
+                    [s.triggered for s in NodeDownSub.objects.order_by('id')])
+
+        snapshot = updaters.ConsensusSnapshot(FakeCtlUtil())
+        late_router = Router(name='c', fingerprint='9012', up=True)
+        late_router.save()
+        late = Subscriber(email='late@place.com', router=late_router,
+                          confirmed=True)
+        late.save()
+        BandwidthSub(subscriber=late, threshold=100).save()
+        VersionSub(subscriber=late, notify_type='OBSOLETE').save()
+        results = []
+        for shard in updaters._subscriber_id_ranges(4):
+            results.extend(updaters._check_shard((snapshot, shard)))
+        sharded = updaters._apply_shard_results(results, [])
+        late.delete()
+        sharded_state = state()
+
+        BandwidthSub.objects.update(emailed=False)
+        VersionSub.objects.update(emailed=False)
+        NodeDownSub.objects.update(triggered=True)
+        serial = updaters.check_all_subs(FakeCtlUtil(), [])
+
+        self.assertEqual(len(serial), 9)
+        self.assertEqual(sharded, serial)
+        self.assertEqual(sharded_state, state())
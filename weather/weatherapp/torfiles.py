@@ -0,0 +1,184 @@
+"""Reads the consensus and the router descriptors that a local Tor caches in
+its DataDirectory (C{cached-consensus}, C{cached-descriptors} and
+C{cached-descriptors.new}), as an alternative to fetching them over the
+control port. The files are memory-mapped and scanned once to index where
+each router's consensus entry and descriptor are; the text itself is only
+copied out of the page cache when it is asked for.
+
+@type CONSENSUS_FILE: str
+@var CONSENSUS_FILE: The name of Tor's consensus cache file.
+@type DESCRIPTOR_FILES: tuple (str)
+@var DESCRIPTOR_FILES: The names of Tor's descriptor cache files, oldest
+    first. Tor appends new descriptors to the C{.new} journal and folds it
+    into the other file from time to time.
+"""
+import base64
+import logging
+import mmap
+import os
+
+CONSENSUS_FILE = 'cached-consensus'
+DESCRIPTOR_FILES = ('cached-descriptors', 'cached-descriptors.new')
+
+_END_SIGNATURE = '-----END SIGNATURE-----'
+
+def _map_file(path):
+    """Maps the file at C{path} read-only.
+
+    @rtype: mmap.mmap or None
+    @return: The mapping, or C{None} if the file is missing or empty.
+    """
+    try:
+        f = open(path, 'rb')
+    except IOError, e:
+        logging.info('Cannot read %s: %s' % (path, e))
+        return None
+    try:
+        if os.fstat(f.fileno()).st_size == 0:
+            return None
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    finally:
+        f.close()
+
+def _line_starts(data, keyword, start, end):
+    """Yields the offsets of the lines from C{start} to C{end} in C{data}
+    that begin with C{keyword}."""
+    if data[start:start + len(keyword)] == keyword:
+        yield start
+    keyword = '\n' + keyword
+    pos = data.find(keyword, start, end)
+    while pos != -1:
+        yield pos + 1
+        pos = data.find(keyword, pos + 1, end)
+
+def _line_value(data, keyword, start, end):
+    """Returns the rest of the first line from C{start} to C{end} in C{data}
+    that begins with C{keyword}, or C{None} if there is none."""
+    for pos in _line_starts(data, keyword, start, end):
+        line_end = data.find('\n', pos, end)
+        if line_end == -1:
+            line_end = end
+        return data[pos + len(keyword):line_end]
+    return None
+
+class TorDataFiles:
+    """The consensus and descriptors cached in a Tor DataDirectory.
+
+    @type data_dir: str
+    @ivar data_dir: The DataDirectory the files are read from.
+    """
+
+    def __init__(self, data_dir):
+        self.data_dir = data_dir
+        self._consensus = None
+        self._entries = {}
+        self._versions = []
+        self._descs = {}
+
+    def load(self):
+        """Maps the cache files and indexes the consensus entries and
+        descriptors in them. Where several descriptors of a router are
+        cached, the most recently published one is used.
+        """
+        self._consensus = _map_file(os.path.join(self.data_dir,
+                                                 CONSENSUS_FILE))
+        self._entries = {}
+        self._versions = []
+        if self._consensus is not None:
+            self._index_consensus(self._consensus)
+
+        self._descs = {}
+        for name in DESCRIPTOR_FILES:
+            data = _map_file(os.path.join(self.data_dir, name))
+            if data is not None:
+                self._index_descriptors(data)
+        logging.info('Indexed %d consensus entries and %d descriptors in %s.'
+                     % (len(self._entries), len(self._descs), self.data_dir))
+
+    def _index_consensus(self, data):
+        """Records where each router's entry is in the consensus C{data}.
+        An entry runs from its C{r} line to the next one."""
+        end = data.find('\ndirectory-footer')
+        if end == -1:
+            end = len(data)
+        starts = list(_line_starts(data, 'r ', 0, end))
+        if starts:
+            header_end = starts[0]
+        else:
+            header_end = end
+        versions = _line_value(data, 'server-versions ', 0, header_end)
+        if versions:
+            self._versions = versions.split(',')
+        for i, start in enumerate(starts):
+            if i + 1 < len(starts):
+                entry_end = starts[i + 1]
+            else:
+                entry_end = end + 1
+            # r nickname identity digest date time IP ORPort DirPort
+            identity = data[start:data.find('\n', start)].split(' ')[2]
+            finger = base64.b64decode(identity + '=').encode('hex').upper()
+            self._entries[finger] = (start, entry_end)
+
+    def _index_descriptors(self, data):
+        """Records where each router's descriptor is in the descriptor
+        file C{data}, unless a more recent one has been seen already."""
+        pos = 0
+        for start in _line_starts(data, 'router ', 0, len(data)):
+            if start < pos:
+                continue # A 'router ' line inside the previous descriptor
+            end = data.find(_END_SIGNATURE, start)
+            if end == -1:
+                break # Truncated while Tor was writing it
+            pos = end = end + len(_END_SIGNATURE)
+            finger = _line_value(data, 'opt fingerprint ', start, end)
+            if finger is None:
+                finger = _line_value(data, 'fingerprint ', start, end)
+            if finger is None:
+                continue
+            finger = finger.replace(' ', '')
+            published = _line_value(data, 'published ', start, end)
+            if finger not in self._descs or \
+               published >= self._descs[finger][0]:
+                self._descs[finger] = (published, data, start, end)
+
+    def get_consensus(self):
+        """@rtype: str
+        @return: The whole consensus document, or the empty string if there
+            is none."""
+        if self._consensus is None:
+            return ''
+        return self._consensus[:]
+
+    def get_consensus_entry(self, fingerprint):
+        """@type fingerprint: str
+        @param fingerprint: Fingerprint of the router with no spaces.
+        @rtype: str
+        @return: The router's entry in the consensus, or the empty string if
+            it isn't listed."""
+        if fingerprint not in self._entries:
+            return ''
+        start, end = self._entries[fingerprint]
+        return self._consensus[start:end]
+
+    def get_recommended_versions(self):
+        """@rtype: list [str]
+        @return: The Tor versions the consensus recommends for relays, in
+            ascending order."""
+        return list(self._versions)
+
+    def get_descriptor(self, fingerprint):
+        """@type fingerprint: str
+        @param fingerprint: Fingerprint of the router with no spaces.
+        @rtype: str
+        @return: The router's descriptor, or the empty string if there is
+            none."""
+        if fingerprint not in self._descs:
+            return ''
+        published, data, start, end = self._descs[fingerprint]
+        return data[start:end]
+
+    def get_descriptors(self):
+        """@rtype: list [str]
+        @return: The descriptors of all routers."""
+        return [data[start:end]
+                for (published, data, start, end) in self._descs.values()]
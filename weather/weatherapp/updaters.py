@@ -5,30 +5,218 @@ updating info relating to routers already stored. Next, each subscription is
 checked to determine if the Subscriber should be emailed. When an email 
 notification is indicated, a tuple with the email subject, message, sender, and 
 recipient is added to the list of email tuples. Once all updates are complete, 
-Django's send_mass_mail method is called, passing in the emails tuple as a 
-parameter.
+the notifications for each recipient are combined into a digest (unless the
+subscriber opted out of digests) and the emails are handed to the rate-limited
+L{mailer}, which sends node down notifications first.
 
 @type ctl_util: CtlUtil
 @var ctl_util: A CtlUtil object for the module to handle the connection to and
     communication with TorCtl.
-@var failed_email_file: A log file for parsed email addresses that were non-functional. 
 """
 import socket, sys, os
 import threading
 from datetime import datetime
 import time
 import logging
-from smtplib import SMTPException
+import multiprocessing
+
+from django.db import connection
 
 from config import config
 from weatherapp.ctlutil import CtlUtil
 from weatherapp.models import Subscriber, Router, NodeDownSub, BandwidthSub, \
                               TShirtSub, VersionSub, DeployedDatetime
-from weatherapp import emails
+from weatherapp import emails, mailer, routerdir
+
+def _check_node_down_sub(sub, ctl_util):
+    """Update a confirmed L{NodeDownSub} for the current state of its
+    router.
+
+    @type sub: NodeDownSub
+    @param sub: The subscription to check. It is modified but not saved.
+    @type ctl_util: CtlUtil
+    @param ctl_util: Unused, for symmetry with the other checks.
+    @rtype: tuple or None
+    @return: The email to send, if any.
+    """
+    if sub.subscriber.router.up:
+        if sub.triggered:
+           sub.triggered = False
+           sub.emailed = False
+           sub.last_changed = datetime.now()
+    else:
+        if not sub.triggered:
+            sub.triggered = True
+            sub.last_changed = datetime.now()
+
+        if sub.is_grace_passed() and sub.emailed == False:
+            recipient = sub.subscriber.email
+            fingerprint = sub.subscriber.router.fingerprint
+            name = sub.subscriber.router.name
+            grace_pd = sub.grace_pd
+            unsubs_auth = sub.subscriber.unsubs_auth
+            pref_auth = sub.subscriber.pref_auth
+                
+            sub.emailed = True 
+            return emails.node_down_tuple(recipient, fingerprint, name,
+                                          grace_pd, unsubs_auth, pref_auth)
+    return None
+
+def _check_bandwidth_sub(sub, ctl_util):
+    """Update a confirmed L{BandwidthSub} for the bandwidth its router
+    currently reports.
+
+    @type sub: BandwidthSub
+    @param sub: The subscription to check. It is modified but not saved.
+    @type ctl_util: CtlUtil
+    @param ctl_util: A valid CtlUtil instance or L{ConsensusSnapshot}.
+    @rtype: tuple or None
+    @return: The email to send, if any.
+    """
+    #TorCtl does type checking, so fingerprint needs to be converted from
+    #a unicode string to a python str
+    fingerprint = str(sub.subscriber.router.fingerprint)
+
+    bandwidth = ctl_util.get_bandwidth(fingerprint)
+    if bandwidth < sub.threshold: 
+        if sub.emailed == False:
+            recipient = sub.subscriber.email
+            name = sub.subscriber.router.name
+            threshold = sub.threshold
+            unsubs_auth = sub.subscriber.unsubs_auth
+            pref_auth = sub.subscriber.pref_auth
+            sub.emailed = True
+            return emails.bandwidth_tuple(recipient, fingerprint, name,
+                                          bandwidth, threshold, unsubs_auth,
+                                          pref_auth)
+    else:
+        sub.emailed = False
+    return None
+
+def _check_tshirt_sub(sub, ctl_util):
+    """Update a confirmed L{TShirtSub}'s average bandwidth and decide
+    whether its subscriber has earned a t-shirt.
 
-from django.core.mail import send_mass_mail
+    @type sub: TShirtSub
+    @param sub: The subscription to check. It is modified but not saved.
+    @type ctl_util: CtlUtil
+    @param ctl_util: A valid CtlUtil instance or L{ConsensusSnapshot}.
+    @rtype: tuple or None
+    @return: The email to send, if any.
+    """
+    router = sub.subscriber.router
+    is_up = router.up
+    fingerprint = str(router.fingerprint)
+    if not is_up and sub.triggered:
+        # reset the data if the node goes down
+        sub.triggered = False
+        sub.avg_bandwidth = 0
+        sub.last_changed = datetime.now()
+    elif is_up:
+        current_bandwidth = ctl_util.get_bandwidth(fingerprint)
+        if sub.triggered == False:
+        # router just came back, reset values
+            sub.triggered = True
+            sub.avg_bandwidth = current_bandwidth
+            sub.last_changed = datetime.now()
+        else:
+        # update the avg bandwidth (arithmetic)
+            hours_up = sub.get_hours_since_triggered()
+            sub.avg_bandwidth = ctl_util.get_new_avg_bandwidth(
+                                        sub.avg_bandwidth,
+                                        hours_up,
+                                        current_bandwidth)
+
+            #send email if needed
+            if sub.should_email():
+                recipient = sub.subscriber.email
+                fingerprint = sub.subscriber.router.fingerprint
+                name = sub.subscriber.router.name
+                avg_band = sub.avg_bandwidth
+                time = hours_up
+                exit = sub.subscriber.router.exit
+                unsubs_auth = sub.subscriber.unsubs_auth
+                pref_auth = sub.subscriber.pref_auth
+                
+                sub.emailed = True
+                return emails.t_shirt_tuple(recipient, fingerprint, name,
+                                            avg_band, time, exit,
+                                            unsubs_auth, pref_auth)
+    return None
+
+def _check_version_sub(sub, ctl_util):
+    """Update a confirmed L{VersionSub} for the version of Tor its router
+    runs.
+
+    @type sub: VersionSub
+    @param sub: The subscription to check. It is modified but not saved.
+    @type ctl_util: CtlUtil
+    @param ctl_util: A valid CtlUtil instance or L{ConsensusSnapshot}.
+    @rtype: tuple or None
+    @return: The email to send, if any.
+    """
+    fingerprint = str(sub.subscriber.router.fingerprint)
+    version_type = ctl_util.get_version_type(fingerprint)
+
+    if version_type != 'ERROR':
+        if (version_type == 'OBSOLETE' or sub.notify_type == \
+            version_type): 
+            if sub.emailed == False:
+                name = sub.subscriber.router.name
+                recipient = sub.subscriber.email
+                unsubs_auth = sub.subscriber.unsubs_auth
+                pref_auth = sub.subscriber.pref_auth
+                sub.emailed = True
+                return emails.version_tuple(recipient, fingerprint, name,
+                                            version_type, unsubs_auth,
+                                            pref_auth)
+
+    #if the user has their desired version type, we need to set emailed
+    #to False so that we can email them in the future if we need to
+        else:
+            sub.emailed = False
+    else:
+        logging.info("Couldn't parse the version relay %s is running" \
+                      % fingerprint)
+    return None
+
+# The subscription checks in the order check_all_subs runs them: the
+# subscription class, the function checking one subscription, and the
+# fields that function may change.
+_SUB_CHECKS = ((NodeDownSub, _check_node_down_sub, 
+                ('triggered', 'emailed', 'last_changed')),
+               (VersionSub, _check_version_sub, ('emailed',)),
+               (BandwidthSub, _check_bandwidth_sub, ('emailed',)),
+               (TShirtSub, _check_tshirt_sub,
+                ('triggered', 'avg_bandwidth', 'last_changed', 'emailed')))
+
+def _subs_to_check(sub_class):
+    """Get the subscriptions of class C{sub_class} that need checking, in
+    the order they are checked in.
+
+    @type sub_class: class
+    @param sub_class: A subclass of L{Subscription}.
+    @rtype: QuerySet
+    @return: The confirmed subscriptions to check, ordered by id.
+    """
+    subs = sub_class.objects.filter(subscriber__confirmed = True)
+    if sub_class is TShirtSub:
+        subs = subs.filter(emailed = False)
+    return subs.select_related('subscriber__router').order_by('id')
+
+def _check_subs(sub_class, check, ctl_util, email_list):
+    """Run C{check} on every subscription of class C{sub_class} that needs
+    checking, saving each one and collecting the emails to send.
 
-failed_email_file = 'log/failed_emails.txt'
+    @rtype: list
+    @return: The updated list of tuples representing emails to send.
+    """
+    for sub in _subs_to_check(sub_class):
+        email = check(sub, ctl_util)
+        if email:
+            email_list.append(email)
+        sub.save()
+    return email_list
 
 def check_node_down(email_list):
     """Check if all nodes with L{NodeDownSub} subs are up or down,
@@ -39,39 +227,7 @@ def check_node_down(email_list):
     @rtype: list
     @return: The updated list of tuples representing emails to send.
     """
-    #All node down subs
-    subs = NodeDownSub.objects.all()
-
-    for sub in subs:
-        #only check subscriptions of confirmed subscribers
-        if sub.subscriber.confirmed:
-
-            if sub.subscriber.router.up:
-                if sub.triggered:
-                   sub.triggered = False
-                   sub.emailed = False
-                   sub.last_changed = datetime.now()
-            else:
-                if not sub.triggered:
-                    sub.triggered = True
-                    sub.last_changed = datetime.now()
-
-                if sub.is_grace_passed() and sub.emailed == False:
-                    recipient = sub.subscriber.email
-                    fingerprint = sub.subscriber.router.fingerprint
-                    name = sub.subscriber.router.name
-                    grace_pd = sub.grace_pd
-                    unsubs_auth = sub.subscriber.unsubs_auth
-                    pref_auth = sub.subscriber.pref_auth
-                        
-                    email = emails.node_down_tuple(recipient, fingerprint, 
-                                                   name, grace_pd,          
-                                                   unsubs_auth, pref_auth)
-                    email_list.append(email)
-                    sub.emailed = True 
-
-            sub.save()
-    return email_list
+    return _check_subs(NodeDownSub, _check_node_down_sub, None, email_list)
 
 def check_low_bandwidth(ctl_util, email_list):
     """Checks all L{BandwidthSub} subscriptions, updates the information,
@@ -84,32 +240,8 @@ def check_low_bandwidth(ctl_util, email_list):
     @rtype: list
     @return: The updated list of tuples representing emails to send.
     """
-    subs = BandwidthSub.objects.all()
-
-    for sub in subs:
-
-        #TorCtl does type checking, so fingerprint needs to be converted from
-        #a unicode string to a python str
-        fingerprint = str(sub.subscriber.router.fingerprint)
-
-        if sub.subscriber.confirmed:
-            bandwidth = ctl_util.get_bandwidth(fingerprint)
-            if bandwidth < sub.threshold: 
-                if sub.emailed == False:
-                    recipient = sub.subscriber.email
-                    name = sub.subscriber.router.name
-                    threshold = sub.threshold
-                    unsubs_auth = sub.subscriber.unsubs_auth
-                    pref_auth = sub.subscriber.pref_auth
-                    email_list.append(emails.bandwidth_tuple(recipient, 
-                    fingerprint, name, bandwidth, threshold, unsubs_auth,
-                    pref_auth)) 
-                    sub.emailed = True
-            else:
-                sub.emailed = False
-            sub.save()
-
-    return email_list
+    return _check_subs(BandwidthSub, _check_bandwidth_sub, ctl_util,
+                       email_list)
 
 def check_earn_tshirt(ctl_util, email_list):
     """Check all L{TShirtSub} subscriptions and send an email if necessary. 
@@ -124,57 +256,7 @@ def check_earn_tshirt(ctl_util, email_list):
     @rtype: list
     @return: The updated list of tuples representing emails to send.
     """
-   
-    subs = TShirtSub.objects.filter(emailed = False)
-
-    for sub in subs:
-        if sub.subscriber.confirmed:
-
-            # first, update the database 
-            router = sub.subscriber.router
-            is_up = router.up
-            fingerprint = str(router.fingerprint)
-            if not is_up and sub.triggered:
-                # reset the data if the node goes down
-                sub.triggered = False
-                sub.avg_bandwidth = 0
-                sub.last_changed = datetime.now()
-            elif is_up:
-                descriptor = ctl_util.get_single_descriptor(fingerprint)
-                current_bandwidth = ctl_util.get_bandwidth(fingerprint)
-                if sub.triggered == False:
-                # router just came back, reset values
-                    sub.triggered = True
-                    sub.avg_bandwidth = current_bandwidth
-                    sub.last_changed = datetime.now()
-                else:
-                # update the avg bandwidth (arithmetic)
-                    hours_up = sub.get_hours_since_triggered()
-                    sub.avg_bandwidth = ctl_util.get_new_avg_bandwidth(
-                                                sub.avg_bandwidth,
-                                                hours_up,
-                                                current_bandwidth)
-
-                    #send email if needed
-                    if sub.should_email():
-                        recipient = sub.subscriber.email
-                        fingerprint = sub.subscriber.router.fingerprint
-                        name = sub.subscriber.router.name
-                        avg_band = sub.avg_bandwidth
-                        time = hours_up
-                        exit = sub.subscriber.router.exit
-                        unsubs_auth = sub.subscriber.unsubs_auth
-                        pref_auth = sub.subscriber.pref_auth
-                        
-                        email = emails.t_shirt_tuple(recipient, fingerprint,
-                                                     name, avg_band, time,
-                                                     exit, unsubs_auth, 
-                                                     pref_auth)
-                        email_list.append(email)
-                        sub.emailed = True
-
-            sub.save()
-    return email_list
+    return _check_subs(TShirtSub, _check_tshirt_sub, ctl_util, email_list)
 
 def check_version(ctl_util, email_list):
     """Check/update all C{VersionSub} subscriptions and send emails as
@@ -186,47 +268,155 @@ def check_version(ctl_util, email_list):
     @param email_list: The list of tuples representing emails to send.
     @rtype: list
     @return: The updated list of tuples representing emails to send."""
+    return _check_subs(VersionSub, _check_version_sub, ctl_util, email_list)
+
+class ConsensusSnapshot:
+    """A read-only copy of the relay data the subscription checks get from
+    L{CtlUtil}, taken once in the parent process and sent to the worker 
+    processes of L{check_all_subs}, so that they need no connection to Tor.
+    Only the subscriptions that needed checking when it was taken are
+    covered; the workers leave any others for the next consensus.
+
+    @type sub_ids: dict {class: set}
+    @ivar sub_ids: The ids of the subscriptions to check, by subscription
+        class.
+    @type bandwidth: dict {str: int}
+    @ivar bandwidth: Observed bandwidth by fingerprint.
+    @type version_type: dict {str: str}
+    @ivar version_type: Version type by fingerprint.
+    """
+    def __init__(self, ctl_util):
+        """Look up everything the pending checks will ask for.
+
+        @type ctl_util: CtlUtil
+        @param ctl_util: A valid CtlUtil instance.
+        """
+        self.sub_ids = {}
+        self.bandwidth = {}
+        self.version_type = {}
+        for sub_class, check, fields in _SUB_CHECKS:
+            subs = _subs_to_check(sub_class).values_list('id',
+                        'subscriber__router__fingerprint',
+                        'subscriber__router__up')
+            self.sub_ids[sub_class] = set()
+            for sub_id, fingerprint, up in subs:
+                self.sub_ids[sub_class].add(sub_id)
+                fingerprint = str(fingerprint)
+                if sub_class is BandwidthSub or \
+                        (sub_class is TShirtSub and up):
+                    if fingerprint not in self.bandwidth:
+                        self.bandwidth[fingerprint] = \
+                                ctl_util.get_bandwidth(fingerprint)
+                elif sub_class is VersionSub:
+                    if fingerprint not in self.version_type:
+                        self.version_type[fingerprint] = \
+                                ctl_util.get_version_type(fingerprint)
+
+    def get_bandwidth(self, fingerprint):
+        return self.bandwidth[fingerprint]
+
+    def get_version_type(self, fingerprint):
+        return self.version_type[fingerprint]
+
+    def get_new_avg_bandwidth(self, avg_bandwidth, hours_up, obs_bandwidth):
+        # Plain arithmetic, no Tor connection involved
+        return CtlUtil.get_new_avg_bandwidth.im_func(self, avg_bandwidth,
+                                                     hours_up, obs_bandwidth)
+
+#The worker processes of check_all_subs, started by start_check_pool()
+_pool = None
+
+def start_check_pool():
+    """Start the C{config.check_processes} worker processes that
+    L{check_all_subs} splits the subscription checks across, if it is more
+    than one. Must be called before the process starts any threads: a
+    child forked from a threaded process can inherit locks that are held
+    by threads it doesn't have, and deadlock on them.
+    """
+    global _pool
+    if config.check_processes > 1 and _pool is None:
+        #The workers must open their own database connections
+        connection.close()
+        _pool = multiprocessing.Pool(config.check_processes)
 
-    subs = VersionSub.objects.all()
+def _subscriber_id_ranges(shards):
+    """Split the subscriber ids into at most C{shards} contiguous ranges of
+    about equal size.
 
-    for sub in subs:
-        if sub.subscriber.confirmed:
-            version_type = ctl_util.get_version_type(
-                           str(sub.subscriber.router.fingerprint))
+    @rtype: list
+    @return: List of inclusive (low, high) subscriber id tuples.
+    """
+    ids = list(Subscriber.objects.order_by('id').values_list('id', flat=True))
+    size = (len(ids) + shards - 1) / shards
+    return [(ids[i], ids[min(i + size, len(ids)) - 1]) 
+            for i in xrange(0, len(ids), size or 1)]
+
+def _check_shard(task):
+    """Check the subscriptions of the subscribers in an id range against a
+    L{ConsensusSnapshot} without saving anything, skipping those the
+    snapshot doesn't cover. Runs in a worker process.
+
+    @type task: tuple
+    @param task: The snapshot and the inclusive (low, high) subscriber id
+        range.
+    @rtype: list
+    @return: List of (check index, subscription id, changed fields, email)
+        tuples for every subscription that changed or needs an email.
+    """
+    snapshot, id_range = task
+    results = []
+    for index, (sub_class, check, fields) in enumerate(_SUB_CHECKS):
+        subs = _subs_to_check(sub_class).filter(
+                                        subscriber__id__range = id_range)
+        for sub in subs:
+            #Confirmed since the snapshot was taken
+            if sub.id not in snapshot.sub_ids[sub_class]:
+                continue
+            before = [getattr(sub, field) for field in fields]
+            email = check(sub, snapshot)
+            changed = {}
+            for field, old in zip(fields, before):
+                if getattr(sub, field) != old:
+                    changed[field] = getattr(sub, field)
+            if changed or email:
+                results.append((index, sub.id, changed, email))
+    return results
+
+def _apply_shard_results(results, email_list):
+    """Save the changes and collect the emails from L{_check_shard} results,
+    in the same order the serial checks would have produced them.
 
-            if version_type != 'ERROR':
-                if (version_type == 'OBSOLETE' or sub.notify_type == \
-                    version_type): 
-                    if sub.emailed == False:
-                
-                        fingerprint = sub.subscriber.router.fingerprint
-                        name = sub.subscriber.router.name
-                        recipient = sub.subscriber.email
-                        unsubs_auth = sub.subscriber.unsubs_auth
-                        pref_auth = sub.subscriber.pref_auth
-                        email_list.append(emails.version_tuple(recipient,     
-                                                               fingerprint,
-                                                               name,
-                                                               version_type,
-                                                               unsubs_auth,
-                                                               pref_auth))
-                        sub.emailed = True
-
-            #if the user has their desired version type, we need to set emailed
-            #to False so that we can email them in the future if we need to
-                else:
-                    sub.emailed = False
-            else:
-                logging.info("Couldn't parse the version relay %s is running" \
-                              % fingerprint)
+    @rtype: list
+    @return: The updated list of tuples representing emails to send.
+    """
+    results.sort(key = lambda result: result[:2])
+    for index, sub_id, changed, email in results:
+        if changed:
+            _SUB_CHECKS[index][0].objects.filter(id = sub_id).update(**changed)
+        if email:
+            email_list.append(email)
+    return email_list
 
-            sub.save()
+def _check_all_subs_sharded(ctl_util, email_list, processes):
+    """Check all subscriptions with the worker processes of
+    L{start_check_pool}, each handling a range of subscriber ids.
 
-    return email_list
-        
+    @rtype: list
+    @return: The updated list of tuples representing emails to send.
+    """
+    snapshot = ConsensusSnapshot(ctl_util)
+    shards = _subscriber_id_ranges(processes * 4)
+    results = []
+    for shard_results in _pool.map(_check_shard,
+                                   [(snapshot, shard) for shard in shards]):
+        results.extend(shard_results)
+    return _apply_shard_results(results, email_list)
                 
 def check_all_subs(ctl_util, email_list):
-    """Check/update all subscriptions
+    """Check/update all subscriptions. If C{config.check_processes} is more
+    than one and L{start_check_pool} has been called, the subscriptions are
+    split by subscriber id across that many worker processes; the results
+    are the same as checking them serially.
    
     @type ctl_util: CtlUtil
     @param ctl_util: A valid CtlUtil instance.
@@ -235,14 +425,22 @@ def check_all_subs(ctl_util, email_list):
     @rtype: list
     @return: The updated list of tuples representing emails to send.
     """
+    if config.check_processes > 1 and _pool is None:
+        logging.warning('No check worker processes were started. Checking '
+                        'subscriptions in this process.')
+    elif config.check_processes > 1:
+        logging.debug('Checking subscriptions in %d processes.' % 
+                      config.check_processes)
+        return _check_all_subs_sharded(ctl_util, email_list,
+                                       config.check_processes)
     logging.debug('Checking node down subscriptions.')
     email_list = check_node_down(email_list)
     logging.debug('Checking version subscriptions.')
-    check_version(email_list)
+    email_list = check_version(ctl_util, email_list)
     logging.debug('Checking bandwidth subscriptions.')
-    check_low_bandwidth(email_list)
+    email_list = check_low_bandwidth(ctl_util, email_list)
     logging.debug('Checking shirt subscriptions.')
-    email_list = check_earn_tshirt(email_list)
+    email_list = check_earn_tshirt(ctl_util, email_list)
     return email_list
 
 def update_all_routers(ctl_util, email_list):
@@ -331,16 +529,15 @@ def run_all():
     # the list of tuples of email info, gets updated w/ each call
     email_list = []
     email_list = update_all_routers(ctl_util, email_list)
+    routerdir.publish(Router.objects.values_list('fingerprint', 'name', 'up',
+                                                 'exit'))
     logging.info('Finished updating routers. About to check all subscriptions.')
     email_list = check_all_subs(ctl_util, email_list)
     logging.info('Finished checking subscriptions. About to send emails.')
-    mails = tuple(email_list)
-
-    try:
-        send_mass_mail(mails, fail_silently = False)
-    except SMTPException, e:
-        logging.info(e)
-        failed = open(failed_email_file, 'w')
-        failed.write(e + '\n')
-        failed.close()
-    logging.info('Finished sending emails.')
+    # An address gets no digests if any of its subscriptions opted out
+    no_digest = Subscriber.objects.filter(digest=False).values_list('email',
+                                                                    flat=True)
+    email_list = emails.digest_tuples(email_list, no_digest)
+
+    mailer.get_mailer().send(email_list)
+    logging.info('Finished queueing emails.')
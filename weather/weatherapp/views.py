@@ -12,6 +12,7 @@ from weatherapp.models import Subscriber, Router, GenericForm, \
 from weatherapp import emails
 from config import url_helper, templates
 from weatherapp import error_messages
+from weatherapp import routerdir
 
 import django.views.static
 from django.db import models
@@ -318,8 +319,12 @@ def router_name_lookup(request):
 
             # Ignore queries shorter than length 2
             if len(value) > 2:
-                nodes = Router.objects.filter(name__icontains=value)
-                results = [ node.name for node in nodes ]
+                directory = routerdir.get_directory()
+                if directory is not None:
+                    results = directory.names_containing(value)
+                else:
+                    nodes = Router.objects.filter(name__icontains=value)
+                    results = [ node.name for node in nodes ]
 
         # Creates a json object
         json = simplejson.dumps(results)
@@ -343,6 +348,17 @@ def router_fingerprint_lookup(request):
     if request.method == 'GET':
         if u'query' in request.GET:
             router_name = request.GET[u'query']
+            directory = routerdir.get_directory()
+            if directory is not None:
+                fingerprints = directory.fingerprints_named(router_name)
+                if len(fingerprints) > 1:
+                    json = simplejson.dumps('nonunique_name')
+                elif not fingerprints:
+                    json = simplejson.dumps('no_router')
+                else:
+                    json = simplejson.dumps(
+                            insert_fingerprint_spaces(fingerprints[0]))
+                return HttpResponse(json, mimetype='application/json')
             try:
                 router = Router.objects.get(name = router_name)
             except Router.MultipleObjectsReturned: